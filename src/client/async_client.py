@@ -0,0 +1,575 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from urllib.parse import quote
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+from client import HTTP_TIMEOUT, LEASE_RETRIES, LEASE_RETRY_DELAY, MAX_BACKLOG, RM_FAILOVER_WAIT, RM_POLL_WAIT, reconnect_delay
+
+# asyncio version of Client for driving many logical clients from one
+# process. Requests to the replicas are coroutines on one event loop instead
+# of a thread per replica per request, and they share a bounded pool of
+# kept-alive connections per replica (ReplicaPools). AsyncClient has the
+# same methods as Client; they are coroutines and must be awaited.
+
+
+class ReplicaPool:
+    """At most `size` kept-alive HTTP/1.1 connections to one replica.
+
+    A request takes an idle connection (or opens one while fewer than
+    `size` exist) and waits for one to come back otherwise, so a replica
+    never sees more than `size` connections from this process.
+    """
+
+    def __init__(self, address, size=4, timeout=HTTP_TIMEOUT):
+        host, _, port = address.rpartition(":")
+        self._host = host
+        self._port = int(port)
+        self._timeout = float(timeout)
+        self._slots = asyncio.Semaphore(int(size))
+        self._idle = []
+
+    async def request(self, method, path, body=None, timeout=None):
+        """Send one request; return (status, text).
+
+        A connection the server closed while it sat idle fails on reuse, so
+        the request is resent once on a new connection, as in
+        Client._exchange. `timeout` overrides the pool's for this request
+        (a long-poll).
+        """
+        async with self._slots:
+            for attempt in range(2):
+                conn = self._idle.pop() if self._idle else None
+                reused = conn is not None
+                try:
+                    if conn is None:
+                        conn = await asyncio.wait_for(asyncio.open_connection(self._host, self._port), self._timeout)
+                    status, text, close = await asyncio.wait_for(self._exchange(conn, method, path, body), timeout or self._timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    self._discard(conn)
+                    if not reused or attempt:
+                        raise ConnectionError(f"{self._host}:{self._port}: {e or 'connection closed'}") from e
+                    continue
+                except BaseException:
+                    self._discard(conn)
+                    raise
+                if close:
+                    self._discard(conn)
+                else:
+                    self._idle.append(conn)
+                return status, text
+
+    async def _exchange(self, conn, method, path, body):
+        reader, writer = conn
+        payload = body.encode() if body is not None else b""
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self._host}:{self._port}", f"Content-Length: {len(payload)}"]
+        if body is not None:
+            lines.append("Content-Type: application/json")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + payload)
+        await writer.drain()
+
+        # Status line, headers, then Content-Length bytes of body (or, from
+        # a server that closes the connection and sends no length, such as
+        # the RM, everything up to the close)
+        head = await reader.readuntil(b"\r\n\r\n")
+        status_line, *headers = head.split(b"\r\n")
+        version, status = status_line.split()[:2]
+        length = None
+        close = version == b"HTTP/1.0"
+        for line in headers:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value.strip() or 0)
+            elif name == b"connection":
+                close = value.strip().lower() == b"close"
+        if method == "HEAD":
+            # A reply to HEAD announces a length but carries no body
+            text = ""
+        elif length is None:
+            text = (await reader.read()).decode() if close else ""
+        else:
+            text = (await reader.readexactly(length)).decode() if length else ""
+        return int(status), text, close
+
+    def _discard(self, conn):
+        if conn is not None:
+            conn[1].close()
+
+    def close(self):
+        while self._idle:
+            self._discard(self._idle.pop())
+
+
+class ReplicaPools:
+    """One ReplicaPool per replica, shared by any number of AsyncClients."""
+
+    def __init__(self, server_addresses, size=4, timeout=HTTP_TIMEOUT):
+        self._pools = {replica_id: ReplicaPool(address, size, timeout) for replica_id, address in server_addresses.items()}
+
+    def __getitem__(self, replica_id):
+        return self._pools[replica_id]
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.close()
+
+
+class AsyncClient:
+    def __init__(self, client_id, server_addresses, pools=None, pool_size=4, probe_interval=0, rm_address=None, logger=None):
+        self.client_id = client_id
+        self.server_addresses = server_addresses
+        # Pools passed in are shared and closed by their owner
+        self._own_pools = pools is None
+        self.pools = pools if pools is not None else ReplicaPools(server_addresses, pool_size)
+        self.request_num = 1
+        # Tells this incarnation's request numbers apart from an earlier one's (see Client)
+        self.session = uuid.uuid4().hex
+        self.start_time = time.strftime("%Y%m%d_%H:%M:%S")
+        self.get_counter = None
+        self.primary = None
+        # Chain replication: the replica that answers reads (None otherwise)
+        self.tail = None
+        self._next_backup = -1
+        # Requests to the backups, which finish in the background,
+        # and this client's requests outstanding per replica (at most
+        # MAX_BACKLOG, as in Client, so a hung replica cannot collect an
+        # unbounded pile of them)
+        self._draining = set()
+        self._backlog = {replica_id: 0 for replica_id in server_addresses}
+        if logger is None:
+            log_file = os.path.join(os.path.dirname(__file__), "..", "..", "logs", f"client_{self.client_id}_log_{self.start_time.replace(':', '_')}.txt")
+            logger = get_logger(log_file)
+        self.logger = logger
+        # As in Client: the primary is taken to be healthy until a request to
+        # it fails, and with probe_interval > 0 a background task also checks
+        # it (HEAD /health) when no reply came from it for that long
+        self.probe_interval = float(probe_interval)
+        self._last_reply = time.monotonic()
+        # With the RM's host:port the primary comes from the RM's view (GET
+        # /primary), and a watcher task long-polls the RM for changes. The
+        # tasks start with the first connect_to_servers(), on the caller's loop.
+        self.rm_address = rm_address
+        self._rm_pool = ReplicaPool(rm_address, size=2) if rm_address else None
+        self.view_version = None
+        self._failed_primary = None
+        self._tasks = []
+
+    def log(self, text, level="INFO"):
+        """Print and write log to log file."""
+        self.logger.log(text, level)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        self._tasks = []
+        if self._draining:
+            await asyncio.wait(self._draining, timeout=HTTP_TIMEOUT)
+        if self._rm_pool is not None:
+            self._rm_pool.close()
+        if self._own_pools:
+            self.pools.close()
+
+    def _start_tasks(self):
+        if self._tasks:
+            return
+        if self.probe_interval > 0:
+            self._tasks.append(asyncio.create_task(self._probe()))
+        if self.rm_address:
+            self._tasks.append(asyncio.create_task(self._watch_view()))
+
+    def _primary_failed(self, reason):
+        # Passive failure detection: a real request failed, so look for the
+        # primary (and chain tail) again before the next one
+        if self.primary is not None:
+            self.log(f"[{self._timestamp()}] {self.client_id}: {reason}; rediscovering primary")
+            self._failed_primary = self.primary
+        self.primary = self.tail = None
+
+    async def _probe(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            primary = self.primary
+            if primary is None or time.monotonic() - self._last_reply < self.probe_interval:
+                continue
+            try:
+                status, _ = await self.pools[primary].request("HEAD", "/health")
+            except Exception as e:
+                status = e
+            if status == 200:
+                self._last_reply = time.monotonic()
+            elif self.primary == primary:
+                self._primary_failed(f"Probe of primary {primary} failed: {status}")
+
+    async def _fetch_view(self, since=None, wait=0.0):
+        # The RM's view; with `since`, long-poll for one newer than that version
+        path = "/primary" if since is None else f"/primary?version={since}&wait={wait}"
+        try:
+            status, raw = await self._rm_pool.request("GET", path, timeout=wait + HTTP_TIMEOUT)
+            return json.loads(raw) if status == 200 else None
+        except Exception as e:
+            self.log(f"[{self._timestamp()}] {self.client_id}: RM {self.rm_address} did not answer: {e}")
+            return None
+
+    def _apply_view(self, view):
+        # Take the primary (and chain tail) from an RM view; False if it names none
+        if view is None:
+            return False
+        if self.view_version is not None and view["version"] < self.view_version:
+            return self.primary is not None
+        self.view_version = view["version"]
+        primary = view.get("primary")
+        if primary not in self.server_addresses:
+            return False
+        tail = view.get("tail")
+        if primary != self.primary:
+            self.log(f"[{self._timestamp()}] {self.client_id}: RM view {view['version']}: primary is {primary}")
+            self._failed_primary = None
+        self.primary = primary
+        self.tail = tail if tail in self.server_addresses else None
+        return True
+
+    async def _primary_from_rm(self):
+        view = await self._fetch_view()
+        if view is not None and view.get("primary") is not None and view["primary"] == self._failed_primary:
+            # The RM has not noticed the failure yet: wait for its next view
+            newer = await self._fetch_view(since=view["version"], wait=RM_FAILOVER_WAIT)
+            if newer is None or newer["version"] == view["version"]:
+                return False
+            view = newer
+        return self._apply_view(view)
+
+    async def _watch_view(self):
+        # Follow the RM's view, so a failover reaches the client as soon as
+        # the RM has picked the new primary
+        attempt = 0
+        while True:
+            view = await self._fetch_view(since=self.view_version if self.view_version is not None else -1, wait=RM_POLL_WAIT)
+            if view is None:
+                await asyncio.sleep(reconnect_delay(attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            if view["version"] != self.view_version:
+                self._apply_view(view)
+
+    async def connect_to_servers(self):
+        self._start_tasks()
+        attempt = 0
+        while True:
+            # Ask the RM first; probe the replicas only when it cannot tell
+            if self.rm_address and await self._primary_from_rm():
+                self.log(f"[{self._timestamp()}] {self.client_id}: Primary server is {self.primary} (from the RM)")
+                return
+            connected = None
+            tail = None
+            for replica_id in self.server_addresses:
+                try:
+                    status, raw = await self.pools[replica_id].request("GET", f"/get?client_id={self.client_id}&request_num={self.request_num}")
+                    data = json.loads(raw) if raw else {}
+                except Exception as e:
+                    self.log(f"[{self._timestamp()}] {self.client_id}: Connection to {replica_id} failed: {e}")
+                    continue
+                # A chain head refuses reads (503) but still says it is the primary
+                if data.get("primary") is True and (status == 200 or "tail" in data):
+                    connected = replica_id
+                if status == 200 and data.get("tail") is True:
+                    tail = replica_id
+                # Outside a chain the primary is all we need
+                if connected and (tail or "tail" not in data):
+                    break
+            if connected:
+                self.primary, self.tail = connected, tail
+                self.log(f"[{self._timestamp()}] {self.client_id}: Primary server is {self.primary}")
+                if self.tail:
+                    self.log(f"[{self._timestamp()}] {self.client_id}: Chain tail (reads) is {self.tail}")
+                return
+            delay = reconnect_delay(attempt)
+            attempt += 1
+            self.log(f"[{self._timestamp()}] {self.client_id}: No primary server connections available; retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def increase(self, key=None, retries=0):
+        # Increase the counter named `key` (the default counter if None)
+        return await self.send_request("increase", retries=retries, key=key)
+
+    async def decrease(self, key=None, retries=0):
+        return await self.send_request("decrease", retries=retries, key=key)
+
+    async def get(self, key=None, max_staleness=None):
+        # Value of the counter named `key`, or False
+        data = await self.get_counter_value(max_staleness=max_staleness, key=key)
+        return data.get("counter") if data else False
+
+    async def send_request(self, action, retries=0, key=None):
+        """Send an increase/decrease, retrying up to `retries` times with the
+        same request number (see Client.send_request)."""
+        if action not in ("increase", "decrease"):
+            self.log(f"[{self._timestamp()}] {self.client_id}: Invalid action for send_request: {action}")
+            return False
+        ok = False
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Retrying request id {self.request_num} ({attempt}/{retries})")
+            ok = await self._send_request_once(action, key)
+            if ok:
+                break
+        self.request_num += 1
+        return ok
+
+    async def _send_request_once(self, action, key=None):
+        if not self.primary:
+            await self.connect_to_servers()
+        message_data = {"client_id": self.client_id, "session": self.session, "request_num": self.request_num, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")}
+        if key is not None:
+            message_data["key"] = key
+        data = await self._fan_out(f"/{action}", message_data, action)
+        if data is not None:
+            return True
+        self._primary_failed(f"Primary {self.primary} failed or did not reply")
+        return False
+
+    async def send_batch(self, actions):
+        """Send many increase/decrease ops in one /batch request; returns the
+        primary's per-op results or False (see Client.send_batch)."""
+        ops = []
+        for offset, action in enumerate(actions):
+            action, key = action if isinstance(action, (tuple, list)) else (action, None)
+            if action not in ("increase", "decrease"):
+                self.log(f"[{self._timestamp()}] {self.client_id}: Invalid action for send_batch: {action}")
+                return False
+            op = {"op": action, "client_id": self.client_id, "session": self.session, "request_num": self.request_num + offset}
+            if key is not None:
+                op["key"] = key
+            ops.append(op)
+        if not ops:
+            return []
+
+        if not self.primary:
+            await self.connect_to_servers()
+        message_data = {"client_id": self.client_id, "session": self.session, "request_num": self.request_num, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "ops": ops}
+        data = await self._fan_out("/batch", message_data, f"batch of {len(ops)}")
+        # Every op consumed its request number, even if the batch failed
+        self.request_num += len(ops)
+        if data is not None:
+            return data.get("results")
+        self._primary_failed(f"Primary {self.primary} failed or did not reply to batch")
+        return False
+
+    async def _fan_out(self, path, message_data, action):
+        """POST to every replica at once and return the primary's reply, or
+        None if the primary failed (see Client._primary_reply). The other
+        requests finish in the background."""
+        primary = self.primary
+        request_num = message_data.get("request_num")
+        awaited = None
+        for replica_id in self.server_addresses:
+            if self._backlog[replica_id] >= MAX_BACKLOG:
+                self.log(f"[{self._timestamp()}] {self.client_id}: {replica_id} has {MAX_BACKLOG} requests outstanding; not sending request id {request_num} ({action}) to it")
+                continue
+            self._backlog[replica_id] += 1
+            task = asyncio.create_task(self._post_to_replica(replica_id, path, dict(message_data, replica_id=replica_id), action, primary))
+            task.replica_id = replica_id
+            task.add_done_callback(self._settled)
+            if replica_id == primary:
+                awaited = task
+            else:
+                self._draining.add(task)
+                task.add_done_callback(lambda task: self._drained(task, request_num))
+        if awaited is None:
+            return None
+        reply = await awaited
+        if reply is not None:
+            self._last_reply = time.monotonic()
+            self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {primary}, {reply.get('counter')}, reply>")
+        return reply
+
+    def _settled(self, task):
+        self._backlog[task.replica_id] -= 1
+
+    def _drained(self, task, request_num):
+        self._draining.discard(task)
+        if not task.cancelled() and task.result() is not None:
+            self.log(f"[{self._timestamp()}] request_num {request_num}: Discarded duplicate reply from {task.replica_id}")
+
+    async def _post_to_replica(self, replica_id, path, message_data, action, primary):
+        request_num = message_data.get("request_num")
+        try:
+            self.log(f"[{self._timestamp()}] Sent: <{self.client_id}, {replica_id}, request id: {request_num}, {action}>")
+            status, raw = await self.pools[replica_id].request("POST", path, json.dumps(message_data))
+        except Exception as e:
+            if replica_id == primary:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Failed to send request to {replica_id}: {e}")
+            return None
+        if status != 200:
+            if replica_id == primary:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Bad response from {replica_id}: {status} body={raw}")
+            return None
+        try:
+            return json.loads(raw) if raw else {}
+        except Exception:
+            return {}
+
+    def _get_query(self, request_num, key):
+        query = f"client_id={self.client_id}&request_num={request_num}"
+        if key is not None:
+            query += f"&key={quote(key, safe='')}"
+        return query
+
+    async def get_counter_value(self, max_staleness=None, key=None):
+        # With a staleness bound, a backup's last checkpoint is good enough
+        if max_staleness is not None:
+            data = await self._get_from_backup(max_staleness, key)
+            if data:
+                self.request_num += 1
+                self.get_counter = data
+                return self.get_counter
+
+        if not self.primary:
+            await self.connect_to_servers()
+        reader = self._reader()
+        data = None
+        for attempt in range(LEASE_RETRIES + 1):
+            data = await self._get_from_replica(reader, self.request_num, key)
+            if data or data is False or attempt == LEASE_RETRIES:
+                break
+            # None: the primary has no valid lease (yet), e.g. during a handoff
+            await asyncio.sleep(LEASE_RETRY_DELAY)
+
+        if data:
+            self.request_num += 1
+            self.get_counter = data
+            self._last_reply = time.monotonic()
+            return self.get_counter
+        if data is None:
+            # Still no lease after the retries, e.g. a new primary waiting out
+            # its predecessor's: it answered, so it is not treated as failed
+            self.log(f"[{self._timestamp()}] {self.client_id}: {reader} holds no read lease yet")
+            return False
+        # The primary failed or the chain was reconfigured
+        self._primary_failed(f"Failed to get counter from {'chain tail' if self.tail else 'primary'} {reader}")
+        return False
+
+    async def _get_from_backup(self, max_staleness, key=None):
+        # Try the backups in turn, starting after the one used last time
+        backups = [r for r in self.server_addresses if r != self.primary]
+        if not backups:
+            return None
+        self._next_backup = (self._next_backup + 1) % len(backups)
+        for replica_id in backups[self._next_backup:] + backups[:self._next_backup]:
+            try:
+                self.log(f"[{self._timestamp()}] Sent <{self.client_id}, {replica_id}, request id: {self.request_num}, get, max staleness {max_staleness}s>")
+                status, raw = await self.pools[replica_id].request("GET", f"/get?{self._get_query(self.request_num, key)}&max_staleness={max_staleness}")
+                if status == 200 and raw:
+                    data = json.loads(raw)
+                    self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, backup reply, age {data.get('age', 0):.3f}s>")
+                    return data
+                self.log(f"[{self._timestamp()}] {self.client_id}: Backup {replica_id} refused read: {status} body={raw}")
+            except Exception as e:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Backup read from {replica_id} failed: {e}")
+        return None
+
+    async def _get_from_replica(self, replica_id, request_num, key=None):
+        """Read from one replica. Returns the reply, None if the replica
+        refused because it holds no read lease, or False on any other error."""
+        try:
+            self.log(f"[{self._timestamp()}] Sent <{self.client_id}, {replica_id}, request id: {self.request_num}, get>")
+            status, raw = await self.pools[replica_id].request("GET", f"/get?{self._get_query(request_num, key)}&lease=1")
+        except Exception as e:
+            self.log(f"[{self._timestamp()}] {self.client_id}: Get request to {replica_id} failed: {e}")
+            return False
+        try:
+            data = json.loads(raw) if raw else {}
+        except Exception:
+            data = {}
+        if status == 200:
+            self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, reply>")
+            return data
+        self.log(f"[{self._timestamp()}] {self.client_id}: Failed to get counter value from {replica_id}: {status} body={raw}")
+        if status == 503 and data.get("error") == "no lease":
+            return None
+        return False
+
+    async def list_counters(self):
+        """Return {key: value} for every counter, read from the primary (the
+        tail in a chain), or False."""
+        if not self.primary:
+            await self.connect_to_servers()
+        reader = self._reader()
+        try:
+            status, raw = await self.pools[reader].request("GET", f"/counters?client_id={self.client_id}&request_num={self.request_num}")
+            self.request_num += 1
+            if status != 200:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Failed to list counters on {reader}: {status} body={raw}")
+                return False
+            return json.loads(raw).get("counters", {})
+        except Exception as e:
+            self.log(f"[{self._timestamp()}] {self.client_id}: Listing counters on {reader} failed: {e}")
+            self._primary_failed(f"{reader} did not answer")
+            return False
+
+    def _reader(self):
+        # Replica whose /get reply counts: the chain tail, else the primary
+        return self.tail or self.primary
+
+    def _timestamp(self):
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def run_clients(server_addresses, clients, ops, pool_size=8, mix=(("get", 1), ("increase", 1), ("decrease", 1)), rm_address=None, log_file=None):
+    """Run `clients` logical clients, each doing `ops` random ops one after
+    another, over one shared set of pools. Returns (ok, failed, seconds)."""
+    if log_file is None:
+        log_file = os.path.join(os.path.dirname(__file__), "..", "..", "logs", f"clients_{time.strftime('%Y%m%d_%H_%M_%S')}.txt")
+    # One log file for all logical clients: a file per client would mean a writer thread per client
+    logger = get_logger(log_file, console=False)
+    pools = ReplicaPools(server_addresses, pool_size)
+    actions = [action for action, _ in mix]
+    weights = [weight for _, weight in mix]
+    counts = {"ok": 0, "failed": 0}
+
+    async def one_client(index):
+        client = AsyncClient(f"C{index}", server_addresses, pools=pools, rm_address=rm_address, logger=logger)
+        try:
+            await client.connect_to_servers()
+            for action in random.choices(actions, weights, k=ops):
+                if action == "get":
+                    reply = await client.get_counter_value()
+                else:
+                    reply = await client.send_request(action)
+                counts["ok" if reply else "failed"] += 1
+        finally:
+            await client.close()
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(one_client(i) for i in range(clients)))
+    finally:
+        pools.close()
+    return counts["ok"], counts["failed"], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive many concurrent clients from one process")
+    parser.add_argument("--servers", default="S1=127.0.0.1:8080,S2=127.0.0.1:8081,S3=127.0.0.1:8082",
+                        help="Comma separated replica_id=host:port (default: S1..S3 on 127.0.0.1:8080-8082)")
+    parser.add_argument("--clients", type=int, default=100, help="Concurrent logical clients (default: 100)")
+    parser.add_argument("--ops", type=int, default=100, help="Ops per client (default: 100)")
+    parser.add_argument("--pool-size", type=int, default=8, help="Max connections per replica shared by all clients (default: 8)")
+    parser.add_argument("--rm", default=None, help="RM host:port to learn the primary from (default: probe the replicas)")
+    args = parser.parse_args()
+
+    server_addresses = dict(entry.split("=", 1) for entry in args.servers.split(","))
+    ok, failed, seconds = asyncio.run(run_clients(server_addresses, args.clients, args.ops, pool_size=args.pool_size, rm_address=args.rm))
+    print(f"{args.clients} clients: {ok} ok, {failed} failed in {seconds:.2f}s ({(ok + failed) / seconds:.0f} ops/sec)")
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
-from http.client import HTTPConnection
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from http.client import HTTPConnection, RemoteDisconnected
 import json
 import time
 import os
@@ -8,101 +9,316 @@ import select
 import termios
 import tty
 import threading
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+from urllib.parse import quote
 
 HTTP_TIMEOUT = 5.0
+# A primary without a valid read lease refuses reads for a moment around a
+# lease handoff; retry it this many times before looking for a new primary
+LEASE_RETRIES = 3
+LEASE_RETRY_DELAY = 0.2
+# Requests queued for one replica before further ones skip it: a replica that
+# hangs must not collect an unbounded backlog behind the fast ones
+MAX_BACKLOG = 8
+# Longest a request from outside a replica's sender thread (discovery,
+# probes, reads) waits for it, queueing included
+EXCHANGE_DEADLINE = 2 * HTTP_TIMEOUT
+# Looking for a primary again backs off exponentially between rounds, with
+# jitter so that clients that lost the same primary do not probe in lockstep
+RECONNECT_BACKOFF = 0.1
+RECONNECT_BACKOFF_MAX = 2.0
+# Long-poll window of the RM view watcher, and how long a client that just
+# lost the primary waits for the RM to name another one before it probes
+# the replicas itself
+RM_POLL_WAIT = 20.0
+RM_FAILOVER_WAIT = 5.0
+
+def reconnect_delay(attempt):
+    """Seconds to wait before discovery round `attempt` (0-based) is retried."""
+    return min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
 
 class Client:
-    def __init__(self, client_id, server_addresses):
+    def __init__(self, client_id, server_addresses, probe_interval=0, rm_address=None, logger=None):
         self.client_id = client_id
         self.server_addresses = server_addresses
         self.connections = {}
         self.request_num = 1
+        # Request numbers restart with every Client, so the replicas tell
+        # this incarnation's requests apart from an earlier one's by session
+        self.session = uuid.uuid4().hex
         self.start_time = time.strftime("%Y%m%d_%H:%M:%S")
         #self.log_file = f"../../logs/client_{self.client_id}_log_{self.start_time}.txt"
         self.log_file = os.path.join(os.path.dirname(__file__), "..",'..', "logs", f"client_{self.client_id}_log_{self.start_time.replace(':','_')}.txt")
-        self.success_count = 0
         self.get_counter = None
         self.primary = None
+        # Chain replication: the replica that answers reads (None otherwise)
+        self.tail = None
+        self._next_backup = -1
         self.reply_lock = threading.Lock()
+        # One sender thread per replica owns that replica's connection; the
+        # requests queued on it (at most MAX_BACKLOG) are sent in order
+        self._senders = {}
+        self._backlog = {}
+        self._sender_local = threading.local()
+        # Clients run together (e.g. by the load generator) can share one logger
+        self.logger = logger if logger is not None else get_logger(self.log_file)
+        # The primary is taken to be healthy until a request to it fails. With
+        # probe_interval > 0 a background thread also checks it (HEAD /health)
+        # when no reply came from it for that long.
+        self.probe_interval = float(probe_interval)
+        self._last_reply = time.monotonic()
+        self._stopped = threading.Event()
+        if self.probe_interval > 0:
+            threading.Thread(target=self._probe, name=f"{client_id}-probe", daemon=True).start()
+        # With the RM's host:port the primary comes from the RM's view (GET
+        # /primary), and a watcher thread long-polls the RM for changes
+        self.rm_address = rm_address
+        self.view_version = None
+        self._failed_primary = None
+        if rm_address:
+            threading.Thread(target=self._watch_view, name=f"{client_id}-view", daemon=True).start()
 
         
 
-    def log(self, text):
-        print(text)
+    def log(self, text, level="INFO"):
         """Print and write log to log file."""
-        with open(self.log_file, "a") as f:
-            f.write(text + "\n")
-
-    def _ensure_primary_connection(self):
-        """Ensure there is a live connection to the current primary.
-
-        Returns True if the connection looks usable after at most one
-        reconnection attempt, otherwise False.
-        """
-        if not self.primary:
-            return False
-
-        # If we don't have a connection object, try to create one.
-        if self.primary not in self.connections:
+        self.logger.log(text, level)
+
+    def _sender(self, replica_id):
+        sender = self._senders.get(replica_id)
+        if sender is None:
+            def mark():
+                self._sender_local.replica_id = replica_id
+            sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{self.client_id}-{replica_id}", initializer=mark)
+            self._senders[replica_id] = sender
+            self._backlog[replica_id] = 0
+        return sender
+
+    def _submit(self, replica_id, fn, *args):
+        # Queue fn(*args) on the replica's sender; None if its backlog is full
+        sender = self._sender(replica_id)
+        with self.reply_lock:
+            if self._backlog[replica_id] >= MAX_BACKLOG:
+                return None
+            self._backlog[replica_id] += 1
+
+        def run():
             try:
-                self.connections[self.primary] = HTTPConnection(self.server_addresses[self.primary], timeout=HTTP_TIMEOUT)
-            except Exception as e:
-                self.log(f"[{self._timestamp()}] {self.client_id}: Cannot connect to primary {self.primary}: {e}")
-                return False
-
-        conn = self.connections[self.primary]
-        # Check if the socket is still usable.
+                return fn(*args)
+            finally:
+                with self.reply_lock:
+                    self._backlog[replica_id] -= 1
+        return sender.submit(run)
+
+    def close(self):
+        # Stop the probe, view watcher and sender threads; replies still outstanding are not waited for
+        self._stopped.set()
+        for sender in self._senders.values():
+            sender.shutdown(wait=False, cancel_futures=True)
+
+    def _exchange(self, replica_id, method, path, body=None):
+        """Send one request on the replica's connection; return (status, text).
+
+        The connection belongs to the replica's sender thread, so a call
+        from any other thread is queued there like a write (it counts
+        towards MAX_BACKLOG) and waited for at most EXCHANGE_DEADLINE
+        seconds. Raises on failure, on a full backlog or past the deadline.
+        """
+        if getattr(self._sender_local, "replica_id", None) == replica_id:
+            return self._exchange_on_connection(replica_id, method, path, body)
+        future = self._submit(replica_id, self._exchange_on_connection, replica_id, method, path, body)
+        if future is None:
+            raise ConnectionError(f"{replica_id} has {MAX_BACKLOG} requests outstanding")
         try:
-            conn.request("HEAD", "/health")
-            _ = conn.getresponse()
-            return True
-        except Exception:
-            # try to rebuild the connection once.
+            return future.result(timeout=EXCHANGE_DEADLINE)
+        except FutureTimeout:
+            raise TimeoutError(f"{replica_id} did not answer within {EXCHANGE_DEADLINE}s") from None
+
+    def _exchange_on_connection(self, replica_id, method, path, body):
+        # Servers keep connections open between requests. One that the server
+        # closed while it sat idle fails on reuse, so the request is resent
+        # once on a new connection; for increase/decrease the replica's
+        # de-duplication table makes the resend safe. After any other error
+        # the connection is closed too (a timeout can leave half a reply on
+        # it); the next request opens a new one.
+        conn = self.connections.get(replica_id)
+        if conn is None:
+            conn = self.connections.setdefault(replica_id, HTTPConnection(self.server_addresses[replica_id], timeout=HTTP_TIMEOUT))
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                return response.status, response.read().decode()
+            except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused or attempt:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def _primary_failed(self, reason):
+        # Passive failure detection: a real request failed, so look for the
+        # primary (and chain tail) again before the next one
+        if self.primary is not None:
+            self.log(f"[{self._timestamp()}] {self.client_id}: {reason}; rediscovering primary")
+            self._failed_primary = self.primary
+        self.primary = self.tail = None
+
+    def _probe(self):
+        while not self._stopped.wait(self.probe_interval):
+            primary = self.primary
+            if primary is None or time.monotonic() - self._last_reply < self.probe_interval:
+                continue
             try:
-                self.connections[self.primary] = HTTPConnection(self.server_addresses[self.primary])
-                conn = self.connections[self.primary]
-                conn.request("HEAD", "/health")
-                _ = conn.getresponse()
-                self.log(f"[{self._timestamp()}] {self.client_id}: Reconnected to primary {self.primary}")
-                return True
+                status, _ = self._exchange(primary, "HEAD", "/health")
             except Exception as e:
-                self.log(f"[{self._timestamp()}] {self.client_id}: Primary {self.primary} connection failed after retry: {e}")
+                status = e
+            if status == 200:
+                self._last_reply = time.monotonic()
+            elif self.primary == primary:
+                self._primary_failed(f"Probe of primary {primary} failed: {status}")
+
+    def _fetch_view(self, since=None, wait=0.0):
+        # The RM's view; with `since`, long-poll for one newer than that version
+        path = "/primary" if since is None else f"/primary?version={since}&wait={wait}"
+        conn = HTTPConnection(self.rm_address, timeout=wait + HTTP_TIMEOUT)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            raw = response.read()
+            return json.loads(raw) if response.status == 200 else None
+        except Exception as e:
+            if not self._stopped.is_set():
+                self.log(f"[{self._timestamp()}] {self.client_id}: RM {self.rm_address} did not answer: {e}")
+            return None
+        finally:
+            conn.close()
+
+    def _apply_view(self, view):
+        # Take the primary (and chain tail) from an RM view; False if it names none
+        if view is None:
+            return False
+        if self.view_version is not None and view["version"] < self.view_version:
+            return self.primary is not None
+        self.view_version = view["version"]
+        primary = view.get("primary")
+        if primary not in self.server_addresses:
+            return False
+        tail = view.get("tail")
+        if primary != self.primary:
+            self.log(f"[{self._timestamp()}] {self.client_id}: RM view {view['version']}: primary is {primary}")
+            self._failed_primary = None
+        self.primary = primary
+        self.tail = tail if tail in self.server_addresses else None
+        return True
+
+    def _primary_from_rm(self):
+        view = self._fetch_view()
+        if view is not None and view.get("primary") is not None and view["primary"] == self._failed_primary:
+            # The RM has not noticed the failure yet: wait for its next view
+            newer = self._fetch_view(since=view["version"], wait=RM_FAILOVER_WAIT)
+            if newer is None or newer["version"] == view["version"]:
                 return False
+            view = newer
+        return self._apply_view(view)
+
+    def _watch_view(self):
+        # Follow the RM's view, so a failover reaches the client as soon as
+        # the RM has picked the new primary
+        attempt = 0
+        while not self._stopped.is_set():
+            view = self._fetch_view(since=self.view_version if self.view_version is not None else -1, wait=RM_POLL_WAIT)
+            if view is None:
+                self._stopped.wait(reconnect_delay(attempt))
+                attempt += 1
+                continue
+            attempt = 0
+            if view["version"] != self.view_version:
+                self._apply_view(view)
 
     def connect_to_servers(self):
         connected = ""
+        attempt = 0
         while connected == "":
             for replica_id, address in self.server_addresses.items():
                 try:
-                    self.connections[replica_id] = HTTPConnection(address, timeout=HTTP_TIMEOUT)
+                    # Only created here: from now on the replica's sender thread owns it
+                    self.connections.setdefault(replica_id, HTTPConnection(address, timeout=HTTP_TIMEOUT))
                     self.log(f"[{self._timestamp()}] {self.client_id}: Connected to server {replica_id} at {address}")
                 except Exception as e:
                     self.log(f"[{self._timestamp()}] {self.client_id}: Connection to {replica_id} failed: {e}")
 
+            # Ask the RM first; probe the replicas only when it cannot tell
+            if self.rm_address and self._primary_from_rm():
+                self.log(f"[{self._timestamp()}] {self.client_id}: Primary server is {self.primary} (from the RM)")
+                return
+
+            self.tail = None
             for replica_id in list(self.connections.keys()):
                 try:
-                    conn = self.connections[replica_id]
-                    conn.request("GET", f"/get?client_id={self.client_id}&request_num={self.request_num}")
-                    resp = conn.getresponse()
-                    raw = resp.read().decode()
-                    if resp.status == 200 and raw:
-                        try:
-                            data = json.loads(raw)
-                            if data.get("primary") is True:
-                                connected = replica_id
-                                break
-                        except Exception:
-                            pass
+                    status, raw = self._exchange(replica_id, "GET", f"/get?client_id={self.client_id}&request_num={self.request_num}")
+                    data = json.loads(raw) if raw else {}
                 except Exception:
-                    pass
+                    continue
+                # A chain head refuses reads (503) but still says it is the primary
+                if data.get("primary") is True and (status == 200 or "tail" in data):
+                    connected = replica_id
+                if status == 200 and data.get("tail") is True:
+                    self.tail = replica_id
+                # Outside a chain the primary is all we need
+                if connected and (self.tail or "tail" not in data):
+                    break
             if connected in self.connections:
                 self.primary = connected
                 self.log(f"[{self._timestamp()}] {self.client_id}: Primary server is {self.primary}")
+                if self.tail:
+                    self.log(f"[{self._timestamp()}] {self.client_id}: Chain tail (reads) is {self.tail}")
             else:
-                self.log(f"[{self._timestamp()}] {self.client_id}: No primary server connections available")
-                time.sleep(2)
-
-    def send_request(self, action):
+                delay = reconnect_delay(attempt)
+                attempt += 1
+                self.log(f"[{self._timestamp()}] {self.client_id}: No primary server connections available; retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    def increase(self, key=None, retries=0):
+        # Increase the counter named `key` (the default counter if None)
+        return self.send_request("increase", retries=retries, key=key)
+
+    def decrease(self, key=None, retries=0):
+        return self.send_request("decrease", retries=retries, key=key)
+
+    def get(self, key=None, max_staleness=None):
+        # Value of the counter named `key`, or False
+        data = self.get_counter_value(max_staleness=max_staleness, key=key)
+        return data.get("counter") if data else False
+
+    def send_request(self, action, retries=0, key=None):
+        """Send an increase/decrease, retrying up to `retries` times.
+
+        Retries reuse the request number, so a replica that already applied
+        the op answers from its de-duplication table instead of applying it
+        again. The request number advances once per call, success or not.
+        `key` names the counter; None means the server's default counter.
+        """
+        if action not in ("increase", "decrease"):
+            self.log(f"[{self._timestamp()}] {self.client_id}: Invalid action for send_request: {action}")
+            return False
+        ok = False
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Retrying request id {self.request_num} ({attempt}/{retries})")
+            ok = self._send_request_once(action, key)
+            if ok:
+                break
+        self.request_num += 1
+        return ok
+
+    def _send_request_once(self, action, key=None):
         # Check connections
         if not self.connections:
             self.log(f"[{self._timestamp()}] {self.client_id}: No connections established")
@@ -124,96 +340,183 @@ class Client:
             self.log(f"[{self._timestamp()}] {self.client_id}: Primary not found")
             return False
 
-        # Ensure the primary connection is alive; if not, try rediscovery.
-        if not self._ensure_primary_connection():
-            self.log(f"[{self._timestamp()}] {self.client_id}: Primary connection dead; rediscovering primary")
-            time.sleep(1)
-            self.primary = None
-            self.connect_to_servers()
-            if not self.primary or not self._ensure_primary_connection():
-                self.log(f"[{self._timestamp()}] {self.client_id}: Unable to establish connection to any primary")
-                return False
+        request_num = self.request_num
+        data = self._primary_reply(request_num, action, lambda replica_id: self._send_to_replica(replica_id, path, request_num, action, key))
+        if data is not None:
+            return True
+        else:
+            self._primary_failed(f"Primary {self.primary} failed or did not reply")
+            return False
 
-        self.success_count = 0
-        threads = []
+    def _primary_reply(self, request_num, action, send):
+        """Run send(replica_id) for every replica on its sender and return
+        the primary's reply, or None if the primary failed.
+
+        Reads go to the primary (in the chain the head answers a write only
+        once the tail has it), so returning on a backup's reply would let
+        the next read miss the write, and would hide a primary that stopped
+        answering. The other replies are still read, in the background, and
+        logged as duplicates.
+        """
+        primary = self.primary
+        done = threading.Condition(self.reply_lock)
+        outcome = {"reply": None, "answered": False}
 
         def worker(replica_id):
-            if replica_id not in self.connections:
-                try:
-                    self.connections[replica_id] = HTTPConnection(self.server_addresses[replica_id], timeout=HTTP_TIMEOUT)
-                except Exception as e:
-                    self.log(f"[{self._timestamp()}] {self.client_id}: Cannot connect to {replica_id}: {e}")
-                    return
-            sent = self._send_to_replica(replica_id, path, self.request_num, action)
-            if replica_id == self.primary and sent:
-                with self.reply_lock:
-                    self.success_count += 1
+            data = None
+            try:
+                data = send(replica_id)
+            except Exception as e:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Cannot connect to {replica_id}: {e}")
+            finally:
+                if replica_id == primary:
+                    with done:
+                        outcome["reply"] = data
+                        outcome["answered"] = True
+                        if data is not None:
+                            self._last_reply = time.monotonic()
+                        done.notify_all()
+            if data is None:
+                return
+            if replica_id == primary:
+                self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, reply>")
+            else:
+                self.log(f"[{self._timestamp()}] request_num {request_num}: Discarded duplicate reply from {replica_id}")
 
         for replica_id in self.server_addresses.keys():
-            t = threading.Thread(target=worker, args=(replica_id,))
-            t.start()
-            threads.append(t)
+            if self._submit(replica_id, worker, replica_id) is None:
+                self.log(f"[{self._timestamp()}] {self.client_id}: {replica_id} has {MAX_BACKLOG} requests outstanding; not sending request id {request_num} ({action}) to it")
+                if replica_id == primary:
+                    with done:
+                        outcome["answered"] = True
+
+        with done:
+            done.wait_for(lambda: outcome["answered"])
+            return outcome["reply"]
+
+    def send_batch(self, actions):
+        """Send many increase/decrease ops in one /batch request.
+
+        An action is "increase" / "decrease" for the default counter or an
+        (action, key) pair. Each op gets its own request number. Returns the
+        primary's per-op results (list of dicts with ok / key / counter /
+        request_num) or False.
+        """
+        if not self.connections:
+            self.log(f"[{self._timestamp()}] {self.client_id}: No connections established")
+            return False
 
-        for t in threads:
-            t.join()
+        ops = []
+        for offset, action in enumerate(actions):
+            action, key = action if isinstance(action, (tuple, list)) else (action, None)
+            if action not in ("increase", "decrease"):
+                self.log(f"[{self._timestamp()}] {self.client_id}: Invalid action for send_batch: {action}")
+                return False
+            op = {"op": action, "client_id": self.client_id, "session": self.session, "request_num": self.request_num + offset}
+            if key is not None:
+                op["key"] = key
+            ops.append(op)
+        if not ops:
+            return []
 
-        if self.success_count > 0:
-            self.request_num += 1
-            return True
+        if not self.primary:
+            self.connect_to_servers()
+        if not self.primary:
+            self.log(f"[{self._timestamp()}] {self.client_id}: Primary not found")
+            return False
+
+        message_data = {
+            'client_id': self.client_id,
+            'session': self.session,
+            'request_num': self.request_num,
+            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'ops': ops,
+        }
+
+        action = f"batch of {len(ops)}"
+        data = self._primary_reply(self.request_num, action,
+                                   lambda replica_id: self._post_to_replica(replica_id, "/batch", dict(message_data, replica_id=replica_id), action))
+
+        # Every op consumed its request number, even if the batch failed
+        self.request_num += len(ops)
+        if data is not None:
+            return data.get("results")
         else:
-            self.log(f"[{self._timestamp()}] {self.client_id}: Primary {self.primary} failed or did not reply")
+            self._primary_failed(f"Primary {self.primary} failed or did not reply to batch")
             return False
 
-    def _send_to_replica(self, replica_id, path, request_num, action):
+    def _post_to_replica(self, replica_id, path, message_data, action):
+        # POST a JSON body and return the decoded reply, or None on failure
+        request_num = message_data.get('request_num')
+        try:
+            self.log(f"[{self._timestamp()}] Sent: <{self.client_id}, {replica_id}, request id: {request_num}, {action}>")
+            status, raw = self._exchange(replica_id, "POST", path, json.dumps(message_data))
+            if status != 200:
+                if replica_id == self.primary:
+                    self.log(f"[{self._timestamp()}] {self.client_id}: Bad response from {replica_id}: {status} body={raw}")
+                return None
+            try:
+                return json.loads(raw) if raw else {}
+            except Exception:
+                return {}
+        except Exception as e:
+            if replica_id == self.primary:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Failed to send request to {replica_id}: {e}")
+            return None
+
+    def _send_to_replica(self, replica_id, path, request_num, action, key=None):
+        # Returns the replica's decoded reply, or None on failure
         # Construct the message payload
         message_data = {
             'client_id': self.client_id,
+            'session': self.session,
             'replica_id': replica_id,
             'request_num': request_num,
             'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
         }
+        if key is not None:
+            message_data['key'] = key
         message_json = json.dumps(message_data)
 
         try:
-            # Send POST request
-            self.connections[replica_id].request("POST", path, body=message_json,
-                                                headers={"Content-Type": "application/json"})
+            # Send POST request and receive the response
             self.log(f"[{self._timestamp()}] Sent: <{self.client_id}, {replica_id}, request id: {request_num}, {action}>")
-
-            # Receive response
-            response = self.connections[replica_id].getresponse()
-            raw = response.read().decode()
-            if response.status == 200:
+            status, raw = self._exchange(replica_id, "POST", path, message_json)
+            if status == 200:
                 try:
-                    data = json.loads(raw) if raw else {}
+                    return json.loads(raw) if raw else {}
                 except Exception:
-                    data = {}
-                if replica_id == self.primary:
-                    self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, reply>")
-                else:
-                    # self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, reply discarded>")
-                    self.log(f"[{self._timestamp()}] request_num {request_num}: Discarded duplicate reply from {replica_id}")
-                return True
+                    return {}
             else:
                 if replica_id == self.primary:
-                    self.log(f"[{self._timestamp()}] {self.client_id}: Bad response from {replica_id}: {response.status} body={raw}")
-                return False
+                    self.log(f"[{self._timestamp()}] {self.client_id}: Bad response from {replica_id}: {status} body={raw}")
+                return None
         except Exception as e:
             if replica_id == self.primary:
                 self.log(f"[{self._timestamp()}] {self.client_id}: Failed to send request to {replica_id}: {e}")
-            # attempt to recreate connection lazily
-            try:
-                self.connections[replica_id] = HTTPConnection(self.server_addresses[replica_id], timeout=HTTP_TIMEOUT)
-            except Exception:
-                pass
-            return False
+            # The sender thread has closed the connection; the next request reopens it
+            return None
 
-    def get_counter_value(self):
+    def _get_query(self, request_num, key):
+        query = f"client_id={self.client_id}&request_num={request_num}"
+        if key is not None:
+            query += f"&key={quote(key, safe='')}"
+        return query
+
+    def get_counter_value(self, max_staleness=None, key=None):
         # Check connection
         if not self.connections:
             self.log(f"[{self._timestamp()}] {self.client_id}: No connections established")
             return False
 
+        # With a staleness bound, a backup's last checkpoint is good enough
+        if max_staleness is not None:
+            data = self._get_from_backup(max_staleness, key)
+            if data:
+                self.request_num += 1
+                self.get_counter = data
+                return self.get_counter
+
         # Ensure primary known
         if not self.primary:
             self.connect_to_servers()
@@ -221,74 +524,97 @@ class Client:
             self.log(f"[{self._timestamp()}] {self.client_id}: Primary not known")
             return False
 
-        # Ensure the primary connection is alive; if not, try rediscovery.
-        if not self._ensure_primary_connection():
-            self.log(f"[{self._timestamp()}] {self.client_id}: Primary connection dead; rediscovering primary for get")
-            time.sleep(1)
-            self.primary = None
-            self.connect_to_servers()
-            if not self.primary or not self._ensure_primary_connection():
-                self.log(f"[{self._timestamp()}] {self.client_id}: Unable to establish connection to any primary for get")
-                return False
-
-        threads = []
-        primary_data = {"value": None}
-
-        def worker(replica_id):
-            if replica_id not in self.connections:
-                try:
-                    self.connections[replica_id] = HTTPConnection(self.server_addresses[replica_id], timeout=HTTP_TIMEOUT)
-                except Exception as e:
-                    self.log(f"[{self._timestamp()}] {self.client_id}: Cannot connect to {replica_id}: {e}")
-                    return
-            data = self._get_from_replica(replica_id, self.request_num)
-            if replica_id == self.primary and data:
-                primary_data["value"] = data
-
-        for replica_id in self.server_addresses.keys():
-            t = threading.Thread(target=worker, args=(replica_id,))
-            t.start()
-            threads.append(t)
-
-        for t in threads:
-            t.join()
-
-        if primary_data["value"] is not None:
+        # Only the primary (the tail in a chain) is asked: with a lease it can
+        # answer from its own state, so the other replicas need not see reads
+        reader = self._reader()
+        data = None
+        for attempt in range(LEASE_RETRIES + 1):
+            data = self._get_from_replica(reader, self.request_num, key)
+            if data or data is False or attempt == LEASE_RETRIES:
+                break
+            # None: the primary has no valid lease (yet), e.g. during a handoff
+            time.sleep(LEASE_RETRY_DELAY)
+
+        if data:
             self.request_num += 1
-            self.get_counter = primary_data["value"]
+            self.get_counter = data
+            self._last_reply = time.monotonic()
             return self.get_counter
-        else:
-            self.log(f"[{self._timestamp()}] {self.client_id}: Failed to get counter from primary {self.primary}")
+        if data is None:
+            # Still no lease after the retries, e.g. a new primary waiting out
+            # its predecessor's: it answered, so it is not treated as failed
+            self.log(f"[{self._timestamp()}] {self.client_id}: {reader} holds no read lease yet")
             return False
+        # The primary failed or the chain was reconfigured
+        self._primary_failed(f"Failed to get counter from {'chain tail' if self.tail else 'primary'} {reader}")
+        return False
 
-    def _get_from_replica(self, replica_id, request_num):
+    def _get_from_backup(self, max_staleness, key=None):
+        # Try the backups in turn, starting after the one used last time
+        backups = [r for r in self.server_addresses if r != self.primary]
+        if not backups:
+            return None
+        self._next_backup = (self._next_backup + 1) % len(backups)
+        for replica_id in backups[self._next_backup:] + backups[:self._next_backup]:
+            try:
+                self.log(f"[{self._timestamp()}] Sent <{self.client_id}, {replica_id}, request id: {self.request_num}, get, max staleness {max_staleness}s>")
+                status, raw = self._exchange(replica_id, "GET", f"/get?{self._get_query(self.request_num, key)}&max_staleness={max_staleness}")
+                if status == 200 and raw:
+                    data = json.loads(raw)
+                    self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, backup reply, age {data.get('age', 0):.3f}s>")
+                    return data
+                self.log(f"[{self._timestamp()}] {self.client_id}: Backup {replica_id} refused read: {status} body={raw}")
+            except Exception as e:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Backup read from {replica_id} failed: {e}")
+        return None
+
+    def _get_from_replica(self, replica_id, request_num, key=None):
+        """Read from one replica. Returns the reply, None if the replica
+        refused because it holds no read lease, or False on any other error."""
         try:
-            # Send GET request
-            # self.connection.request("GET", f"/get")
-            self.connections[replica_id].request("GET", f"/get?client_id={self.client_id}&request_num={request_num}")
             self.log(f"[{self._timestamp()}] Sent <{self.client_id}, {replica_id}, request id: {self.request_num}, get>")
-            response = self.connections[replica_id].getresponse()
-            raw = response.read().decode()
-            if response.status == 200:
-                try:
-                    data = json.loads(raw) if raw else {}
-                except Exception:
-                    data = {}
-                if replica_id == self.primary:
-                    self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, reply>")
-                else:
-                    self.log(f"[{self._timestamp()}] request_num {request_num}: Discarded duplicate reply from {replica_id}")
+            # lease=1: a replica running with leases answers only while it holds one
+            status, raw = self._exchange(replica_id, "GET", f"/get?{self._get_query(request_num, key)}&lease=1")
+            try:
+                data = json.loads(raw) if raw else {}
+            except Exception:
+                data = {}
+            if status == 200:
+                self.log(f"[{self._timestamp()}] Received: <{self.client_id}, {replica_id}, {data.get('counter')}, reply>")
                 return data
-            else:
-                if replica_id == self.primary:
-                    self.log(f"[{self._timestamp()}] {self.client_id}: Failed to get counter value from {replica_id}: {response.status} body={raw}")
+            self.log(f"[{self._timestamp()}] {self.client_id}: Failed to get counter value from {replica_id}: {status} body={raw}")
+            if status == 503 and data.get("error") == "no lease":
+                return None
+            return False
+        except Exception as e:
+            self.log(f"[{self._timestamp()}] {self.client_id}: Get request to {replica_id} failed: {e}")
+            return False
+
+    def list_counters(self):
+        """Return {key: value} for every counter, read from the primary (the
+        tail in a chain), or False."""
+        if not self.primary:
+            self.connect_to_servers()
+        if not self.primary:
+            self.log(f"[{self._timestamp()}] {self.client_id}: Primary not known")
+            return False
+        reader = self._reader()
+        try:
+            status, raw = self._exchange(reader, "GET", f"/counters?client_id={self.client_id}&request_num={self.request_num}")
+            self.request_num += 1
+            if status != 200:
+                self.log(f"[{self._timestamp()}] {self.client_id}: Failed to list counters on {reader}: {status} body={raw}")
                 return False
+            return json.loads(raw).get("counters", {})
         except Exception as e:
-            if replica_id == self.primary:
-                self.log(f"[{self._timestamp()}] {self.client_id}: Get request to {replica_id} failed: {e}")
-            self.connections[replica_id] = HTTPConnection(self.server_addresses[replica_id], timeout=HTTP_TIMEOUT)
+            self.log(f"[{self._timestamp()}] {self.client_id}: Listing counters on {reader} failed: {e}")
+            self._primary_failed(f"{reader} did not answer")
             return False
 
+    def _reader(self):
+        # Replica whose /get reply counts: the chain tail, else the primary
+        return self.tail or self.primary
+
     def _timestamp(self):
         return time.strftime("%Y-%m-%d %H:%M:%S")
 
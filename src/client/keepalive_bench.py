@@ -0,0 +1,155 @@
+import argparse
+import json
+import socket
+import threading
+import time
+from http.client import HTTPConnection
+
+# Benchmark connection reuse against one replica server:
+#   close     - a new TCP connection per request ("Connection: close")
+#   keepalive - one persistent HTTP/1.1 connection per client thread
+#   pipeline  - persistent connection, `depth` requests written back to back
+#               before the replies are read
+# Point it at a primary (or an active replica) started with the serving mode
+# to measure, e.g. --serving-mode threaded.
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(p / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+def _request_bytes(host, method, path, body, close):
+    lines = [f"{method} {path} HTTP/1.1", f"Host: {host}", "Content-Type: application/json", f"Content-Length: {len(body)}"]
+    if close:
+        lines.append("Connection: close")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+def _read_reply(rfile):
+    # Status line, headers, then Content-Length bytes of body. Returns
+    # (status, close) where close means the server is closing the connection.
+    status = rfile.readline()
+    if not status:
+        raise ConnectionError("connection closed")
+    length = 0
+    close = False
+    while True:
+        line = rfile.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            length = int(value.strip())
+        elif name == b"connection" and value.strip().lower() == b"close":
+            close = True
+    rfile.read(length)
+    return int(status.split()[1]), close
+
+def run_close(host, port, method, path, body, requests, samples):
+    for _ in range(requests):
+        start = time.perf_counter()
+        conn = HTTPConnection(host, port, timeout=5)
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json", "Connection": "close"})
+        conn.getresponse().read()
+        conn.close()
+        samples.append(time.perf_counter() - start)
+
+def run_keepalive(host, port, method, path, body, requests, samples):
+    conn = HTTPConnection(host, port, timeout=5)
+    for _ in range(requests):
+        start = time.perf_counter()
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        conn.getresponse().read()
+        samples.append(time.perf_counter() - start)
+    conn.close()
+
+def run_pipeline(host, port, method, path, body, requests, samples, depth):
+    # Latency of a request here is from writing its window to reading its
+    # reply. When the server closes the connection (request cap, or a server
+    # that does not keep connections open) the rest of the window was not
+    # processed and is sent again on a new connection.
+    request = _request_bytes(host, method, path, body, close=False)
+    sock = rfile = None
+    done = 0
+    while done < requests:
+        if sock is None:
+            sock = socket.create_connection((host, port), timeout=5)
+            rfile = sock.makefile("rb")
+        window = min(depth, requests - done)
+        start = time.perf_counter()
+        sock.sendall(request * window)
+        close = False
+        for _ in range(window):
+            _, close = _read_reply(rfile)
+            samples.append(time.perf_counter() - start)
+            done += 1
+            if close:
+                break
+        if close:
+            rfile.close()
+            sock.close()
+            sock = rfile = None
+    if sock is not None:
+        rfile.close()
+        sock.close()
+
+def run_mode(mode, args):
+    body = json.dumps({"client_id": "bench", "request_num": 0}).encode() if args.method == "POST" else b""
+    per_thread = args.requests // args.threads
+    latencies = [[] for _ in range(args.threads)]
+
+    def worker(samples):
+        if mode == "close":
+            run_close(args.host, args.port, args.method, args.path, body, per_thread, samples)
+        elif mode == "keepalive":
+            run_keepalive(args.host, args.port, args.method, args.path, body, per_thread, samples)
+        else:
+            run_pipeline(args.host, args.port, args.method, args.path, body, per_thread, samples, args.depth)
+
+    workers = [threading.Thread(target=worker, args=(latencies[i],)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    samples = sorted(s for per in latencies for s in per)
+    return {
+        "mode": mode,
+        "requests": len(samples),
+        "threads": args.threads,
+        "seconds": elapsed,
+        "requests_per_sec": len(samples) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Replica server connection reuse benchmark")
+    parser.add_argument("--host", default="127.0.0.1", help="Server host (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Server port (default: 8080)")
+    parser.add_argument("--modes", default="close,keepalive,pipeline", help="Comma separated modes (default: close,keepalive,pipeline)")
+    parser.add_argument("--method", choices=("GET", "POST"), default="GET", help="Request method (default: GET)")
+    parser.add_argument("--path", default="/get", help="Request path, e.g. /increase with --method POST (default: /get)")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per mode (default: 2000)")
+    parser.add_argument("--threads", type=int, default=1, help="Concurrent client connections (default: 1)")
+    parser.add_argument("--depth", type=int, default=16, help="Requests in flight per connection in pipeline mode (default: 16)")
+    parser.add_argument("--json", dest="json_out", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+    args.threads = max(1, args.threads)
+
+    results = []
+    print(f"{'mode':<10} {'req/sec':>10} {'p50 ms':>9} {'p99 ms':>9}")
+    for mode in args.modes.split(","):
+        result = run_mode(mode.strip(), args)
+        results.append(result)
+        print(f"{result['mode']:<10} {result['requests_per_sec']:>10.0f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f}")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+from common.metrics import Histogram
+from client import Client
+
+# Non-interactive load generator built on Client.
+#
+#   closed loop - `concurrency` workers, each sending its next op as soon as
+#                 the previous one returned (plus --think-time)
+#   open loop   - ops are started at a fixed --rate no matter how fast the
+#                 cluster answers; an op that has to wait for a free client
+#                 counts that wait in its latency, so a slow cluster shows
+#                 up in the percentiles instead of just lowering the rate
+#
+# Latencies go into HDR-style histograms (common.metrics.Histogram), one per
+# op and one overall; the results are printed and optionally written as JSON.
+
+OPS = ("get", "increase", "decrease")
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+def parse_mix(text):
+    """"get=50,increase=40,decrease=10" -> [(op, weight), ...]"""
+    mix = []
+    for entry in text.split(","):
+        op, _, weight = entry.partition("=")
+        op = op.strip()
+        if op not in OPS:
+            raise ValueError(f"unknown op {op!r} in mix (expected {', '.join(OPS)})")
+        mix.append((op, float(weight or 1)))
+    if not any(weight > 0 for _, weight in mix):
+        raise ValueError("the mix needs at least one op with a positive weight")
+    return mix
+
+
+class LoadGenerator:
+    def __init__(self, server_addresses, clients, mix, keys=0, rm_address=None, retries=0, log_file=None, log_level="WARN"):
+        if log_file is None:
+            log_file = os.path.join(os.path.dirname(__file__), "..", "..", "logs", f"load_{time.strftime('%Y%m%d_%H_%M_%S')}.txt")
+        # One quiet log for all clients; per-op lines only with --log-level INFO
+        logger = get_logger(log_file, console=False, level=log_level)
+        self.clients = [Client(f"L{i}", server_addresses, rm_address=rm_address, logger=logger) for i in range(clients)]
+        self._ops = [op for op, _ in mix]
+        self._weights = [weight for _, weight in mix]
+        self._keys = int(keys)
+        self._retries = int(retries)
+        self._lock = threading.Lock()
+        self._measuring = False
+        self.latency = {op: Histogram() for op in self._ops}
+        self.overall = Histogram()
+        self.errors = {op: 0 for op in self._ops}
+
+    def connect(self):
+        for client in self.clients:
+            client.connect_to_servers()
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def _run_op(self, client, intended=None):
+        # One random op; latency counts from `intended` when the op was due
+        # (open loop), else from when it was sent
+        op = random.choices(self._ops, self._weights)[0]
+        key = f"k{random.randrange(self._keys)}" if self._keys else None
+        start = intended if intended is not None else time.perf_counter()
+        if op == "get":
+            ok = client.get(key=key) is not False
+        else:
+            ok = client.send_request(op, retries=self._retries, key=key)
+        elapsed = time.perf_counter() - start
+        if self._measuring:
+            if ok:
+                self.latency[op].observe(elapsed)
+                self.overall.observe(elapsed)
+            else:
+                with self._lock:
+                    self.errors[op] += 1
+
+    def _phases(self, warmup, duration):
+        # (measure_from, stop_at) on the perf_counter clock
+        measure_from = time.perf_counter() + warmup
+        return measure_from, measure_from + duration
+
+    def run_closed(self, concurrency, duration, warmup=0.0, think_time=0.0):
+        """`concurrency` workers send ops back to back for `duration` seconds
+        (after `warmup`); worker i uses clients i, i+concurrency, ... in turn."""
+        measure_from, stop_at = self._phases(warmup, duration)
+
+        def worker(index):
+            mine = self.clients[index::concurrency]
+            turn = 0
+            while True:
+                now = time.perf_counter()
+                if now >= stop_at:
+                    return
+                if not self._measuring and now >= measure_from:
+                    self._measuring = True
+                self._run_op(mine[turn % len(mine)])
+                turn += 1
+                if think_time:
+                    time.sleep(think_time)
+
+        workers = [threading.Thread(target=worker, args=(i,), name=f"load-{i}") for i in range(concurrency)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return max(0.0, time.perf_counter() - measure_from)
+
+    def run_open(self, rate, duration, warmup=0.0):
+        """Start ops at `rate` per second for `duration` seconds (after
+        `warmup`), each on whichever client is free."""
+        measure_from, stop_at = self._phases(warmup, duration)
+        idle = queue.Queue()
+        for client in self.clients:
+            idle.put(client)
+
+        def run(client, intended):
+            try:
+                self._run_op(client, intended)
+            finally:
+                idle.put(client)
+
+        interval = 1.0 / rate
+        with ThreadPoolExecutor(max_workers=len(self.clients), thread_name_prefix="load") as pool:
+            due = time.perf_counter()
+            while due < stop_at:
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if not self._measuring and due >= measure_from:
+                    self._measuring = True
+                # Blocks while every client is busy; that wait is part of the op's latency
+                pool.submit(run, idle.get(), due)
+                due += interval
+        return max(0.0, time.perf_counter() - measure_from)
+
+    def report(self, seconds):
+        completed = self.overall.count
+        return {
+            "ops": completed,
+            "errors": sum(self.errors.values()),
+            "seconds": seconds,
+            "ops_per_sec": completed / seconds if seconds > 0 else 0.0,
+            "latency": {"all": self.overall.snapshot(PERCENTILES),
+                        **{op: dict(histogram.snapshot(PERCENTILES), errors=self.errors[op]) for op, histogram in self.latency.items()}},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the replicated counter")
+    parser.add_argument("--servers", default="S1=127.0.0.1:8080,S2=127.0.0.1:8081,S3=127.0.0.1:8082",
+                        help="Comma separated replica_id=host:port (default: S1..S3 on 127.0.0.1:8080-8082)")
+    parser.add_argument("--rm", default=None, help="RM host:port to learn the primary from (default: probe the replicas)")
+    parser.add_argument("--clients", type=int, default=8, help="Client instances (default: 8)")
+    parser.add_argument("--mix", default="get=50,increase=25,decrease=25", help="Op mix as op=weight pairs (default: get=50,increase=25,decrease=25)")
+    parser.add_argument("--keys", type=int, default=0, help="Spread ops over this many counters; 0 uses the default counter (default: 0)")
+    parser.add_argument("--rate", type=float, default=0, help="Open loop: ops/sec to start, regardless of replies (default: 0, closed loop)")
+    parser.add_argument("--concurrency", type=int, default=0, help="Closed loop: ops in flight (default: --clients)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="Closed loop: seconds a worker waits between ops (default: 0)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to measure (default: 10)")
+    parser.add_argument("--warmup", type=float, default=0.0, help="Seconds to run before measuring (default: 0)")
+    parser.add_argument("--retries", type=int, default=0, help="Retries per write (default: 0)")
+    parser.add_argument("--log-level", default="WARN", choices=["DEBUG", "INFO", "WARN", "ERROR"], help="Client log level (default WARN)")
+    parser.add_argument("--json", dest="json_out", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.clients < 1:
+        parser.error("--clients must be at least 1")
+    concurrency = args.concurrency or args.clients
+    if args.rate <= 0 and concurrency > args.clients:
+        parser.error("--concurrency cannot exceed --clients: a client sends one op at a time")
+
+    server_addresses = dict(entry.split("=", 1) for entry in args.servers.split(","))
+    generator = LoadGenerator(server_addresses, args.clients, mix, keys=args.keys, rm_address=args.rm, retries=args.retries, log_level=args.log_level)
+    generator.connect()
+    try:
+        if args.rate > 0:
+            seconds = generator.run_open(args.rate, args.duration, args.warmup)
+        else:
+            seconds = generator.run_closed(concurrency, args.duration, args.warmup, args.think_time)
+    finally:
+        generator.close()
+
+    result = {"mode": "open" if args.rate > 0 else "closed", "clients": args.clients, "mix": dict(mix),
+              "rate": args.rate if args.rate > 0 else None, "concurrency": None if args.rate > 0 else concurrency,
+              **generator.report(seconds)}
+    print(f"{result['mode']} loop: {result['ops']} ops, {result['errors']} errors in {seconds:.2f}s ({result['ops_per_sec']:.0f} ops/sec)")
+    print(f"{'op':<10} {'count':>8} " + " ".join(f"{'p' + format(p, 'g') + ' ms':>11}" for p in PERCENTILES) + f" {'max ms':>9}")
+    for op, summary in result["latency"].items():
+        print(f"{op:<10} {summary['count']:>8} " + " ".join(f"{summary['p' + format(p, 'g')] * 1000:>11.3f}" for p in PERCENTILES) + f" {summary['max'] * 1000:>9.3f}")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main()
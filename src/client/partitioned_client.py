@@ -0,0 +1,183 @@
+import argparse
+import bisect
+import hashlib
+import json
+import random
+import time
+from client import Client
+
+# Spread counters over several independent replica groups.
+#
+# Every group is a full S1/S2/S3-style deployment with its own primary. A key
+# is routed to the group that owns it on a consistent hash ring: each group
+# is placed on the ring at `vnodes` pseudo-random points and a key belongs
+# to the first group point at or after the key's hash. Adding a group only
+# moves the keys that land on the new group's points (about 1/(n+1) of them);
+# every other key stays where it was. Counters of moved keys are not copied
+# by the client, they start from what the new group has.
+
+def _hash(text: str) -> int:
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big")
+
+
+class ConsistentHashRing:
+    def __init__(self, vnodes: int = 128):
+        self._vnodes = int(vnodes)
+        self._points = []   # sorted hashes
+        self._owners = []   # group of the point at the same index
+        self._groups = set()
+
+    def __contains__(self, group_id):
+        return group_id in self._groups
+
+    def __len__(self):
+        return len(self._groups)
+
+    def add(self, group_id: str):
+        if group_id in self._groups:
+            return
+        self._groups.add(group_id)
+        for i in range(self._vnodes):
+            point = _hash(f"{group_id}#{i}")
+            index = bisect.bisect_left(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, group_id)
+
+    def remove(self, group_id: str):
+        if group_id not in self._groups:
+            return
+        self._groups.discard(group_id)
+        kept = [(p, g) for p, g in zip(self._points, self._owners) if g != group_id]
+        self._points = [p for p, _ in kept]
+        self._owners = [g for _, g in kept]
+
+    def lookup(self, key: str) -> str:
+        if not self._points:
+            raise LookupError("no replica groups on the ring")
+        index = bisect.bisect_left(self._points, _hash(key))
+        return self._owners[index % len(self._points)]
+
+    def ownership(self) -> dict:
+        """Share of the hash space owned by each group (sums to 1.0)."""
+        shares = {group_id: 0 for group_id in self._groups}
+        space = 1 << 64
+        for i, point in enumerate(self._points):
+            previous = self._points[i - 1] if i > 0 else self._points[-1] - space
+            shares[self._owners[i]] += (point - previous) / space
+        return shares
+
+
+class PartitionedClient:
+    """Route each counter operation to the replica group that owns its key.
+
+    `groups` maps a group id to that group's server_addresses, e.g.
+    {"G1": {"S1": "host:port", "S2": ..., "S3": ...}, "G2": {...}}. One
+    Client per group keeps that group's connections, request numbers and
+    primary; a group connects (and finds its primary) on first use.
+    """
+
+    def __init__(self, client_id, groups, vnodes=128):
+        self.client_id = client_id
+        self.ring = ConsistentHashRing(vnodes)
+        self.clients = {}
+        for group_id, server_addresses in groups.items():
+            self.add_group(group_id, server_addresses)
+
+    def log(self, text, level="INFO"):
+        if self.clients:
+            next(iter(self.clients.values())).log(text, level)
+
+    def add_group(self, group_id, server_addresses):
+        if group_id in self.ring:
+            return
+        self.clients[group_id] = Client(self.client_id, server_addresses)
+        self.ring.add(group_id)
+        shares = ", ".join(f"{g}: {share:.1%}" for g, share in sorted(self.ring.ownership().items()))
+        self.log(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {self.client_id}: Added replica group {group_id}; key space now {shares}")
+
+    def remove_group(self, group_id):
+        if group_id not in self.ring:
+            return
+        self.ring.remove(group_id)
+        client = self.clients.pop(group_id, None)
+        if client is not None:
+            client.close()
+        self.log(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {self.client_id}: Removed replica group {group_id}")
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+
+    def group_for(self, key) -> str:
+        return self.ring.lookup(key)
+
+    def _client_for(self, group_id) -> Client:
+        client = self.clients[group_id]
+        if not client.connections:
+            client.connect_to_servers()
+        return client
+
+    def primaries(self) -> dict:
+        # The primary each group's client currently talks to (None if unknown)
+        return {group_id: client.primary for group_id, client in self.clients.items()}
+
+    def increase(self, key, retries=0):
+        return self._client_for(self.group_for(key)).increase(key, retries=retries)
+
+    def decrease(self, key, retries=0):
+        return self._client_for(self.group_for(key)).decrease(key, retries=retries)
+
+    def get(self, key, max_staleness=None):
+        return self._client_for(self.group_for(key)).get(key, max_staleness=max_staleness)
+
+    def send_batch(self, actions):
+        """Send (action, key) pairs, one /batch per group involved.
+
+        Returns the per-op results in the order of `actions`; ops of a group
+        whose batch failed get {"ok": False}.
+        """
+        by_group = {}
+        for index, (action, key) in enumerate(actions):
+            by_group.setdefault(self.group_for(key), []).append(index)
+        results = [None] * len(actions)
+        for group_id, indexes in by_group.items():
+            replies = self._client_for(group_id).send_batch([actions[i] for i in indexes])
+            for position, index in enumerate(indexes):
+                results[index] = replies[position] if replies else {"ok": False, "group": group_id}
+        return results
+
+    def list_counters(self) -> dict:
+        # Every counter of every group; a group that cannot be read is skipped
+        counters = {}
+        for group_id in self.clients:
+            values = self._client_for(group_id).list_counters()
+            if values:
+                counters.update(values)
+        return counters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Client spreading keyed counters over several replica groups")
+    parser.add_argument("--client-id", default="C1", help="Client ID (default: C1)")
+    parser.add_argument("--groups", required=True, help='JSON file: {"G1": {"S1": "host:port", ...}, "G2": {...}}')
+    parser.add_argument("--keys", type=int, default=100, help="Distinct keys to send random ops to (default: 100)")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between requests (default: 1.0)")
+    parser.add_argument("--vnodes", type=int, default=128, help="Ring points per group (default: 128)")
+    args = parser.parse_args()
+
+    with open(args.groups, "r", encoding="utf-8") as f:
+        groups = json.load(f)
+    client = PartitionedClient(args.client_id, groups, vnodes=args.vnodes)
+    try:
+        while True:
+            key = f"key{random.randrange(args.keys)}"
+            action = random.choice(("get", "increase", "decrease"))
+            if action == "get":
+                client.get(key)
+            else:
+                getattr(client, action)(key)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("\nClient Exit")
+    finally:
+        client.close()
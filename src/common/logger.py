@@ -0,0 +1,146 @@
+import atexit
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+# Shared logging for server, client, LFD, GFD and RM.
+#
+# log() only puts the line on a bounded queue; a writer thread per log file
+# drains it in batches, echoes to the console with colors, appends to the
+# file with the ANSI codes stripped and rotates the file by size. When the
+# queue is full lines are dropped (and counted) rather than blocking the
+# caller.
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+DEFAULT_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*m")
+
+class AsyncLogger:
+    def __init__(self, path, level=DEFAULT_LEVEL, console=True, max_bytes=10 * 1024 * 1024, backup_count=3,
+                 queue_size=10000, batch_size=256, flush_interval=0.2):
+        self.path = path
+        self.console = console
+        self._level = LEVELS.get(str(level).upper(), LEVELS["INFO"])
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._dropped = 0
+        self._file = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def set_level(self, level):
+        self._level = LEVELS.get(str(level).upper(), self._level)
+
+    def enabled(self, level="INFO"):
+        return LEVELS.get(level, 20) >= self._level
+
+    def log(self, text, level="INFO"):
+        if LEVELS.get(level, 20) < self._level:
+            return text
+        try:
+            self._queue.put_nowait(text)
+        except queue.Full:
+            self._dropped += 1
+        return text
+
+    def debug(self, text):
+        return self.log(text, "DEBUG")
+
+    def info(self, text):
+        return self.log(text, "INFO")
+
+    def warn(self, text):
+        return self.log(text, "WARN")
+
+    def error(self, text):
+        return self.log(text, "ERROR")
+
+    def flush(self, timeout=2.0):
+        # Wait until everything queued so far has been written
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def close(self):
+        self.flush()
+        self._closed = True
+        self._thread.join(timeout=1.0)
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._closed:
+            try:
+                batch = [self._queue.get(timeout=self._flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            queued = len(batch)
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                batch.append(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] logger: dropped {dropped} line(s), queue full")
+            try:
+                self._write(batch)
+            except Exception as e:
+                sys.stderr.write(f"logger: cannot write {self.path}: {e}\n")
+            finally:
+                for _ in range(queued):
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        if self.console:
+            sys.stdout.write("\n".join(batch) + "\n")
+            sys.stdout.flush()
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(ANSI_ESCAPE.sub("", "\n".join(batch)) + "\n")
+        self._file.flush()
+        if self._max_bytes and self._file.tell() >= self._max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        # path -> path.1 -> ... -> path.<backup_count>; the oldest is dropped
+        self._file.close()
+        self._file = None
+        for i in range(self._backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self._backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+def get_logger(path, **options):
+    """Return the logger for `path`, creating it on first use."""
+    key = os.path.abspath(path)
+    with _loggers_lock:
+        logger = _loggers.get(key)
+        if logger is None:
+            logger = AsyncLogger(path, **options)
+            _loggers[key] = logger
+        elif "level" in options:
+            logger.set_level(options["level"])
+        return logger
+
+@atexit.register
+def _flush_all():
+    for logger in list(_loggers.values()):
+        logger.flush()
@@ -0,0 +1,158 @@
+import threading
+import time
+
+# In-process performance counters, exposed as JSON on /metrics.
+#
+# Counters and histograms are created once (per name and label set) and then
+# updated from the hot path: an update is one uncontended lock acquire and a
+# list index. Histograms use HDR-style log-linear buckets over microseconds,
+# 16 sub-buckets per power of two, so any recorded latency is reproduced
+# within ~6%.
+
+SUB_BUCKETS = 16
+MAX_BUCKETS = SUB_BUCKETS * 40
+
+def _bucket_index(micros: int) -> int:
+    if micros < SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - 5
+    return min(MAX_BUCKETS - 1, SUB_BUCKETS * shift + (micros >> shift))
+
+def _bucket_value(index: int) -> float:
+    # Midpoint of the bucket, in microseconds
+    if index < SUB_BUCKETS:
+        return float(index)
+    shift, sub = divmod(index, SUB_BUCKETS)
+    low = (sub + SUB_BUCKETS) << (shift - 1)
+    return low + ((1 << (shift - 1)) - 1) / 2.0
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = [0] * MAX_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds: float):
+        index = _bucket_index(int(seconds * 1_000_000))
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def time(self):
+        # with histogram.time(): ...
+        return _Timer(self)
+
+    def percentile(self, p: float) -> float:
+        """Value (seconds) at or below which p percent of observations fall."""
+        with self._lock:
+            return self._percentile_locked(p)
+
+    def _percentile_locked(self, p: float) -> float:
+        if self.count == 0:
+            return 0.0
+        target = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for index, n in enumerate(self._counts):
+            seen += n
+            if seen >= target:
+                return min(self.max, max(self.min, _bucket_value(index) / 1_000_000))
+        return self.max
+
+    def merge(self, other: "Histogram"):
+        with other._lock:
+            counts, count, total, low, high = list(other._counts), other.count, other.total, other.min, other.max
+        with self._lock:
+            for index, n in enumerate(counts):
+                self._counts[index] += n
+            self.count += count
+            self.total += total
+            if low is not None and (self.min is None or low < self.min):
+                self.min = low
+            if high is not None and (self.max is None or high > self.max):
+                self.max = high
+
+    def snapshot(self, percentiles=(50, 95, 99)):
+        # One lock hold, so the percentiles agree with count, min and max
+        with self._lock:
+            result = {"count": self.count, "sum": self.total, "min": self.min or 0.0, "max": self.max or 0.0}
+            for p in percentiles:
+                result[f"p{p:g}"] = self._percentile_locked(p)
+        return result
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+    def counter(self, name, **labels) -> Counter:
+        key = self._key(name, labels)
+        metric = self._counters.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._counters.setdefault(key, Counter())
+        return metric
+
+    def histogram(self, name, **labels) -> Histogram:
+        key = self._key(name, labels)
+        metric = self._histograms.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._histograms.setdefault(key, Histogram())
+        return metric
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        return {
+            "uptime": time.time() - self.started,
+            "counters": {key: metric.snapshot() for key, metric in sorted(counters.items())},
+            "histograms": {key: metric.snapshot() for key, metric in sorted(histograms.items())},
+        }
+
+
+# One registry per process
+metrics = MetricsRegistry()
@@ -4,8 +4,13 @@ from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
 import time
 import os
+import sys
 import requests
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+from common.metrics import metrics
+
 # -------------------- Config & State --------------------
 
 ####### start #######
@@ -35,11 +40,9 @@ log_file = os.path.join(
 
 # -------------------- Utils --------------------
 
-def log(text: str):
+def log(text: str, level: str = "INFO"):
     """Print and append to log file."""
-    print(text)
-    with open(log_file, "a") as f:
-        f.write(text + "\n")
+    get_logger(log_file).log(text, level)
 
 def _timestamp() -> str:
     return time.strftime("%Y-%m-%d %H:%M:%S")
@@ -63,8 +66,10 @@ def report_membership_rm(timeout=5):
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
     try:
-        requests.post(rm_membership_url, json=payload, timeout=timeout)
+        with metrics.histogram("rm_report_seconds").time():
+            requests.post(rm_membership_url, json=payload, timeout=timeout)
     except requests.exceptions.RequestException as e:
+        metrics.counter("rm_report_failed_total").inc()
         log(f"\033[33m[{time.strftime('%Y-%m-%d %H:%M:%S')}] WARN: Failed to report status to RM: {e}\033[0m")
 ####### end #######
 
@@ -93,6 +98,7 @@ def recompute_membership_for(server_id: str):
     if any_alive and not in_membership:
         membership.append(server_id)
         member_count += 1
+        metrics.counter("membership_changes_total", change="add").inc()
         log(f"\033[35m[{_timestamp()}] GFD: Adding server {server_id}...\033[0m")
         log(f"\033[32m[{_timestamp()}] GFD: {member_count} members: {' '.join(membership)}\033[0m")
         ####### start #######
@@ -102,6 +108,7 @@ def recompute_membership_for(server_id: str):
     elif (not any_alive) and in_membership:
         membership.remove(server_id)
         member_count -= 1
+        metrics.counter("membership_changes_total", change="remove").inc()
         log(f"\033[35m[{_timestamp()}] GFD: Deleting server {server_id}...\033[0m")
         log(f"\033[32m[{_timestamp()}] GFD: {member_count} members: {' '.join(membership)}\033[0m")
         ####### start #######
@@ -132,6 +139,17 @@ class GFDHandler(BaseHTTPRequestHandler):
         self.send_header("Content-Type", "application/json")
         self.end_headers()
 
+    def do_GET(self):
+        if self.path == "/metrics":
+            report = metrics.snapshot()
+            report["membership"] = list(membership)
+            report["lfds"] = {lfd_id: dict(info) for lfd_id, info in list(lfd_status_table.items())}
+            self._set_headers(200)
+            self.wfile.write(json.dumps(report).encode())
+        else:
+            self._set_headers(404)
+            self.wfile.write(json.dumps({"error": "unknown path"}).encode())
+
     def do_POST(self):
         length = int(self.headers.get("Content-Length", 0))
         body = self.rfile.read(length)
@@ -184,6 +202,11 @@ class GFDHandler(BaseHTTPRequestHandler):
                 "last_update": time.time()
             }
 
+            metrics.counter("status_reports_total", status=status).inc()
+            rtt = data.get("heartbeat_rtt")
+            if isinstance(rtt, (int, float)):
+                metrics.histogram("heartbeat_rtt_seconds", server=server_id).observe(rtt)
+
             if prev_status != status:
                 log(f"\033[31m[{timestamp}] Status change: LFD={lfd_id} -> {status}...\033[0m")
 
@@ -216,7 +239,9 @@ def main():
     #######  end  #######
 
     parser.add_argument("--timeout", type=float, default=10.0, help="LFD heartbeat timeout seconds (default 10.0)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARN", "ERROR"], help="Log level (default INFO)")
     args = parser.parse_args()
+    get_logger(log_file, level=args.log_level)
 
     global TIMEOUT
     TIMEOUT = args.timeout
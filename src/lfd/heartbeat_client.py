@@ -2,12 +2,14 @@ import argparse
 import time
 import requests
 import os
+import sys
 
-def log(log_file, text):
-    print(text)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+
+def log(log_file, text, level="INFO"):
     """Print and write log to log file."""
-    with open(log_file, "a") as f:
-        f.write(text + "\n")
+    get_logger(log_file).log(text, level)
 
 def register_with_gfd(gfd_host, gfd_port, lfd_id, server_id, log_file, timeout=5):
     """向GFD注册LFD信息"""
@@ -28,7 +30,7 @@ def register_with_gfd(gfd_host, gfd_port, lfd_id, server_id, log_file, timeout=5
         log(log_file, f"\033[31m[{time.strftime('%Y-%m-%d %H:%M:%S')}] ERROR: Failed to register with GFD: {e}\033[0m")
     return False
 
-def report_status_to_gfd(gfd_host, gfd_port, lfd_id, server_id, status, log_file, timeout=5):
+def report_status_to_gfd(gfd_host, gfd_port, lfd_id, server_id, status, log_file, timeout=5, heartbeat_rtt=None):
     """向GFD汇报状态"""
     gfd_url = f"http://{gfd_host}:{gfd_port}/status"
     payload = {
@@ -37,6 +39,8 @@ def report_status_to_gfd(gfd_host, gfd_port, lfd_id, server_id, status, log_file
         "status": status,
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
     }
+    if heartbeat_rtt is not None:
+        payload["heartbeat_rtt"] = heartbeat_rtt
     try:
         requests.post(gfd_url, json=payload, timeout=timeout)
     except requests.exceptions.RequestException as e:
@@ -58,9 +62,12 @@ def lfd1(lfd_id, server_id, host, port, gfd_host, gfd_port, heartbeat_freq, time
 
     while True:
         start_time = time.time()
+        heartbeat_rtt = None
         log(log_file, f"\033[35m[{time.strftime('%Y-%m-%d %H:%M:%S')}] {lfd_id}: Sending heartbeat to {server_id}\033[0m")
         try:
+            sent_at = time.perf_counter()
             r = requests.get(f"{server_url}/heartbeat", params={"lfd_id": lfd_id}, timeout=timeout)
+            heartbeat_rtt = time.perf_counter() - sent_at
             if r.status_code == 200 and r.json().get("ok"):
                 last_response_time = time.time()
                 has_logged_failure = False
@@ -87,7 +94,7 @@ def lfd1(lfd_id, server_id, host, port, gfd_host, gfd_port, heartbeat_freq, time
                 status = "warn"
 
         # 向GFD汇报状态
-        report_status_to_gfd(gfd_host, gfd_port, lfd_id, server_id, status, log_file)
+        report_status_to_gfd(gfd_host, gfd_port, lfd_id, server_id, status, log_file, heartbeat_rtt=heartbeat_rtt)
 
         elapsed = time.time() - start_time
         time.sleep(max(0, heartbeat_freq - elapsed))
@@ -102,10 +109,12 @@ if __name__ == "__main__":
     parser.add_argument("--gfd_port", type=int, default=6000, help="GFD port (default: 6000)")
     parser.add_argument("--freq", type=float, default=5.0, help="Heartbeat frequency in seconds (default: 5.0)")
     parser.add_argument("--timeout", type=float, default=10.0, help="Heartbeat timeout in seconds (default: 10.0)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARN", "ERROR"], help="Log level (default: INFO)")
     args = parser.parse_args()
 
     start_time_filename  = time.strftime("%Y%m%d_%H:%M:%S")
     log_file = os.path.join(os.path.dirname(__file__), "..",'..', "logs", f"fld_{args.lfd_id}_log_{start_time_filename.replace(':','_')}.txt")
+    get_logger(log_file, level=args.log_level)
 
     log(log_file, f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Starting {args.lfd_id} to http://{args.host}:{args.port} with heartbeat_freq={args.freq} and reporting to GFD http://{args.gfd_host}:{args.gfd_port}")
     try:
@@ -2,10 +2,17 @@ import argparse
 import json
 import os
 import socket
+import sys
+import threading
 import time
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 import requests
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+from common.metrics import metrics
+
 
 # -------------------- Config & State --------------------
 
@@ -17,6 +24,31 @@ member_count = 0  # int
 replicas_dic = None
 primary = None
 configuration = 1
+# Chain configuration: replica order from head to tail
+chain = []
+
+# Primary read lease: holder, epoch (bumped on every new holder) and when
+# it expires on the RM's monotonic clock
+lease = {"holder": None, "epoch": 0, "expires": 0.0}
+lease_duration = 2.0
+lease_drift = 0.01
+
+# Requests are served on threads (GET /primary long-polls), so every change
+# to the state above happens under state_lock. view_version counts the
+# changes of primary, membership and chain clients are told about.
+state_lock = threading.RLock()
+view_changed = threading.Condition(state_lock)
+view_version = 0
+_published_view = None
+# What GET /primary answers: the view as of the last publish_view(), so
+# clients only hear of a new primary once it has been told
+published_view = None
+# Membership updates are handled one at a time, their role changes
+# included, so the replicas get the changes in the order they were decided.
+# The role changes are sent with only this lock held, not state_lock.
+membership_lock = threading.Lock()
+# Longest a GET /primary long-poll is held open
+VIEW_POLL_MAX = 30.0
 
 # Log file path
 start_time_filename = time.strftime("%Y%m%d_%H:%M:%S")
@@ -27,11 +59,8 @@ log_file = os.path.join(
 
 # -------------------- Utils --------------------
 
-def log(text: str):
-    print(text)
-    os.makedirs(os.path.dirname(log_file), exist_ok=True)
-    with open(log_file, "a") as f:
-        f.write(text + "\n")
+def log(text: str, level: str = "INFO"):
+    get_logger(log_file).log(text, level)
 
 def _timestamp() -> str:
     return time.strftime("%Y-%m-%d %H:%M:%S")
@@ -55,34 +84,28 @@ def print_membership_info(communicate_with_gfd):
            log(f"\033[32m[{_timestamp()}] RM: {member_count} members\033[0m")
     
 def who_is_primary():
+    """Pick a new primary if the current one left (state_lock held).
 
-    global primary
+    Returns the role changes to send, see send_role_changes.
+    """
 
+    global primary
 
+    changes = []
     if primary not in membership or primary == None:
         if len(membership) > 0:
             primary = membership[0]
             for replica_name, addr in replicas_dic.items():
                 if replica_name == primary:
-                    primary_host, primary_port = replicas_dic[replica_name]
-                    primary_url = f"http://{primary_host}:{primary_port}/select_primary"
-                    try:
-                        requests.post(primary_url, timeout=5)
-                        #print(f"set {primary_url} to primary")
-                    except requests.exceptions.RequestException as e:
-                        log(f"\033[33m[{time.strftime('%Y-%m-%d %H:%M:%S')}] WARN: Failed to set the primary: {primary_url}\033[0m")
+                    changes.append(("primary", replica_name, None))
                 elif replica_name in membership:
-                    back_host, back_port = replicas_dic[replica_name]
-                    back_url = f"http://{back_host}:{back_port}/select_backup"
-                    try:
-                        requests.post(back_url, timeout=5)
-                        #print(f"set {back_url} to backup")
-                    except requests.exceptions.RequestException as e:
-                        log(f"\033[33m[{time.strftime('%Y-%m-%d %H:%M:%S')}] WARN: Failed to set the back_up: {back_url}\033[0m")
+                    changes.append(("backup", replica_name, None))
 
+            metrics.counter("primary_changes_total").inc()
             log(f"\033[32m[{_timestamp()}] New Primary: {primary} \033[0m")
         else:
             primary = None
+    return changes
     """
     else:
 
@@ -100,6 +123,138 @@ def who_is_primary():
 
         
     
+def who_is_chain():
+    """Reconfigure the chain after a membership change (state_lock held).
+
+    Survivors keep their order and new members join at the tail, so the head
+    is always a replica that already holds every acknowledged write. Returns
+    the role changes to send: each member is told its successor, tail
+    first, so nobody ships to a replica that does not know its place yet.
+    """
+    global chain, primary
+
+    new_chain = [replica for replica in chain if replica in membership]
+    new_chain += sorted(replica for replica in membership if replica not in new_chain and replica in replicas_dic)
+    if new_chain == chain:
+        return []
+
+    changes = []
+    for position in reversed(range(len(new_chain))):
+        successor = None
+        if position + 1 < len(new_chain):
+            successor_name = new_chain[position + 1]
+            successor = [successor_name, *replicas_dic[successor_name]]
+        changes.append(("primary" if position == 0 else "backup", new_chain[position], {"successor": successor}))
+
+    if (new_chain[0] if new_chain else None) != primary:
+        primary = new_chain[0] if new_chain else None
+        metrics.counter("primary_changes_total").inc()
+    chain = new_chain
+    log(f"\033[32m[{_timestamp()}] New Chain: {' -> '.join(chain) if chain else '(empty)'} \033[0m")
+    return changes
+
+
+def send_role_changes(changes):
+    """POST /select_primary or /select_backup for each (role, replica, body),
+    in order.
+
+    Called without state_lock, so a replica that is slow to answer holds up
+    only this membership update, not /lease, /metrics or the view polls.
+    """
+    for role, replica_name, body in changes:
+        host, port = replicas_dic[replica_name]
+        url = f"http://{host}:{port}/select_{role}"
+        try:
+            with metrics.histogram("role_change_seconds", role=role).time():
+                response = requests.post(url, json=body, timeout=5)
+        except requests.exceptions.RequestException as e:
+            log(f"\033[33m[{_timestamp()}] WARN: Failed to set {replica_name} to {role}: {url}\033[0m")
+            continue
+        if role == "backup" and response.status_code == 200:
+            release_lease(replica_name)
+
+
+def release_lease(replica_id):
+    """End `replica_id`'s read lease early: it acknowledged becoming a
+    backup, which drops its lease, so the new primary need not wait out
+    the rest of it. A holder that crashed or cannot be reached is not
+    released; its lease has to expire."""
+    with state_lock:
+        if lease["holder"] != replica_id or time.monotonic() >= lease["expires"]:
+            return
+        lease["expires"] = 0.0
+        epoch = lease["epoch"]
+    metrics.counter("lease_releases_total").inc()
+    log(f"\033[32m[{_timestamp()}] RM: read lease epoch {epoch} released by demoted {replica_id} \033[0m")
+
+
+def stale_lease_holder():
+    """The lease holder if it left the membership while its lease runs
+    (state_lock held), else None.
+
+    It may still be alive, only cut off from the GFD, and serving lease
+    reads; it is not told its new role by the membership update, so it is
+    demoted separately.
+    """
+    holder = lease["holder"]
+    if configuration == 1 or holder is None or holder == primary or holder in membership:
+        return None
+    if time.monotonic() >= lease["expires"]:
+        return None
+    return holder
+
+
+def demote_stale_holder(holder):
+    # Skipped if the holder rejoined or its lease ran out meanwhile
+    with state_lock:
+        if stale_lease_holder() != holder:
+            return
+    send_role_changes([("backup", holder, None)])
+
+
+def grant_lease(replica_id):
+    """Grant or renew the read lease for `replica_id`; returns the reply.
+
+    The holder counts the lease from before it asked, shortened by the
+    drift bound; here it counts from now, lengthened by it. A different
+    replica only gets the lease once that longer period is over, so two
+    replicas never both believe they hold it.
+    """
+    now = time.monotonic()
+    if configuration != 1 and replica_id != primary:
+        return {"granted": False, "holder": lease["holder"], "primary": primary, "retry_after": lease_duration}
+    if lease["holder"] not in (None, replica_id) and now < lease["expires"]:
+        return {"granted": False, "holder": lease["holder"], "retry_after": lease["expires"] - now}
+    if lease["holder"] != replica_id:
+        lease["epoch"] += 1
+        metrics.counter("lease_handoffs_total").inc()
+        log(f"\033[32m[{_timestamp()}] RM: read lease epoch {lease['epoch']} granted to {replica_id} \033[0m")
+    lease["holder"] = replica_id
+    lease["expires"] = now + lease_duration * (1 + lease_drift)
+    return {"granted": True, "holder": replica_id, "epoch": lease["epoch"], "duration": lease_duration, "drift": lease_drift}
+
+
+def current_view():
+    """What clients need to find the primary (state_lock held)."""
+    view = {"version": view_version, "configuration": configuration, "primary": primary, "membership": list(membership)}
+    if configuration == 2:
+        view["chain"] = list(chain)
+        view["tail"] = chain[-1] if chain else None
+    return view
+
+def publish_view():
+    # Bump the version and wake the long-polls if anything clients see changed (state_lock held)
+    global view_version, _published_view, published_view
+    published = (primary, tuple(membership), tuple(chain))
+    if published == _published_view:
+        return
+    _published_view = published
+    view_version += 1
+    published_view = current_view()
+    metrics.counter("view_changes_total").inc()
+    view_changed.notify_all()
+
+
 class RMHandler(BaseHTTPRequestHandler):
 
 
@@ -111,19 +266,71 @@ class RMHandler(BaseHTTPRequestHandler):
     def log_message(self, fmt, *args):
         return
 
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/primary":
+            # ?version=N long-polls: the reply waits (up to ?wait= seconds)
+            # until the view is newer than N
+            query = parse_qs(parsed.query)
+            try:
+                known = int(query["version"][0]) if "version" in query else None
+                wait = min(float(query.get("wait", [VIEW_POLL_MAX])[0]), VIEW_POLL_MAX)
+            except ValueError:
+                self._set_headers(400)
+                self.wfile.write(json.dumps({"error": "version and wait must be numbers"}).encode())
+                return
+            with view_changed:
+                if known is not None:
+                    view_changed.wait_for(lambda: view_version != known, timeout=max(0.0, wait))
+                view = published_view if published_view is not None else current_view()
+            metrics.counter("view_requests_total", poll=known is not None).inc()
+            self._set_headers(200)
+            self.wfile.write(json.dumps(view).encode())
+        elif parsed.path == "/metrics":
+            with state_lock:
+                report = metrics.snapshot()
+                report["membership"] = list(membership)
+                report["primary"] = primary
+                report["view_version"] = view_version
+                if configuration == 2:
+                    report["chain"] = list(chain)
+                report["lease"] = {"holder": lease["holder"], "epoch": lease["epoch"], "expires_in": max(0.0, lease["expires"] - time.monotonic())}
+            self._set_headers(200)
+            self.wfile.write(json.dumps(report).encode())
+        else:
+            self._set_headers(404)
+            self.wfile.write(json.dumps({"error": "unknown path"}).encode())
+
     def do_POST(self):
 
         length = int(self.headers.get("Content-Length", 0))
 
+        body_data = {}
         if length > 0:
             body = self.rfile.read(length)
             try:
                 body_data = json.loads(body)
-            except Exception:
-                print("Cannot get the body")
+            except ValueError:
+                body_data = None
+            if not isinstance(body_data, dict):
+                self._set_headers(400)
+                self.wfile.write(json.dumps({"error": "body must be a JSON object"}).encode())
+                return
 
         path = self.path
 
+        if path == "/lease":
+            if not body_data.get("replica_id"):
+                self._set_headers(400)
+                self.wfile.write(json.dumps({"error": "replica_id is required"}).encode())
+                return
+            with state_lock:
+                reply = grant_lease(body_data.get("replica_id"))
+            metrics.counter("lease_requests_total", granted=reply["granted"]).inc()
+            self._set_headers(200)
+            self.wfile.write(json.dumps(reply).encode())
+            return
+
         if path == "/membership":
 
             received_membership = body_data.get("membership", [])
@@ -134,12 +341,28 @@ class RMHandler(BaseHTTPRequestHandler):
                 return
             
             global membership
-            membership = received_membership
-
-            if configuration == 0:
-                who_is_primary()
-
-            print_membership_info(True)
+            with membership_lock:
+                with state_lock:
+                    if set(received_membership) != set(membership):
+                        metrics.counter("membership_changes_total").inc()
+                    membership = received_membership
+
+                    changes = []
+                    if configuration == 0:
+                        changes = who_is_primary()
+                    elif configuration == 2:
+                        changes = who_is_chain()
+
+                    stale_holder = stale_lease_holder()
+
+                    print_membership_info(True)
+                send_role_changes(changes)
+                with state_lock:
+                    publish_view()
+            if stale_holder is not None:
+                # On its own thread: a crashed holder would hold up this update for the whole timeout
+                threading.Thread(target=demote_stale_holder, args=(stale_holder,),
+                                 name="demote-lease-holder", daemon=True).start()
 
             self._set_headers(200)
             self.wfile.write(json.dumps({"ack_msg": "membership updated"}).encode())
@@ -155,19 +378,23 @@ class RMHandler(BaseHTTPRequestHandler):
         
 def main():
 
-    global configuration, replicas_dic
+    global configuration, replicas_dic, lease_duration, lease_drift
 
     parser = argparse.ArgumentParser(description="Replication Manager server (RM)")
     parser.add_argument("--host", default="0.0.0.0", help="RM host IP (default 0.0.0.0)")
     parser.add_argument("--port", type=int, default=8090, help="RM port number (default 8090)")
-    parser.add_argument("--configuration", type=int, default=1, help="0: Passive 1: Active")
+    parser.add_argument("--configuration", type=int, default=1, help="0: Passive 1: Active 2: Chain")
     parser.add_argument("--s1_host", default="0.0.0.0", help="RM host IP (default 0.0.0.0)")
     parser.add_argument("--s1_port", type=int, default=8080, help="RM port number (default 8090)")
     parser.add_argument("--s2_host", default="0.0.0.0", help="RM host IP (default 0.0.0.0)")
     parser.add_argument("--s2_port", type=int, default=8081, help="RM port number (default 8090)")
     parser.add_argument("--s3_host", default="0.0.0.0", help="RM host IP (default 0.0.0.0)")
     parser.add_argument("--s3_port", type=int, default=8082, help="RM port number (default 8090)")
+    parser.add_argument("--lease-duration", type=float, default=2.0, help="Seconds a primary read lease lasts (default 2.0)")
+    parser.add_argument("--lease-drift", type=float, default=0.01, help="Bound on the relative clock drift between RM and servers (default 0.01)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARN", "ERROR"], help="Log level (default INFO)")
     args = parser.parse_args()
+    get_logger(log_file, level=args.log_level)
 
     s1_host = args.s1_host
     s1_port = args.s1_port
@@ -176,11 +403,13 @@ def main():
     s3_host = args.s3_host
     s3_port = args.s3_port
     configuration = args.configuration
+    lease_duration = args.lease_duration
+    lease_drift = args.lease_drift
 
     replicas_dic = {'S1': (s1_host, s1_port), 'S2': (s2_host, s2_port), 'S3':(s3_host, s3_port)}
 
 
-    server = HTTPServer((args.host, args.port), RMHandler)
+    server = ThreadingHTTPServer((args.host, args.port), RMHandler)
 
     log(f"[{_timestamp()}] RM listening on {args.host}:{args.port}")
     print_membership_info(False)
@@ -0,0 +1,175 @@
+import json
+import threading
+import time
+from http.client import HTTPConnection
+from request_handler import CounterRequestHandler
+from common.metrics import metrics
+
+def _log(text, level="INFO"):
+    CounterRequestHandler.get_logger().log(text, level)
+
+def _timestamp():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class ChainReplicator:
+    """Chain replication: head -> ... -> tail.
+
+    Clients write to the head (the primary) and read from the tail. Every
+    replica but the tail runs one shipper thread that sends the ops it
+    applied since its successor's last acknowledged version (POST /chain),
+    the whole state when the op log no longer covers that version. A
+    replica replies to its predecessor once the ops are applied locally and
+    its own successor acknowledged them, so the "tail_version" in a reply is
+    what the tail holds. The head answers a write only when the tail holds
+    it, which is what makes tail reads strongly consistent.
+
+    While one batch is travelling down the chain the next one accumulates,
+    so concurrent writes are pipelined in batches instead of taking one
+    round trip each.
+    """
+
+    def __init__(self, state_manager, replica_id, successor=None, batch_size=1024, timeout=2.0, idle_interval=1.0):
+        self.state_manager = state_manager
+        self._replica_id = replica_id
+        self._batch_size = int(batch_size)
+        self._timeout = float(timeout)
+        # An idle shipper still sends an empty delta this often, so a
+        # successor that restarted is noticed (and resynced) without a write
+        self._idle_interval = float(idle_interval)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._acked = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._thread = None
+        self._successor = tuple(successor) if successor else None
+        # Bumped on every reconfiguration so the shipper starts over
+        self._generation = 0
+        self._tail_version = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="chain-shipper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._changed.notify_all()
+            self._acked.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def configure(self, successor):
+        """Set the next replica in the chain, (replica_id, host, port) or None for the tail."""
+        successor = tuple(successor) if successor else None
+        with self._lock:
+            if successor == self._successor:
+                return
+            self._successor = successor
+            self._generation += 1
+            self._changed.notify_all()
+            self._acked.notify_all()
+        _log(f"\033[94m[{_timestamp()}] {self._replica_id}: chain successor is now {successor[0] if successor else 'none (tail)'}\033[0m")
+
+    def is_tail(self) -> bool:
+        with self._lock:
+            return self._successor is None
+
+    def successor_id(self):
+        with self._lock:
+            return self._successor[0] if self._successor else None
+
+    def notify(self):
+        # The local state advanced: wake the shipper
+        with self._lock:
+            self._changed.notify_all()
+
+    def tail_version(self) -> int:
+        with self._lock:
+            return self._tail_version_locked()
+
+    def _tail_version_locked(self):
+        if self._successor is None:
+            return self.state_manager.get_version()
+        return self._tail_version
+
+    def wait_replicated(self, version: int) -> int:
+        """Wait until the tail holds `version`; returns the tail's version
+        (lower than `version` when the timeout expired first)."""
+        deadline = time.monotonic() + self._timeout
+        with self._lock:
+            while not self._stop.is_set():
+                current = self._tail_version_locked()
+                remaining = deadline - time.monotonic()
+                if current >= version or remaining <= 0:
+                    return current
+                self._acked.wait(remaining)
+            return self._tail_version_locked()
+
+    # ---- shipper -------------------------------------------------------
+
+    def _run(self):
+        conn = None
+        acked = None   # successor's version, None until it has our state
+        generation = None
+        shipped = metrics.counter("chain_ops_sent_total")
+        round_trip = metrics.histogram("chain_round_trip_seconds")
+        while not self._stop.is_set():
+            with self._lock:
+                deadline = time.monotonic() + self._idle_interval
+                while not self._stop.is_set():
+                    if self._successor is not None:
+                        if generation != self._generation or acked is None or self.state_manager.get_version() > acked:
+                            break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 and self._successor is not None:
+                        break
+                    self._changed.wait(remaining if remaining > 0 else self._idle_interval)
+                if self._stop.is_set():
+                    break
+                if generation != self._generation:
+                    generation = self._generation
+                    acked = None
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                successor_id, host, port = self._successor
+
+            values, version, ops = self.state_manager.delta_since(acked)
+            if ops is not None:
+                ops = ops[:self._batch_size]
+                message_data = {"mode": "delta", "base_version": acked, "ops": ops}
+            else:
+                message_data = {"mode": "full", "state": values, "version": version, "dedup": self.state_manager.dedup.export()}
+            message_data["sender"] = self._replica_id
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = HTTPConnection(host, int(port), timeout=self._timeout * 2)
+                conn.request("POST", "/chain", body=json.dumps(message_data), headers={"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                data = json.loads(resp.read() or b"{}")
+                if resp.status != 200:
+                    raise RuntimeError(f"status {resp.status}: {data}")
+            except Exception as e:
+                _log(f"\033[93m[{_timestamp()}] {self._replica_id}: chain update to {successor_id} failed, will resend: {e}\033[0m", "WARN")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                acked = None
+                self._stop.wait(0.5)
+                continue
+            round_trip.observe(time.perf_counter() - start)
+
+            if data.get("need_full"):
+                acked = None
+                continue
+            acked = int(data.get("version", version))
+            if ops:
+                shipped.inc(len(ops))
+            elif ops is None:
+                _log(f"\033[94m[{_timestamp()}] {self._replica_id}: sent full state (version {version}, {len(values)} key(s)) to chain successor {successor_id}\033[0m")
+            with self._lock:
+                if generation == self._generation:
+                    self._tail_version = max(self._tail_version, int(data.get("tail_version", 0)))
+                    self._acked.notify_all()
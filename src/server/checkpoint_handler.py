@@ -1,16 +1,42 @@
 import time
 import json
-from http.client import HTTPConnection
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from http.client import HTTPConnection, RemoteDisconnected
 from request_handler import CounterRequestHandler
+from common.metrics import metrics
+
+FANOUT_MODES = ("sequential", "parallel")
+
+def _log(text, level="INFO"):
+    CounterRequestHandler.get_logger().log(text, level)
 
 class CheckpointHandler:
-    def __init__(self, last_time=None, freq=1.0, state_manager=None, path="/send_checkpoint", curr_replica_id="S1"):
+    def __init__(self, last_time=None, freq=1.0, state_manager=None, path="/send_checkpoint", curr_replica_id="S1", fanout="sequential", deadline=2.0, max_skips=3):
         self._last_time = time.time() - freq if last_time is None else float(last_time)
         self._freq = float(freq)
         self.state_manager = state_manager
         self._path = path
         self.connections = {}
         self.curr_replica_id = curr_replica_id
+        self._fanout = fanout
+        # Per-backup deadline: also used as the socket timeout of each connection
+        self._deadline = float(deadline)
+        self._pool = None
+        # Backups whose previous checkpoint is still outstanding (parallel mode)
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        # Last state version each backup acknowledged. A backup that is
+        # already current is skipped, but at most max_skips rounds in a row,
+        # so a backup that restarted is still noticed by an empty delta.
+        self._acked_versions = {}
+        self._skips = {}
+        # Guards both maps: in parallel mode every backup is served by its
+        # own pool thread
+        self._acks_lock = threading.Lock()
+        self._max_skips = int(max_skips)
+        # State version when the last round started
+        self._round_version = 0
 
     def _should_send(self, now_wall):
         # Check if at least freq seconds have elapsed since last send
@@ -38,54 +64,291 @@ class CheckpointHandler:
         if not self._should_send(now_wall):
             return {}
 
-        # Update last send timestamp
-        self._last_time = now_wall
+        return self.send_checkpoint(backups)
+
+    def send_checkpoint(self, backups):
+        # Send one checkpoint to every backup now, regardless of freq.
+        # Returns {replica_id: {"ok": bool, "latency_ms": float, ...}}.
+        self._last_time = time.time()
+        self._round_version = self.state_manager.get_version()
 
-        results = {}
-        primary_id = self.curr_replica_id
         wall_ts = time.strftime("%Y-%m-%d %H:%M:%S")
+        checkpoint_count = CounterRequestHandler.get_checkpoint_count()
+
+        if self._fanout == "parallel":
+            results = self._send_parallel(backups, wall_ts, checkpoint_count)
+        else:
+            results = {}
+            for replica_id, replica_host, replica_port in backups:
+                results[replica_id] = self._send_to_backup(replica_id, replica_host, replica_port, wall_ts, checkpoint_count)
 
+        CounterRequestHandler.increase_checkpoint_count()
+
+        return results
+
+    def _send_parallel(self, backups, wall_ts, checkpoint_count):
+        # Fan out to every backup at once; the whole round is bounded by the
+        # per-backup deadline instead of the sum of the round-trips.
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=max(2, len(backups)), thread_name_prefix="checkpoint")
+
+        results = {}
+        futures = {}
+        round_deadline = time.monotonic() + self._deadline
         for replica_id, replica_host, replica_port in backups:
+            with self._in_flight_lock:
+                if replica_id in self._in_flight:
+                    results[replica_id] = {"ok": False, "latency_ms": None, "error": "previous checkpoint still in flight"}
+                    continue
+                self._in_flight.add(replica_id)
+            future = self._pool.submit(self._send_tracked, replica_id, replica_host, replica_port, wall_ts, checkpoint_count, round_deadline)
+            futures[future] = replica_id
+
+        done, not_done = wait(futures, timeout=self._deadline)
+        for future in done:
+            results[futures[future]] = future.result()
+        for future in not_done:
+            replica_id = futures[future]
+            results[replica_id] = {"ok": False, "latency_ms": self._deadline * 1000, "error": "deadline exceeded"}
+            _log(f"\033[91m[{wall_ts}] {self.curr_replica_id}: checkpoint to {replica_id} missed its {self._deadline}s deadline\033[0m", "ERROR")
+        return results
+
+    def _send_tracked(self, replica_id, replica_host, replica_port, wall_ts, checkpoint_count, round_deadline):
+        try:
+            return self._send_to_backup(replica_id, replica_host, replica_port, wall_ts, checkpoint_count, round_deadline)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(replica_id)
+
+    def _record_ack(self, replica_id, version, round_deadline):
+        # The round already reported this backup as late: its answer is
+        # ignored and the next round starts again from the previous ack
+        # (a backup that is ahead of it answers need_full)
+        with self._acks_lock:
+            if round_deadline is not None and time.monotonic() > round_deadline:
+                return False
+            self._acked_versions[replica_id] = version
+            return True
+
+    def _forget_ack(self, replica_id):
+        with self._acks_lock:
+            self._acked_versions.pop(replica_id, None)
+
+    def _send_to_backup(self, replica_id, replica_host, replica_port, wall_ts, checkpoint_count, round_deadline=None):
+        primary_id = self.curr_replica_id
+        start = time.perf_counter()
+        with self._acks_lock:
+            acked = self._acked_versions.get(replica_id)
+        values, version, ops = self.state_manager.delta_since(acked)
+
+        with self._acks_lock:
+            skip = ops == [] and self._skips.get(replica_id, 0) < self._max_skips
+            self._skips[replica_id] = self._skips.get(replica_id, 0) + 1 if skip else 0
+        if skip:
+            metrics.counter("checkpoint_skipped_total", backup=replica_id).inc()
+            return {"ok": True, "latency_ms": 0.0, "skipped": True, "version": version}
+
+        try:
+            conn = self._ensure_connection(replica_id, replica_host, replica_port, timeout=self._deadline)
+
+            # Build checkpoint payload: the ops the backup is missing when the
+            # op log still covers its last acknowledged version, else every key
+            message_data = {
+                "primary_id": primary_id,
+                "replica_id": replica_id,
+                "timestamp": wall_ts,
+                "checkpoint_count": checkpoint_count
+            }
+            if ops is not None:
+                message_data.update({"mode": "delta", "base_version": acked, "ops": ops})
+                kind = f"delta of {len(ops)} op(s) from version {acked}"
+            else:
+                message_data.update({"mode": "full", "state": values, "version": version, "dedup": self.state_manager.dedup.export()})
+                kind = f"full, {len(values)} key(s)"
+            data, status, raw = self._post_checkpoint(conn, message_data)
+            _log(f"\033[94m[{wall_ts}] Sent checkpoint: <{primary_id} -> {replica_id}>, state is: version {version} ({kind}), checkpoint counter is: {checkpoint_count}\033[0m")
+
+            if data.get("need_full"):
+                # The backup is not where we thought (e.g. it restarted); resend everything
+                values, version = self.state_manager.snapshot()
+                message_data.update({"mode": "full", "state": values, "version": version, "dedup": self.state_manager.dedup.export()})
+                for key in ("base_version", "ops"):
+                    message_data.pop(key, None)
+                data, status, raw = self._post_checkpoint(conn, message_data)
+                _log(f"\033[94m[{wall_ts}] Sent checkpoint: <{primary_id} -> {replica_id}>, state is: version {version} (full resync, {len(values)} key(s)), checkpoint counter is: {checkpoint_count}\033[0m")
+
+            ok = (200 <= status < 300) and bool(data.get("ok", True))
+            metrics.histogram("checkpoint_send_seconds", backup=replica_id).observe(time.perf_counter() - start)
+            metrics.counter("checkpoint_sent_total", backup=replica_id, mode=message_data["mode"], ok=ok).inc()
+            if ok:
+                if not self._record_ack(replica_id, data.get("version", version), round_deadline):
+                    _log(f"\033[93m[{wall_ts}] {primary_id}: ack from {replica_id} arrived after the round's deadline, ignored\033[0m", "WARN")
+            else:
+                self._forget_ack(replica_id)
+                _log(f"\033[91m[{wall_ts}] {primary_id}: {replica_id} bad response {status}, body={raw}\033[0m", "ERROR")
+            return {"ok": ok, "latency_ms": (time.perf_counter() - start) * 1000, "version": version}
+
+        except Exception as e:
+            metrics.counter("checkpoint_failed_total", backup=replica_id).inc()
+            _log(f"\033[91m[{wall_ts}] {primary_id}: Failed to send checkpoint to {replica_id}: {e}\033[0m", "ERROR")
+            self._drop_connection(replica_id)
+            self._forget_ack(replica_id)
+            return {"ok": False, "latency_ms": (time.perf_counter() - start) * 1000, "error": str(e)}
+
+    def unreplicated_ops(self, backups):
+        """Ops applied since the version the furthest-behind backup acknowledged.
+
+        Backups that have not acknowledged anything (or whose last send
+        failed) are left out; tightening the interval does not help them.
+        Without any acknowledgement, the ops since the last round count.
+        """
+        version = self.state_manager.get_version()
+        with self._acks_lock:
+            acked = [self._acked_versions[replica_id] for replica_id, _, _ in backups if replica_id in self._acked_versions]
+        base = min(acked) if acked else self._round_version
+        return max(0, version - base)
+
+    def _post_checkpoint(self, conn, message_data):
+        # The connection is kept alive between rounds. If the backup closed
+        # it while idle, resend once on a fresh one: a delta that did get
+        # applied the first time is answered with need_full, so this is safe.
+        body = json.dumps(message_data)
+        for attempt in range(2):
+            reused = conn.sock is not None
             try:
-                conn = self._ensure_connection(replica_id, replica_host, replica_port)
-
-                # Build checkpoint payload
-                message_data = {
-                    "primary_id": primary_id,
-                    "replica_id": replica_id,
-                    "timestamp": wall_ts,
-                    "state": self.state_manager.get(),
-                    "checkpoint_count": CounterRequestHandler.checkpoint_count
-                }
-                body = json.dumps(message_data)
-
-                # Send HTTP POST request
-                conn.request(
-                    "POST",
-                    self._path,
-                    body=body,
-                    headers={"Content-Type": "application/json"},
-                )
-                print(f"\033[94m[{wall_ts}] Sent checkpoint: <{primary_id} -> {replica_id}>, state is: {self.state_manager.get()}, checkpoint counter is: {CounterRequestHandler.checkpoint_count}\033[0m")
-
-                # Read and parse response
+                conn.request("POST", self._path, body=body, headers={"Content-Type": "application/json"})
                 resp = conn.getresponse()
                 raw = resp.read().decode("utf-8", errors="replace")
-                try:
-                    data = json.loads(raw)
-                except json.JSONDecodeError:
-                    data = {"ok": False, "error": "non-json response", "raw": raw}
+                break
+            except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused or attempt:
+                    raise
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            data = {"ok": False, "error": "non-json response", "raw": raw}
+        return data, resp.status, raw
 
-                ok = (200 <= resp.status < 300) and bool(data.get("ok", True))
-                results[replica_id] = ok
-                if not ok:
-                    print(f"\033[91m[{wall_ts}] {primary_id}: {replica_id} bad response {resp.status}, body={raw}\033[0m")
 
-            except Exception as e:
-                results[replica_id] = False
-                print(f"\033[91m[{wall_ts}] {primary_id}: Failed to send checkpoint to {replica_id}: {e}\033[0m")
-                self._drop_connection(replica_id)
+class AdaptiveCheckpointPolicy:
+    """Choose the next checkpoint interval from the write load.
 
-        CounterRequestHandler.checkpoint_count += 1
+    The goal is that no more than max_unreplicated ops are ever missing on a
+    backup. The write rate is smoothed over rounds, and the next round is
+    due when the ops already pending plus the expected new ones reach that
+    bound. The interval is clamped to [min_interval, max_interval], so it
+    shrinks under load and relaxes to max_interval on an idle cluster. The
+    scheduler also checks the pending ops every min_interval and checkpoints
+    early when a burst reaches the bound.
+    """
 
-        return results
+    def __init__(self, min_interval=0.1, max_interval=30.0, max_unreplicated=1000, smoothing=0.5):
+        self.min_interval = float(min_interval)
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.max_unreplicated = max(1, int(max_unreplicated))
+        self._smoothing = float(smoothing)
+        self.write_rate = 0.0
+
+    def next_interval(self, ops, seconds, unreplicated):
+        # ops were applied over the last `seconds`; `unreplicated` are still missing on a backup
+        if seconds > 0:
+            self.write_rate = self._smoothing * (ops / seconds) + (1 - self._smoothing) * self.write_rate
+        headroom = self.max_unreplicated - unreplicated
+        if headroom <= 0:
+            interval = self.min_interval
+        elif self.write_rate > 0:
+            interval = headroom / self.write_rate
+        else:
+            interval = self.max_interval
+        return min(self.max_interval, max(self.min_interval, interval))
+
+
+class CheckpointScheduler:
+    """Sends checkpoints from a dedicated thread on a fixed cadence.
+
+    Deadlines are kept on the monotonic clock and advance by exactly freq,
+    so slow sends do not make the cadence drift. A send that starts more
+    than late_tolerance after its deadline is reported as late; deadlines
+    that passed entirely while a previous send was still running are
+    reported as missed and skipped.
+    """
+
+    def __init__(self, checkpoint_handler, backups, freq=1.0, late_tolerance=0.1, policy=None):
+        self._handler = checkpoint_handler
+        self._backups = backups
+        self._freq = float(freq)
+        # AdaptiveCheckpointPolicy, or None for a fixed interval of freq
+        self._policy = policy
+        self._late_tolerance = float(late_tolerance)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="checkpoint-scheduler", daemon=True)
+        self.sent = 0
+        self.late = 0
+        self.missed = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        stats = {"sent": self.sent, "late": self.late, "missed": self.missed, "freq": self._freq}
+        if self._policy is not None:
+            stats["write_rate"] = self._policy.write_rate
+            stats["unreplicated_ops"] = self._handler.unreplicated_ops(self._backups)
+        return stats
+
+    def _wait(self, deadline):
+        # Sleep until the deadline; True if stopped. With an adaptive policy,
+        # wake up early once a burst of writes reaches the unreplicated bound.
+        while True:
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                return self._stop.is_set()
+            if self._policy is None:
+                return self._stop.wait(delay)
+            if self._stop.wait(min(delay, self._policy.min_interval)):
+                return True
+            if (CounterRequestHandler.is_primary()
+                    and self._handler.unreplicated_ops(self._backups) >= self._policy.max_unreplicated):
+                return False
+
+    def _run(self):
+        next_deadline = time.monotonic() + self._freq
+        last_version = self._handler.state_manager.get_version()
+        last_round = time.monotonic()
+        while not self._stop.is_set():
+            if self._wait(next_deadline):
+                break
+
+            lateness = time.monotonic() - next_deadline
+            wall_ts = time.strftime("%Y-%m-%d %H:%M:%S")
+            missed = int(lateness // self._freq) if lateness > 0 else 0
+            if missed > 0:
+                self.missed += missed
+                _log(f"\033[91m[{wall_ts}] Checkpoint scheduler missed {missed} deadline(s), {lateness * 1000:.0f} ms behind\033[0m", "ERROR")
+            elif lateness > self._late_tolerance:
+                self.late += 1
+                _log(f"\033[93m[{wall_ts}] Checkpoint scheduler late by {lateness * 1000:.0f} ms\033[0m", "WARN")
+            next_deadline += (missed + 1) * self._freq
+
+            if CounterRequestHandler.is_primary():
+                try:
+                    self._handler.send_checkpoint(self._backups)
+                    self.sent += 1
+                except Exception as e:
+                    _log(f"\033[91m[{wall_ts}] Checkpoint scheduler: send failed: {e}\033[0m", "ERROR")
+
+            if self._policy is not None:
+                # The next deadline counts from now, at the interval the load calls for
+                now = time.monotonic()
+                version = self._handler.state_manager.get_version()
+                interval = self._policy.next_interval(version - last_version, now - last_round, self._handler.unreplicated_ops(self._backups))
+                if abs(interval - self._freq) >= 0.5 * min(interval, self._freq):
+                    _log(f"\033[94m[{wall_ts}] Checkpoint interval {self._freq:.3f}s -> {interval:.3f}s ({self._policy.write_rate:.1f} writes/s)\033[0m")
+                self._freq = interval
+                next_deadline = now + interval
+                last_version, last_round = version, now
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Replies already sent to clients, keyed by (client_id, session, request_num).
+#
+# A client that retries after a timeout reuses its request number; the
+# server answers the retry from this table instead of applying the op a
+# second time. Request numbers restart at 1 when a client restarts, so each
+# client incarnation also sends a random session id: a restarted client that
+# reuses its client id is a new session, not a stream of duplicates.
+#
+# Entries are evicted least-recently-used once the table holds `capacity`
+# of them, and are ignored (and dropped) after `ttl` seconds.
+class DedupTable:
+    def __init__(self, capacity: int = 10000, ttl: float = 300.0):
+        self._capacity = int(capacity)
+        self._ttl = float(ttl)
+        self._lock = threading.Lock()
+        # (client_id, session, request_num) -> (inserted_at, reply)
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, client_id, session, request_num, op: Optional[str] = None) -> Optional[dict]:
+        """Return the cached reply, or None if this request was not seen.
+
+        When `op` is given, an entry recorded for a different op does not
+        count as a duplicate.
+        """
+        if client_id is None or request_num is None:
+            return None
+        key = (client_id, session, request_num)
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            inserted_at, reply = item
+            if time.monotonic() - inserted_at > self._ttl:
+                del self._entries[key]
+                return None
+            if op is not None and reply.get("op") not in (None, op):
+                return None
+            self._entries.move_to_end(key)
+            return reply
+
+    def put(self, client_id, session, request_num, reply: dict, inserted_at: Optional[float] = None):
+        if client_id is None or request_num is None:
+            return
+        key = (client_id, session, request_num)
+        with self._lock:
+            self._entries[key] = (time.monotonic() if inserted_at is None else inserted_at, reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def export(self) -> list:
+        # [client_id, session, request_num, reply, age_seconds] for shipping in checkpoints
+        now = time.monotonic()
+        with self._lock:
+            return [[*key, reply, now - inserted_at]
+                    for key, (inserted_at, reply) in self._entries.items()
+                    if now - inserted_at <= self._ttl]
+
+    def load(self, entries: list):
+        # Replace the table with entries from export(), keeping their age
+        now = time.monotonic()
+        with self._lock:
+            self._entries.clear()
+        for client_id, session, request_num, reply, age in entries or []:
+            self.put(client_id, session, request_num, reply, inserted_at=now - float(age))
@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+from http.client import HTTPConnection
+from request_handler import CounterRequestHandler
+from common.metrics import metrics
+
+def _log(text, level="INFO"):
+    CounterRequestHandler.get_logger().log(text, level)
+
+def _timestamp():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class LeaseKeeper:
+    """Read lease of the primary, renewed from the RM.
+
+    While the lease is valid no other replica can hold one, so the primary
+    can answer reads from its own state and still be linearizable. The
+    primary asks the RM for the lease (POST /lease) and counts it from the
+    moment it *sent* the request, shortened by the RM's clock drift bound:
+    expiry = sent + duration * (1 - drift). The RM counts from when it
+    granted it, lengthened by the same bound, and does not grant the lease
+    to anyone else before that. So the holder always stops first, even if
+    the two clocks drift apart by up to `drift`.
+    """
+
+    def __init__(self, replica_id, rm_host, rm_port, timeout=1.0):
+        self._replica_id = replica_id
+        self._rm_host = rm_host
+        self._rm_port = int(rm_port)
+        self._timeout = float(timeout)
+        self._lock = threading.Lock()
+        self._expiry = 0.0
+        self._epoch = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="lease", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+
+    def valid(self) -> bool:
+        with self._lock:
+            return time.monotonic() < self._expiry
+
+    def remaining(self) -> float:
+        with self._lock:
+            return max(0.0, self._expiry - time.monotonic())
+
+    def epoch(self):
+        with self._lock:
+            return self._epoch
+
+    def drop(self):
+        # No longer the primary: stop serving lease reads at once
+        with self._lock:
+            self._expiry = 0.0
+        self._wake.set()
+
+    def renew_now(self):
+        self._wake.set()
+
+    def _request(self):
+        conn = HTTPConnection(self._rm_host, self._rm_port, timeout=self._timeout)
+        try:
+            conn.request("POST", "/lease", body=json.dumps({"replica_id": self._replica_id}), headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read() or b"{}")
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not CounterRequestHandler.is_primary():
+                self.drop()
+                self._wake.wait(1.0)
+                self._wake.clear()
+                continue
+
+            sent = time.monotonic()
+            try:
+                status, data = self._request()
+            except Exception as e:
+                _log(f"\033[93m[{_timestamp()}] {self._replica_id}: lease renewal failed: {e}\033[0m", "WARN")
+                metrics.counter("lease_renewals_total", result="error").inc()
+                self._wake.wait(0.2)
+                self._wake.clear()
+                continue
+
+            if status == 200 and data.get("granted"):
+                duration = float(data["duration"])
+                expiry = sent + duration * (1 - float(data.get("drift", 0.0)))
+                with self._lock:
+                    # A demotion while the request was out wins over the grant
+                    if CounterRequestHandler.is_primary():
+                        if data.get("epoch") != self._epoch:
+                            _log(f"\033[94m[{_timestamp()}] {self._replica_id}: holding the read lease (epoch {data.get('epoch')}, {duration}s)\033[0m")
+                        self._expiry, self._epoch = expiry, data.get("epoch")
+                metrics.counter("lease_renewals_total", result="granted").inc()
+                # Renew well before expiry so a slow RM round trip does not open a gap
+                delay = duration / 3
+            else:
+                metrics.counter("lease_renewals_total", result="denied").inc()
+                delay = min(float(data.get("retry_after", 0.5)), 1.0)
+            self._wake.wait(delay)
+            self._wake.clear()
@@ -0,0 +1,155 @@
+import json
+import threading
+import time
+from http.client import HTTPConnection
+from request_handler import CounterRequestHandler
+from common.metrics import metrics
+
+REPLICATION_MODES = ("checkpoint", "stream")
+
+def _log(text, level="INFO"):
+    CounterRequestHandler.get_logger().log(text, level)
+
+def _timestamp():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class LogShipper:
+    """Streaming replication for the passive configuration.
+
+    Instead of a checkpoint every --checkpoint-freq seconds, the primary
+    keeps one connection per backup open and pushes the ops it applied as
+    soon as they are in its op log. Whatever accumulates while a batch is in
+    flight goes out in the next one. Backups take the batches on
+    /send_checkpoint exactly like delta checkpoints and acknowledge
+    cumulatively with the version they reached.
+
+    sync_acks is the sync policy: 0 answers clients without waiting
+    (asynchronous), k holds each write's reply until k backups acknowledged
+    it.
+    """
+
+    def __init__(self, state_manager, replica_id, backups, sync_acks=0, batch_size=1024, timeout=2.0, idle_interval=1.0):
+        self.state_manager = state_manager
+        self._replica_id = replica_id
+        self._backups = backups
+        self._sync_acks = min(int(sync_acks), len(backups))
+        self._batch_size = int(batch_size)
+        self._timeout = float(timeout)
+        # An idle stream still sends an empty batch this often, so a backup
+        # that restarted is resynced without waiting for a write
+        self._idle_interval = float(idle_interval)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._acked_cond = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._threads = []
+        self._acked = {}   # backup -> version it acknowledged
+        self._sync_wait = metrics.histogram("replication_sync_wait_seconds")
+
+    def start(self):
+        for replica_id, host, port in self._backups:
+            thread = threading.Thread(target=self._run, args=(replica_id, host, int(port)), name=f"stream-{replica_id}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._changed.notify_all()
+            self._acked_cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    def notify(self):
+        # The local state advanced: wake the shippers
+        with self._lock:
+            self._changed.notify_all()
+
+    def acked_versions(self) -> dict:
+        with self._lock:
+            return dict(self._acked)
+
+    def _replicated_locked(self):
+        # Highest version at least sync_acks backups hold
+        if self._sync_acks == 0:
+            return self.state_manager.get_version()
+        versions = sorted(self._acked.values(), reverse=True)
+        return versions[self._sync_acks - 1] if len(versions) >= self._sync_acks else 0
+
+    def wait_replicated(self, version: int) -> int:
+        """Wait until sync_acks backups hold `version`; returns the version
+        they hold (lower than `version` when the timeout expired first)."""
+        start = time.perf_counter()
+        deadline = time.monotonic() + self._timeout
+        with self._lock:
+            while not self._stop.is_set():
+                current = self._replicated_locked()
+                remaining = deadline - time.monotonic()
+                if current >= version or remaining <= 0:
+                    break
+                self._acked_cond.wait(remaining)
+            current = self._replicated_locked()
+        if self._sync_acks:
+            self._sync_wait.observe(time.perf_counter() - start)
+        return current
+
+    def _run(self, replica_id, host, port):
+        conn = None
+        acked = None   # backup's version, None until it has our state
+        shipped = metrics.counter("replication_ops_sent_total", backup=replica_id)
+        round_trip = metrics.histogram("replication_round_trip_seconds", backup=replica_id)
+        while not self._stop.is_set():
+            with self._lock:
+                deadline = time.monotonic() + self._idle_interval
+                while not self._stop.is_set():
+                    primary = CounterRequestHandler.is_primary()
+                    if primary and (acked is None or self.state_manager.get_version() > acked):
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 and primary:
+                        break
+                    self._changed.wait(remaining if remaining > 0 else self._idle_interval)
+            if self._stop.is_set():
+                break
+
+            values, version, ops = self.state_manager.delta_since(acked)
+            message_data = {"primary_id": self._replica_id, "replica_id": replica_id, "timestamp": _timestamp(),
+                            "checkpoint_count": CounterRequestHandler.get_checkpoint_count(), "stream": True}
+            if ops is not None:
+                ops = ops[:self._batch_size]
+                message_data.update({"mode": "delta", "base_version": acked, "ops": ops})
+            else:
+                message_data.update({"mode": "full", "state": values, "version": version, "dedup": self.state_manager.dedup.export()})
+            start = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = HTTPConnection(host, port, timeout=self._timeout)
+                conn.request("POST", "/send_checkpoint", body=json.dumps(message_data), headers={"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                data = json.loads(resp.read() or b"{}")
+                if resp.status != 200:
+                    raise RuntimeError(f"status {resp.status}: {data}")
+            except Exception as e:
+                _log(f"\033[93m[{_timestamp()}] {self._replica_id}: replication stream to {replica_id} failed, will resend: {e}\033[0m", "WARN")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                acked = None
+                with self._lock:
+                    self._acked.pop(replica_id, None)
+                self._stop.wait(0.5)
+                continue
+            round_trip.observe(time.perf_counter() - start)
+
+            if data.get("need_full"):
+                acked = None
+                continue
+            acked = int(data.get("version", version))
+            if ops:
+                shipped.inc(len(ops))
+            elif ops is None:
+                _log(f"\033[94m[{_timestamp()}] {self._replica_id}: streamed full state (version {version}, {len(values)} key(s)) to {replica_id}\033[0m")
+            with self._lock:
+                self._acked[replica_id] = acked
+                self._acked_cond.notify_all()
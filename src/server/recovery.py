@@ -0,0 +1,104 @@
+import json
+import time
+from http.client import HTTPConnection
+from request_handler import CounterRequestHandler
+from common.metrics import metrics
+
+def _log(text, level="INFO"):
+    CounterRequestHandler.get_logger().log(text, level)
+
+def _timestamp():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class StateRecovery:
+    """Bring a restarted replica up to date before it serves.
+
+    The replica asks its peers for GET /snapshot and takes the primary's
+    (any ready peer's if the primary does not answer). The snapshot is the
+    whole state with its version and the de-duplication table. It then asks
+    the same peer for the ops applied since (GET /snapshot?since=<version>)
+    until nothing is missing, and marks itself ready. Client writes that
+    arrive in the meantime wait in their handlers and are applied after;
+    the de-duplication table tells apart the ones the snapshot already has.
+
+    Under a sequencer the snapshot carries the order position instead, and
+    the order stream delivers everything after it.
+    """
+
+    def __init__(self, state_manager, replica_id, peers, prefer=None, timeout=5.0, catch_up_rounds=5, ordering=None):
+        self.state_manager = state_manager
+        self._replica_id = replica_id
+        self._peers = [peer for peer in peers if prefer is None or peer[0] == prefer]
+        self._timeout = float(timeout)
+        self._catch_up_rounds = int(catch_up_rounds)
+        self._ordering = ordering
+        self.result = None
+
+    def _fetch(self, host, port, since=None):
+        conn = HTTPConnection(host, int(port), timeout=self._timeout)
+        try:
+            conn.request("GET", "/snapshot" if since is None else f"/snapshot?since={since}")
+            resp = conn.getresponse()
+            data = json.loads(resp.read() or b"{}")
+        finally:
+            conn.close()
+        return resp.status, data
+
+    def _snapshot(self):
+        # The primary's snapshot if it answers, else the first ready peer's
+        chosen = None
+        for replica_id, host, port in self._peers:
+            try:
+                status, data = self._fetch(host, port)
+            except Exception as e:
+                _log(f"\033[93m[{_timestamp()}] {self._replica_id}: recovery: {replica_id} did not answer: {e}\033[0m", "WARN")
+                continue
+            if status != 200:
+                continue
+            if data.get("primary"):
+                return (replica_id, host, port), data
+            if chosen is None:
+                chosen = (replica_id, host, port), data
+        return chosen if chosen is not None else (None, None)
+
+    def run(self, started):
+        """Recover; returns True once the state is current. `started` is the
+        monotonic time the server started, for the restart-to-ready time."""
+        deadline = time.monotonic() + self._timeout
+        source, data = None, None
+        while source is None and time.monotonic() < deadline:
+            source, data = self._snapshot()
+            if source is None:
+                time.sleep(0.1)
+        if source is None:
+            _log(f"\033[91m[{_timestamp()}] {self._replica_id}: recovery failed, no peer had a snapshot within {self._timeout}s; waiting for checkpoints\033[0m", "ERROR")
+            metrics.counter("recovery_failed_total").inc()
+            return False
+
+        replica_id, host, port = source
+        version = self.state_manager.install_snapshot(data.get("state", {}), data.get("version", 0), data.get("dedup"))
+        replayed = 0
+        if data.get("order") is not None and self._ordering is not None:
+            self._ordering.resume(data["order"]["epoch"], data["order"]["applied"])
+        else:
+            # Catch up on the ops the peer applied while the snapshot travelled
+            for _ in range(self._catch_up_rounds):
+                try:
+                    status, delta = self._fetch(host, port, since=version)
+                except Exception as e:
+                    _log(f"\033[93m[{_timestamp()}] {self._replica_id}: recovery catch-up from {replica_id} failed: {e}\033[0m", "WARN")
+                    break
+                if status != 200 or delta.get("mode") != "delta" or not delta.get("ops"):
+                    break
+                applied, version = self.state_manager.apply_ops(version, delta["ops"])
+                if not applied:
+                    break
+                replayed += len(delta["ops"])
+
+        elapsed = time.monotonic() - started
+        metrics.histogram("recovery_seconds").observe(elapsed)
+        self.result = {"source": replica_id, "version": version, "keys": self.state_manager.key_count(), "replayed_ops": replayed, "ms": elapsed * 1000}
+        _log(f"\033[94m[{_timestamp()}] {self._replica_id}: recovered from {replica_id}: version {version}, {self.result['keys']} key(s), "
+             f"{replayed} op(s) replayed, ready {elapsed * 1000:.1f} ms after start\033[0m")
+        return True
@@ -1,11 +1,37 @@
 from http.server import BaseHTTPRequestHandler
 import json
 import time
-from urllib.parse import urlparse, parse_qs
-import re
+from urllib.parse import urlparse, parse_qs, unquote
 import os
+import sys
+import threading
 from enum import Enum
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from common.logger import get_logger
+from common.metrics import metrics
+from storage import DEFAULT_KEY, check_key
+
+# Paths reported individually in /metrics; anything else counts as "other"
+METRIC_PATHS = {"/get", "/increase", "/decrease", "/batch", "/counters", "/heartbeat", "/send_checkpoint", "/order", "/chain", "/snapshot",
+                "/select_primary", "/select_backup", "/metrics"}
+
+def route(path: str):
+    """Map a key-scoped path to (endpoint, key).
+
+    /counters/<key> is /get and /counters/<key>/increase|decrease are
+    /increase|/decrease for that key; any other path is returned unchanged
+    with key None (the key then comes from the query or body, or defaults).
+    """
+    parts = path.split("/")
+    if len(parts) >= 3 and parts[1] == "counters" and parts[2]:
+        key = unquote(parts[2])
+        if len(parts) == 3:
+            return "/get", key
+        if len(parts) == 4 and parts[3] in ("increase", "decrease"):
+            return "/" + parts[3], key
+    return path, None
+
 class Role(Enum):
     PRIMARY = "primary"
     BACKUP = "backup"
@@ -13,82 +39,348 @@ class Role(Enum):
 class Configuration(Enum):
     ACTIVE = 0
     PASSIVE = 1
+    CHAIN = 2
 
 # The server injects a StateManager instance via a class attribute.
 class CounterRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1: connections stay open between requests (and may carry
+    # pipelined requests) unless the client asks to close, the connection
+    # has been idle for `timeout` seconds or has served
+    # max_requests_per_connection requests.
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without TCP_NODELAY the body
+    # waits for the client's delayed ACK on a kept-alive connection
+    disable_nagle_algorithm = True
+    timeout = 5.0
+    max_requests_per_connection = 1000
     state_manager = None
     replica_id = "S1"
     configuration = Configuration.ACTIVE
     role = Role.PRIMARY
     i_am_ready = 0
     checkpoint_count = 0
+    # Opt-in: a passive backup answers /get from its last checkpoint
+    backup_reads = False
+    last_checkpoint_time = None
+    # Guards role / i_am_ready / checkpoint_count. With --serving-mode threaded
+    # or asyncio several handler instances run at once and share these.
+    state_lock = threading.RLock()
     server_start_time = time.strftime("%Y%m%d_%H:%M:%S")
     # log_file = f"logs/server_{replica_id}_log_{server_start_time}.txt"
     log_file = os.path.join(os.path.dirname(__file__), "..",'..', "logs", f"server_{replica_id}_log_{server_start_time.replace(':','_')}.txt")
+    # Set by the server once the replica id and log level are known
+    logger = None
+    checkpoint_scheduler = None
+    # SequencerOrdering when active replication applies writes in a total order
+    ordering = None
+    # ChainReplicator in the chain configuration
+    chain = None
+    # LogShipper when a passive primary streams its ops to the backups
+    log_shipper = None
+    # Cleared while the replica recovers its state from a peer; writes
+    # wait for it (at most recovery_timeout seconds) instead of failing
+    recovered = threading.Event()
+    recovered.set()
+    recovery_timeout = 10.0
+    # Outcome of the last recovery, for /metrics
+    recovery = None
+    # LeaseKeeper when the primary holds a read lease from the RM
+    lease = None
+
+
+    @classmethod
+    def set_role(cls, role, i_am_ready):
+        with cls.state_lock:
+            cls.role = role
+            cls.i_am_ready = i_am_ready
+
+    @classmethod
+    def is_primary(cls):
+        with cls.state_lock:
+            return cls.role == Role.PRIMARY
+
+    @classmethod
+    def get_checkpoint_count(cls):
+        with cls.state_lock:
+            return cls.checkpoint_count
+
+    @classmethod
+    def set_checkpoint_count(cls, count):
+        with cls.state_lock:
+            cls.checkpoint_count = count
 
+    @classmethod
+    def increase_checkpoint_count(cls):
+        with cls.state_lock:
+            cls.checkpoint_count += 1
+            return cls.checkpoint_count
 
     # block the default log of BaseHTTPRequestHandler
     # e.g. 127.0.0.1 - "GET /get HTTP/1.1" 200
     def log_request(self, code='-', size='-'):
         pass
 
-    def log_message(self, fmt, *args, color="\033[0;96m"):
+    @classmethod
+    def get_logger(cls):
+        if cls.logger is None:
+            cls.logger = get_logger(cls.log_file)
+        return cls.logger
+
+    def log_message(self, fmt, *args, color="\033[0;96m", level="INFO"):
         # Add timestamp as suggested in the guide
+        logger = self.get_logger()
+        if not logger.enabled(level):
+            return ""
         ts = time.strftime("%Y-%m-%d %H:%M:%S")
-        text = f"{color}[{ts}] {self.address_string()} - {fmt % args}\033[0m"
-        print(text)
-        # write in log
-        with open(self.log_file, "a") as f:
-            f.write(f"[{ts}] {self.address_string()} - {fmt % args}\n")
-        return text
-    
+        return logger.log(f"{color}[{ts}] {self.address_string()} - {fmt % args}\033[0m", level)
+
     def log_message_before_after(self, fmt, *args, color="\033[0;35m"):
-        # Prepend timestamp as suggested in the guide
-        ts = time.strftime("%Y-%m-%d %H:%M:%S")
-        text = f"{color}[{ts}] {self.address_string()} - {fmt % args}\033[0;35m"
-        print(text)
-        # write in log
-        with open(self.log_file, "a") as f:
-            f.write(f"[{ts}] {self.address_string()} - {fmt % args}\n")
-        return text
+        return self.log_message(fmt, *args, color=color)
+
+    def _end_headers(self):
+        # Count the request against the connection's cap and announce the
+        # close on the reply that reaches it. Servers that cannot afford
+        # idle connections (the single-threaded one) close after every reply.
+        self._requests_served = getattr(self, "_requests_served", 0) + 1
+        if (not getattr(self.server, "keep_alive", True)
+                or (self.max_requests_per_connection and self._requests_served >= self.max_requests_per_connection)):
+            self.send_header("Connection", "close")
+        self.end_headers()
 
     def _send_json(self, code: int, payload: dict):
         data = json.dumps(payload).encode("utf-8")
         self.send_response(code)
         self.send_header("Content-Type", "application/json")
         self.send_header("Content-Length", str(len(data)))
-        self.end_headers()
+        self._end_headers()
         self.wfile.write(data)
 
-    def check_legal(self):
-        if CounterRequestHandler.i_am_ready == 1 and (self.configuration == Configuration.ACTIVE or CounterRequestHandler.role == Role.PRIMARY):
+    def _send_not_serving(self):
+        # Backups (and replicas not ready yet) still have to answer, or a
+        # client would wait on the open connection for a reply that never comes
+        payload = {"error": "not serving", "replica_id": self.replica_id, "primary": self.is_primary()}
+        if self.chain is not None:
+            payload["tail"] = self.chain.is_tail()
+        self._send_json(503, payload)
+
+    def _serve_backup_read(self, client_id, request_num, max_staleness, key):
+        # Reply from the last checkpoint with how old it is. Age counts from
+        # the last checkpoint message, so it can overestimate staleness while
+        # the primary skips us for already being current.
+        with CounterRequestHandler.state_lock:
+            serving = (self.backup_reads and self.configuration == Configuration.PASSIVE
+                       and CounterRequestHandler.role == Role.BACKUP and CounterRequestHandler.last_checkpoint_time is not None)
+            checkpoint_count = CounterRequestHandler.checkpoint_count
+            last_checkpoint_time = CounterRequestHandler.last_checkpoint_time
+        if not serving:
+            return False
+
+        value, version = self.state_manager.read(key)
+        age = time.monotonic() - last_checkpoint_time
+        if max_staleness is not None and age > max_staleness:
+            self.log_message('Refusing stale read <%s, %s, request id: %d, get>: checkpoint age %.3fs > %.3fs', client_id, self.replica_id, request_num, age, max_staleness, color="\033[0;33m")
+            self._send_json(503, {"error": "stale", "replica_id": self.replica_id, "age": age, "checkpoint_count": checkpoint_count})
             return True
+
+        self.log_message('Sending <%s, %s, request id: %d, backup read: %d, age: %.3fs>', client_id, self.replica_id, request_num, value, age)
+        self._send_json(200, {"counter": value, "key": key, "replica_id": self.replica_id, "primary": False, "stale": True,
+                              "version": version, "checkpoint_count": checkpoint_count, "age": age})
+        return True
+
+    @staticmethod
+    def _op_name(action, key):
+        # Log tags keep their original form for the default counter
+        return action if key == DEFAULT_KEY else f"{action} {key}"
+
+    def _ordered(self, ops):
+        """Apply client ops through the total order; returns the per-op
+        results, or None after replying with an error."""
+        if any(op.get("client_id") is None or op.get("request_num") is None for op in ops):
+            self._send_json(400, {"error": "ordered writes need client_id and request_num"})
+            return None
+        results = self.ordering.execute(ops)
+        if results is None:
+            self.log_message('Ops %s were not ordered in time', [(op["client_id"], op["request_num"]) for op in ops], color="\033[0;33m", level="WARN")
+            self._send_json(503, {"error": "not ordered", "replica_id": self.replica_id})
+        return results
+
+    def _replicator(self):
+        return self.chain if self.chain is not None else self.log_shipper
+
+    def _wait_replicated(self, request_tag):
+        # Hold the reply until the write is replicated: at the chain's tail,
+        # or on as many backups as the streaming sync policy asks for
+        version = self.state_manager.get_version()
+        replicator = self._replicator()
+        replicator.notify()
+        replicated = replicator.wait_replicated(version)
+        if replicated >= version:
+            return True
+        self.log_message('%s not replicated in time (replicated version %d, need %d)', request_tag, replicated, version, color="\033[0;33m", level="WARN")
+        self._send_json(503, {"error": "not replicated", "replica_id": self.replica_id, "version": version, "replicated_version": replicated})
         return False
 
-    # Handle GET
+    def _await_recovery(self):
+        if not CounterRequestHandler.recovered.is_set():
+            self.log_message('Holding %s until recovery completes', self.path, color="\033[0;36m")
+            CounterRequestHandler.recovered.wait(self.recovery_timeout)
+
+    def _send_snapshot(self, since):
+        # State for a recovering replica: the ops after `since` when the op
+        # log still has them, else everything with the de-duplication table
+        with CounterRequestHandler.state_lock:
+            ready = CounterRequestHandler.i_am_ready == 1
+        # Under a sequencer the snapshot names its order position, so a
+        # replica that was just made a backup (not ready) can still tell a
+        # new sequencer how far it got
+        if not (ready or self.ordering is not None) or not CounterRequestHandler.recovered.is_set():
+            self._send_not_serving()
+            return
+        if since is not None:
+            _, version, ops = self.state_manager.delta_since(int(since))
+            if ops is not None:
+                self._send_json(200, {"mode": "delta", "base_version": int(since), "version": version, "ops": ops,
+                                      "replica_id": self.replica_id, "primary": self.is_primary()})
+                return
+        order = None
+        if self.ordering is not None:
+            values, version, dedup, epoch, applied = self.ordering.snapshot()
+            order = {"epoch": epoch, "applied": applied}
+        else:
+            values, version = self.state_manager.snapshot()
+            dedup = self.state_manager.dedup.export()
+        self.log_message('Sending snapshot to a recovering replica: version %d, %d key(s)', version, len(values), color="\033[0;36m")
+        self._send_json(200, {"mode": "full", "state": values, "version": version, "dedup": dedup, "order": order,
+                              "replica_id": self.replica_id, "primary": self.is_primary()})
+
+    def check_legal(self):
+        with CounterRequestHandler.state_lock:
+            if CounterRequestHandler.i_am_ready == 1 and (self.configuration == Configuration.ACTIVE or CounterRequestHandler.role == Role.PRIMARY):
+                return True
+        return False
+
+    def check_read_legal(self):
+        # In a chain only the tail answers reads; it holds exactly the
+        # writes that were acknowledged to clients
+        if self.chain is None:
+            return self.check_legal()
+        with CounterRequestHandler.state_lock:
+            ready = CounterRequestHandler.i_am_ready == 1
+        return ready and self.chain.is_tail()
+
+    def _timed(self, handle):
+        # Count and time every request per path for /metrics
+        start = time.perf_counter()
+        try:
+            handle()
+        finally:
+            path = route(urlparse(self.path).path)[0]
+            if path not in METRIC_PATHS:
+                path = "other"
+            metrics.counter("http_requests_total", path=path).inc()
+            metrics.histogram("http_request_seconds", path=path).observe(time.perf_counter() - start)
+
+    def _send_metrics(self):
+        report = metrics.snapshot()
+        with CounterRequestHandler.state_lock:
+            report["replica"] = {"replica_id": self.replica_id, "role": CounterRequestHandler.role.value,
+                                 "i_am_ready": CounterRequestHandler.i_am_ready, "checkpoint_count": CounterRequestHandler.checkpoint_count}
+        if self.state_manager is not None:
+            report["replica"]["state_version"] = self.state_manager.get_version()
+            report["replica"]["dedup_entries"] = len(self.state_manager.dedup)
+            report["replica"]["keys"] = self.state_manager.key_count()
+        if self.checkpoint_scheduler is not None:
+            report["checkpoint_scheduler"] = self.checkpoint_scheduler.stats()
+        if self.ordering is not None:
+            report["replica"]["ordered_applied_seq"] = self.ordering.applied_seq()
+        if self.chain is not None:
+            report["replica"]["chain"] = {"successor": self.chain.successor_id(), "tail_version": self.chain.tail_version()}
+        if self.log_shipper is not None:
+            report["replica"]["stream_acked_versions"] = self.log_shipper.acked_versions()
+        if CounterRequestHandler.recovery is not None:
+            report["replica"]["recovery"] = CounterRequestHandler.recovery
+        if self.lease is not None:
+            report["replica"]["lease"] = {"valid": self.lease.valid(), "remaining": self.lease.remaining(), "epoch": self.lease.epoch()}
+        self._send_json(200, report)
+
     def do_GET(self):
+        self._timed(self._handle_get)
+
+    def do_POST(self):
+        self._timed(self._handle_post)
+
+    # Handle GET
+    def _handle_get(self):
         parsed_url = urlparse(self.path)
         query = parse_qs(parsed_url.query)
-        path = parsed_url.path
+        path, key = route(parsed_url.path)
         client_id = query.get("client_id", ["Not get client id"])[0]
         lfd_id = query.get("lfd_id", ["Not get lfd id"])[0]
-        request_num = int(query.get("request_num", [0])[0])
+        try:
+            request_num = int(query.get("request_num", [0])[0])
+        except ValueError:
+            self._send_json(400, {"error": "request_num must be an integer"})
+            return
+        max_staleness = query.get("max_staleness", [None])[0]
+        if max_staleness is not None:
+            try:
+                max_staleness = float(max_staleness)
+                if not 0 <= max_staleness < float("inf"):
+                    raise ValueError(max_staleness)
+            except ValueError:
+                self._send_json(400, {"error": "max_staleness must be a non-negative number of seconds"})
+                return
+        lease_read = query.get("lease", ["0"])[0] == "1"
+
+        if path in ("/get", "/counters"):
+            try:
+                key = check_key(key if key is not None else query.get("key", [None])[0])
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
 
         if path == "/get":
-            if not self.check_legal():
+            if not self.check_read_legal():
+                if not self._serve_backup_read(client_id, request_num, max_staleness, key):
+                    self._send_not_serving()
                 return
-            
-            value = self.state_manager.get()
+            if lease_read and self.lease is not None and not (self.is_primary() and self.lease.valid()):
+                # Another replica may hold the lease by now; reading here could miss its writes
+                self.log_message('Refusing lease read <%s, %s, request id: %d, get>: no valid lease', client_id, self.replica_id, request_num, color="\033[0;33m")
+                self._send_json(503, {"error": "no lease", "replica_id": self.replica_id, "primary": self.is_primary()})
+                return
+
+            value = self.state_manager.get(key)
             # self.log_message('Sending <reply> for /get with counter=%d', value)
-            text = self.log_message('Received <%s, %s, request id: %d, get>', client_id, self.replica_id, request_num)
-            text_only_request = re.search(r'<.*?>', text).group(0)
-            self.log_message_before_after('state_%s = %d before processing %s', self.replica_id, value, text_only_request)
+            request_tag = f"<{client_id}, {self.replica_id}, request id: {request_num}, {self._op_name('get', key)}>"
+            self.log_message('Received %s', request_tag)
+            self.log_message_before_after('state_%s = %d before processing %s', self.replica_id, value, request_tag)
 
-            self._send_json(200, {"counter": value, "replica_id": self.replica_id, "primary": self.role==Role.PRIMARY})
+            payload = {"counter": value, "key": key, "replica_id": self.replica_id, "primary": self.is_primary()}
+            if self.chain is not None:
+                payload["tail"] = True
+            if self.lease is not None:
+                payload["lease"] = self.lease.valid()
+            self._send_json(200, payload)
+
+            self.log_message_before_after('state_%s = %d after processing %s', self.replica_id, value, request_tag)
+
+            self.log_message('Sending <%s, %s, request id: %d, primary: %s, reply>', client_id, self.replica_id, request_num, self.is_primary())
+
+        elif path == "/counters":
+            # Every counter at once, with the state version they belong to
+            if not self.check_read_legal():
+                self._send_not_serving()
+                return
+            values, version = self.state_manager.snapshot()
+            self.log_message('Sending <%s, %s, request id: %d, %d counter(s)>', client_id, self.replica_id, request_num, len(values))
+            self._send_json(200, {"counters": values, "version": version, "replica_id": self.replica_id, "primary": self.is_primary()})
 
-            self.log_message_before_after('state_%s = %d after processing %s', self.replica_id, value, text_only_request)
+        elif path == "/metrics":
+            self._send_metrics()
 
-            self.log_message('Sending <%s, %s, request id: %d, primary: %s, reply>', client_id, self.replica_id, request_num, self.role==Role.PRIMARY)
+        elif path == "/snapshot":
+            self._send_snapshot(query.get("since", [None])[0])
 
         elif path == "/heartbeat":
             self.log_message("%s receives heartbeat from %s", self.replica_id, lfd_id, color="\033[1;92m")
@@ -99,9 +391,10 @@ class CounterRequestHandler(BaseHTTPRequestHandler):
             self._send_json(404, {"error": "not found"})
 
     # Handle POST
-    def do_POST(self):
+    def _handle_post(self):
         client_id = ""
         request_num = 0
+        message_data = {}
         length = int(self.headers.get("Content-Length", 0))
         if length > 0:
             body = self.rfile.read(length)
@@ -110,62 +403,170 @@ class CounterRequestHandler(BaseHTTPRequestHandler):
                 client_id = message_data.get("client_id")
                 request_num = message_data.get("request_num")
             except Exception:
-                print("Cannot get the body")
+                self.log_message("Cannot get the body", level="WARN")
+
+        path, key = route(self.path)
+        if path in ("/increase", "/decrease", "/batch", "/send_checkpoint", "/order"):
+            self._await_recovery()
 
-        if self.path == "/increase":
+        if path in ("/increase", "/decrease"):
             if not self.check_legal():
+                self._send_not_serving()
                 return
-            
-            text = self.log_message('Received <%s, %s, request id: %d, increase>', client_id, self.replica_id, request_num)
-            text_only_request = re.search(r'<.*?>', text).group(0)
-            self.log_message_before_after('state_%s = %d before processing %s', self.replica_id, self.state_manager.get(), text_only_request)
-            value = self.state_manager.increase()
-            self.log_message_before_after('state_%s = %d after processing %s', self.replica_id, self.state_manager.get(), text_only_request)
-
-            self._send_json(200, {"counter": value, "replica_id": self.replica_id, "primary": self.role==Role.PRIMARY})
-            text = self.log_message('Sending <%s, %s, request id: %d, primary: %s, reply>', client_id, self.replica_id, request_num, self.role==Role.PRIMARY)
+            try:
+                key = check_key(key if key is not None else message_data.get("key"))
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+                return
+
+            action = path[1:]
+            request_tag = f"<{client_id}, {self.replica_id}, request id: {request_num}, {self._op_name(action, key)}>"
+            self.log_message('Received %s', request_tag)
+            self.log_message_before_after('state_%s = %d before processing %s', self.replica_id, self.state_manager.get(key), request_tag)
+            if self.ordering is not None:
+                results = self._ordered([{"op": action, "key": key, "client_id": client_id, "session": message_data.get("session"), "request_num": request_num}])
+                if results is None:
+                    return
+                value, duplicate = results[0]["counter"], results[0]["duplicate"]
+            else:
+                value, duplicate = self.state_manager.apply_client_op(action, client_id, request_num, key=key, session=message_data.get("session"))
+                if self._replicator() is not None and not self._wait_replicated(request_tag):
+                    return
+            if duplicate:
+                self.log_message('Duplicate %s, replying with the cached result', request_tag, color="\033[0;33m")
+            self.log_message_before_after('state_%s = %d after processing %s', self.replica_id, value, request_tag)
+
+            self._send_json(200, {"counter": value, "key": key, "replica_id": self.replica_id, "primary": self.is_primary(), "duplicate": duplicate})
+            self.log_message('Sending <%s, %s, request id: %d, primary: %s, reply>', client_id, self.replica_id, request_num, self.is_primary())
         
-        elif self.path == "/decrease":
+        elif path == "/batch":
             if not self.check_legal():
+                self._send_not_serving()
                 return
-            
-            text = self.log_message('Received <%s, %s, request id: %d, decrease>', client_id, self.replica_id, request_num)
-            text_only_request = re.search(r'<.*?>', text).group(0)
-            self.log_message_before_after('state_%s = %d before processing %s', self.replica_id, self.state_manager.get(), text_only_request)
-            value = self.state_manager.decrease()
-            self.log_message_before_after('state_%s = %d after processing %s', self.replica_id, self.state_manager.get(), text_only_request)
-
-            self._send_json(200, {"counter": value, "replica_id": self.replica_id, "primary": self.role==Role.PRIMARY})
-            text = self.log_message('Sending <%s, %s, request id: %d, primary: %s, reply>', client_id, self.replica_id, request_num, self.role==Role.PRIMARY)
-        
-        elif self.path == "/send_checkpoint":
-            # Primary replica sending checkpoint request to backups
-            self.state_manager.set(message_data.get("state", 0))
+
+            ops = message_data.get("ops", [])
+            if not isinstance(ops, list):
+                self._send_json(400, {"error": "ops must be a list"})
+                return
+            request_tag = f"<{client_id}, {self.replica_id}, request id: {request_num}, batch of {len(ops)}>"
+            self.log_message('Received %s', request_tag)
+            if self.ordering is not None:
+                # Invalid ops are reported without being ordered
+                checked = self.state_manager.check_batch(ops)
+                valid = [{"op": op["op"], "key": check_key(op.get("key")), "client_id": op.get("client_id"), "session": op.get("session"), "request_num": op.get("request_num")}
+                         for op, error in zip(ops, checked) if error is None]
+                ordered = self._ordered(valid) if valid else []
+                if ordered is None:
+                    return
+                ordered = iter(ordered)
+                results = [next(ordered) if error is None else error for error in checked]
+            else:
+                results = self.state_manager.apply_batch(ops)
+                if self._replicator() is not None and not self._wait_replicated(request_tag):
+                    return
             value = self.state_manager.get()
-            CounterRequestHandler.checkpoint_count = message_data.get("checkpoint_count", 0)
-            self.log_message('%s received checkpoint request: my state value is %d, new checkpoint count is: %d', self.replica_id, value, CounterRequestHandler.checkpoint_count, color="\033[0;36m")
-            self._send_json(200, {"ok": True, "replica_id": self.replica_id})
+            self.log_message_before_after('state_%s = %d after processing %s', self.replica_id, value, request_tag)
+
+            self._send_json(200, {"results": results, "counter": value, "replica_id": self.replica_id, "primary": self.is_primary()})
+            self.log_message('Sending <%s, %s, request id: %d, primary: %s, batch reply>', client_id, self.replica_id, request_num, self.is_primary())
+
+        elif path == "/send_checkpoint":
+            # Primary replica sending checkpoint request to backups: either
+            # the ops since our last acknowledged version or the full state
+            checkpoint_count = message_data.get("checkpoint_count", 0)
+            if message_data.get("mode") == "delta":
+                ops = message_data.get("ops", [])
+                applied, version = self.state_manager.apply_ops(message_data.get("base_version"), ops)
+                if not applied:
+                    self.log_message('%s cannot apply checkpoint delta from version %s at version %d, asking for full state', self.replica_id, message_data.get("base_version"), version, color="\033[0;36m")
+                    self._send_json(200, {"ok": False, "need_full": True, "replica_id": self.replica_id, "version": version})
+                    return
+                detail = f"applied {len(ops)} op(s)"
+            else:
+                version = self.state_manager.install_snapshot(message_data.get("state", {}), message_data.get("version", 0), message_data.get("dedup"))
+                detail = "installed full state"
+            key_count = self.state_manager.key_count()
+            with CounterRequestHandler.state_lock:
+                CounterRequestHandler.checkpoint_count = checkpoint_count
+                CounterRequestHandler.last_checkpoint_time = time.monotonic()
+            kind = "streamed ops" if message_data.get("stream") else "checkpoint request"
+            self.log_message('%s received %s (%s): my state has %d key(s), version %d, new checkpoint count is: %d', self.replica_id, kind, detail, key_count, version, checkpoint_count, color="\033[0;36m")
+            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "version": version})
 
             # Mark the server as ready (class attribute) so other handler
             # instances and the server loop can observe the change.
-            CounterRequestHandler.i_am_ready = 1
+            with CounterRequestHandler.state_lock:
+                CounterRequestHandler.i_am_ready = 1
             self.log_message('%s i_am_ready: 1', self.replica_id)
 
-        elif self.path == "/select_primary":
+        elif path == "/order":
+            # A batch of ordered writes from the sequencer
+            if self.ordering is None:
+                self._send_json(404, {"error": "ordering is not enabled"})
+                return
+            if "snapshot" in message_data:
+                applied = self.ordering.install(message_data.get("epoch"), message_data["snapshot"])
+            else:
+                applied = self.ordering.deliver(message_data.get("epoch"), message_data.get("entries", []), message_data.get("base"))
+            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "applied": applied, "needs_snapshot": applied < 0})
+            if applied >= 0:
+                with CounterRequestHandler.state_lock:
+                    CounterRequestHandler.i_am_ready = 1
+
+        elif path == "/chain":
+            # Ops (or the whole state) from our predecessor in the chain;
+            # answered once our own successor has them too
+            if self.chain is None:
+                self._send_json(404, {"error": "not in the chain configuration"})
+                return
+            if message_data.get("mode") == "delta":
+                applied, version = self.state_manager.apply_ops(message_data.get("base_version"), message_data.get("ops", []))
+                if not applied:
+                    self.log_message('%s cannot apply chain delta from version %s at version %d, asking %s for full state', self.replica_id, message_data.get("base_version"), version, message_data.get("sender"), color="\033[0;36m")
+                    self._send_json(200, {"ok": False, "need_full": True, "replica_id": self.replica_id, "version": version})
+                    return
+            else:
+                version = self.state_manager.install_snapshot(message_data.get("state", {}), message_data.get("version", 0), message_data.get("dedup"))
+                self.log_message('%s installed full state from %s: %d key(s), version %d', self.replica_id, message_data.get("sender"), self.state_manager.key_count(), version, color="\033[0;36m")
+            with CounterRequestHandler.state_lock:
+                CounterRequestHandler.i_am_ready = 1
+            self.chain.notify()
+            tail_version = self.chain.wait_replicated(version)
+            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "version": version, "tail_version": tail_version})
+
+        elif path == "/select_primary":
             # Update the class-level role so the change is global.
-            CounterRequestHandler.role = Role.PRIMARY
+            with CounterRequestHandler.state_lock:
+                CounterRequestHandler.role = Role.PRIMARY
+                CounterRequestHandler.checkpoint_count += 1
+                CounterRequestHandler.i_am_ready = 1
+            if self.chain is not None and "successor" in message_data:
+                self.chain.configure(message_data["successor"])
+            if self.lease is not None:
+                self.lease.renew_now()
+            if self.ordering is not None:
+                self.ordering.role_changed()
             self.log_message('%s set to PRIMARY by select_primary request', self.replica_id, color="\033[0;36m")
-            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "role": CounterRequestHandler.role.value})
-            CounterRequestHandler.checkpoint_count += 1
-            CounterRequestHandler.i_am_ready = 1
+            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "role": Role.PRIMARY.value})
             self.log_message('Update %s i_am_ready -> 1, role -> PRIMARY', self.replica_id)
 
-        elif self.path == "/select_backup":
-            CounterRequestHandler.role = Role.BACKUP
+        elif path == "/select_backup":
+            if self.lease is not None:
+                self.lease.drop()
+            if self.chain is not None:
+                # A chain member's state is always a prefix of the head's, so
+                # it stays ready; a new member becomes ready with its first update
+                with CounterRequestHandler.state_lock:
+                    CounterRequestHandler.role = Role.BACKUP
+                    i_am_ready = CounterRequestHandler.i_am_ready
+                if "successor" in message_data:
+                    self.chain.configure(message_data["successor"])
+            else:
+                CounterRequestHandler.set_role(Role.BACKUP, 0)
+                i_am_ready = 0
             self.log_message('%s set to BACKUP by select_backup request', self.replica_id, color="\033[0;36m")
-            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "role": CounterRequestHandler.role.value})
-            CounterRequestHandler.i_am_ready = 0
-            self.log_message('Update %s i_am_ready -> 0, role -> BACKUP', self.replica_id)
+            self._send_json(200, {"ok": True, "replica_id": self.replica_id, "role": Role.BACKUP.value})
+            self.log_message('Update %s i_am_ready -> %d, role -> BACKUP', self.replica_id, i_am_ready)
         
         else:
             self._send_json(404, {"error": "not found"})
@@ -174,4 +575,5 @@ class CounterRequestHandler(BaseHTTPRequestHandler):
     def do_HEAD(self):
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
-        self.end_headers()
+        self.send_header("Content-Length", "0")
+        self._end_headers()
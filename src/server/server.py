@@ -1,27 +1,265 @@
 import argparse
+import asyncio
+import io
+import json
+import os
+import queue
+import selectors
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer
 from request_handler import CounterRequestHandler, Role, Configuration
+from common.logger import get_logger
 from state_manager import StateManager
-from checkpoint_handler import CheckpointHandler
+from storage import STORAGE_BACKENDS, make_backend
+from dedup import DedupTable
+from checkpoint_handler import CheckpointHandler, CheckpointScheduler, AdaptiveCheckpointPolicy, FANOUT_MODES
+from total_order import SequencerOrdering, ORDERING_MODES
+from chain import ChainReplicator
+from log_shipping import LogShipper, REPLICATION_MODES
+from recovery import StateRecovery
+from lease import LeaseKeeper
 import time
 import json
 
+SERVING_MODES = ("single", "threaded", "asyncio")
+MAX_REQUEST_HEAD = 64 * 1024
+
 class SingleThreadedHTTPServer(HTTPServer):
     allow_reuse_address = True
+    request_queue_size = 128
+    # One open connection would block every other client until it idles out
+    keep_alive = False
+
+class _Connection:
+    # A kept-alive client connection between requests: the socket, its read
+    # buffer (pipelined requests may already sit there) and its request count
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.rfile = sock.makefile("rb")
+        self.served = 0
+        self.idle_since = time.monotonic()
+
+class ThreadPoolHTTPServer(HTTPServer):
+    # Workers only run requests that have arrived. Between requests a
+    # kept-alive connection is parked on a selector (one thread for all of
+    # them) and goes back to the pool when its next request comes in, so an
+    # idle client costs a file descriptor, not a worker: --workers bounds
+    # the requests in progress, not the open connections.
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, workers=64):
+        super().__init__(server_address, handler_class)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="http-worker")
+        self._parked = queue.SimpleQueue()
+        self._selector = None
+        self._wake_r = self._wake_w = None
+        self._closing = False
+
+    def serve_forever(self, poll_interval=0.5):
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        threading.Thread(target=self._watch_idle, name="http-idle", daemon=True).start()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        if self.RequestHandlerClass.disable_nagle_algorithm:
+            request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._pool.submit(self._serve, _Connection(request, client_address))
+
+    def _serve(self, conn):
+        # Worker: answer the requests that are there, then park the connection
+        try:
+            while True:
+                conn.sock.settimeout(self.RequestHandlerClass.timeout)
+                if not self._handle_one(conn):
+                    break
+                conn.sock.settimeout(0)
+                if not conn.rfile.peek(1):
+                    conn.idle_since = time.monotonic()
+                    self._parked.put(conn)
+                    self._wake_w.send(b"x")
+                    return
+        except Exception:
+            self.handle_error(conn.sock, conn.address)
+        self._close(conn)
+
+    def _handle_one(self, conn):
+        # One request through the unchanged CounterRequestHandler; True if
+        # the connection stays open
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = handler.connection = conn.sock
+        handler.client_address = conn.address
+        handler.server = self
+        handler.rfile = conn.rfile
+        handler.wfile = io.BytesIO()
+        handler.close_connection = True
+        handler._requests_served = conn.served
+        handler.handle_one_request()
+        conn.served = handler._requests_served
+        reply = handler.wfile.getvalue()
+        if reply:
+            conn.sock.sendall(reply)
+        return not handler.close_connection
+
+    def _watch_idle(self):
+        # Selector thread: owns every parked connection; hands readable ones
+        # to the pool and closes those idle for longer than the handler timeout
+        while not self._closing:
+            while True:
+                try:
+                    conn = self._parked.get_nowait()
+                except queue.Empty:
+                    break
+                self._selector.register(conn.sock, selectors.EVENT_READ, conn)
+            for key, _ in self._selector.select(0.5):
+                if key.fileobj is self._wake_r:
+                    self._wake_r.recv(4096)
+                    continue
+                self._selector.unregister(key.fileobj)
+                self._pool.submit(self._serve, key.data)
+            now = time.monotonic()
+            for key in list(self._selector.get_map().values()):
+                conn = key.data
+                if conn is not None and now - conn.idle_since > self.RequestHandlerClass.timeout:
+                    self._selector.unregister(conn.sock)
+                    self._close(conn)
+
+    def _close(self, conn):
+        conn.rfile.close()
+        self.shutdown_request(conn.sock)
+
+    def server_close(self):
+        self._closing = True
+        if self._wake_w is not None:
+            self._wake_w.send(b"x")
+        super().server_close()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+class AsyncioHTTPServer(ThreadPoolHTTPServer):
+    # Socket I/O runs on an asyncio event loop: a request is read completely
+    # before it touches a worker, and the reply is written back by the loop.
+    # The handler itself still runs in the pool because StateManager blocks
+    # on its lock and on fsync.
+
+    def serve_forever(self, poll_interval=0.5):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.socket.setblocking(False)
+        server = await asyncio.start_server(self._handle_connection, sock=self.socket, backlog=self.request_queue_size)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        # Requests on one connection (pipelined or not) are answered in order
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername")
+        # asyncio leaves Nagle on for accepted sockets; pipelined replies
+        # would otherwise wait for the client's delayed ACK
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        served = 0
+        try:
+            while True:
+                try:
+                    raw = await asyncio.wait_for(self._read_request(reader), self.RequestHandlerClass.timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not raw:
+                    break
+                if isinstance(raw, str):
+                    # Unreadable framing: say why, then drop the connection
+                    # since the rest of the stream cannot be trusted
+                    writer.write(self._bad_request(raw))
+                    await writer.drain()
+                    break
+                reply, close = await loop.run_in_executor(self._pool, self._run_handler, raw, client_address, served)
+                served += 1
+                writer.write(reply)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        # The raw request, b"" at end of stream, or the reason (a str) the
+        # body cannot be framed
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return b""
+        if len(head) > MAX_REQUEST_HEAD:
+            return b""
+        length = 0
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                try:
+                    length = int(value.strip() or 0)
+                except ValueError:
+                    return "invalid Content-Length"
+                if length < 0:
+                    return "invalid Content-Length"
+            elif name == b"transfer-encoding" and value.strip().lower() != b"identity":
+                return "Transfer-Encoding is not supported, send a Content-Length"
+        body = await reader.readexactly(length) if length > 0 else b""
+        return head + body
+
+    @staticmethod
+    def _bad_request(reason):
+        body = json.dumps({"error": reason}).encode()
+        return (b"HTTP/1.1 400 Bad Request\r\nContent-Type: application/json\r\n"
+                b"Connection: close\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+
+    def _run_handler(self, raw, client_address, served=0):
+        # Drive the unchanged CounterRequestHandler against in-memory files.
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = None
+        handler.client_address = client_address
+        handler.server = self
+        handler.rfile = io.BytesIO(raw)
+        handler.wfile = io.BytesIO()
+        handler.close_connection = True
+        handler._requests_served = served
+        try:
+            handler.handle_one_request()
+        except Exception:
+            self.handle_error(None, client_address)
+        return handler.wfile.getvalue(), handler.close_connection
+
+def build_server(serving_mode, address, workers):
+    if serving_mode == "threaded":
+        return ThreadPoolHTTPServer(address, CounterRequestHandler, workers=workers)
+    if serving_mode == "asyncio":
+        return AsyncioHTTPServer(address, CounterRequestHandler, workers=workers)
+    return SingleThreadedHTTPServer(address, CounterRequestHandler)
 
 def clear_json(f):
     with open(f, "w", encoding="utf-8") as f:
         json.dump({}, f)
 
 def main():
+    started = time.monotonic()
     # Parse args
     parser = argparse.ArgumentParser(description="Counter Server")
     parser.add_argument("--host", default="0.0.0.0", help="Host (default: 0.0.0.0)")
     parser.add_argument("--port", type=int, default=8080, help="Port (default: 8080)")
     parser.add_argument("--replica-id", default="S1", help="Replica (default: S1)")
     parser.add_argument("--state-file", default=None, help="Optional JSON file for persistence (default: None)")
-    parser.add_argument("--checkpoint-freq", type=int, default=5, help="Send periodic checkpoints (default: 5)")
-    parser.add_argument("--configuration", type=int, default=1, help="0: Passive 1: Active")
+    parser.add_argument("--storage", choices=STORAGE_BACKENDS, default=None, help="State storage backend; needs --state-file unless memory (default: json with --state-file, memory without)")
+    parser.add_argument("--wal-flush-interval", type=float, default=0.002, help="Max seconds a WAL batch waits before its fsync (default: 0.002)")
+    parser.add_argument("--wal-batch-size", type=int, default=256, help="Ops that trigger an immediate WAL fsync (default: 256)")
+    parser.add_argument("--snapshot-every", type=int, default=10000, help="WAL ops between state file snapshots / log compaction (default: 10000)")
+    parser.add_argument("--checkpoint-freq", type=float, default=5, help="Send periodic checkpoints (default: 5)")
+    parser.add_argument("--configuration", type=int, default=1, help="0: Passive 1: Active 2: Chain")
     parser.add_argument("--is-primary", type=int, default=1, help="Whether this server is primary replica (1.primary/0.backup)")
     parser.add_argument("--backup1-name", default="S1", help="Backup Replica 1 Name")
     parser.add_argument("--backup2-name", default="S1", help="Backup Replica 2 Name")
@@ -29,56 +267,186 @@ def main():
     parser.add_argument("--backup1-port", default="8080", help="Backup Replica 1 Port")
     parser.add_argument("--backup2-host", default="0.0.0.0", help="Backup Replica 2 Host")
     parser.add_argument("--backup2-port", default="8080", help="Backup Replica 2 Port")
+    parser.add_argument("--serving-mode", choices=SERVING_MODES, default="single", help="single: one request at a time, threaded: worker pool, asyncio: event loop I/O + worker pool (default: single)")
+    parser.add_argument("--checkpoint-max-skips", type=int, default=3, help="Checkpoint rounds a backup already at the current version may be skipped in a row (default: 3)")
+    parser.add_argument("--keepalive-timeout", type=float, default=5.0, help="Seconds an idle HTTP/1.1 connection is kept open (default: 5.0)")
+    parser.add_argument("--max-requests-per-connection", type=int, default=1000, help="Requests served on one connection before it is closed, 0 for no limit (default: 1000)")
+    parser.add_argument("--shards", type=int, default=16, help="Lock shards the counters are split over by key (default: 16)")
+    parser.add_argument("--op-log-size", type=int, default=10000, help="Recent operations kept for delta checkpoints (default: 10000)")
+    parser.add_argument("--dedup-capacity", type=int, default=10000, help="Client requests remembered for duplicate detection (default: 10000)")
+    parser.add_argument("--dedup-ttl", type=float, default=300.0, help="Seconds a remembered client request stays valid (default: 300)")
+    parser.add_argument("--backup-reads", type=int, default=0, help="Passive backups answer /get from their last checkpoint (1.on/0.off, default: 0)")
+    parser.add_argument("--checkpoint-late-tolerance", type=float, default=0.1, help="Report a checkpoint as late when it starts this many seconds after its deadline (default: 0.1)")
+    parser.add_argument("--checkpoint-fanout", choices=FANOUT_MODES, default="sequential", help="sequential: one backup after another, parallel: all backups at once (default: sequential)")
+    parser.add_argument("--checkpoint-adaptive", type=int, default=0, help="Adapt the checkpoint interval to the write rate; --checkpoint-freq is the first interval (1.on/0.off, default: 0)")
+    parser.add_argument("--checkpoint-min-interval", type=float, default=0.1, help="Shortest adaptive checkpoint interval in seconds (default: 0.1)")
+    parser.add_argument("--checkpoint-max-interval", type=float, default=30.0, help="Longest adaptive checkpoint interval in seconds (default: 30)")
+    parser.add_argument("--checkpoint-max-unreplicated", type=int, default=1000, help="Adaptive target: most ops a backup may be missing (default: 1000)")
+    parser.add_argument("--checkpoint-deadline", type=float, default=2.0, help="Per-backup checkpoint deadline in seconds (default: 2.0)")
+    parser.add_argument("--ordering", choices=ORDERING_MODES, default="arrival", help="Active replication write order. arrival: each replica applies writes as they arrive, sequencer: the primary orders all writes (default: arrival)")
+    parser.add_argument("--order-batch-interval", type=float, default=0.002, help="Seconds the sequencer lets ordered writes accumulate before sending them (default: 0.002)")
+    parser.add_argument("--order-batch-size", type=int, default=512, help="Max ordered entries per batch sent to a replica (default: 512)")
+    parser.add_argument("--order-timeout", type=float, default=2.0, help="Seconds a write waits to be ordered and applied before 503 (default: 2.0)")
+    parser.add_argument("--order-log-size", type=int, default=100000, help="Ordered entries the sequencer keeps for replicas to catch up from (default: 100000)")
+    parser.add_argument("--replication", choices=REPLICATION_MODES, default="checkpoint", help="Passive replication. checkpoint: periodic checkpoints, stream: the primary pushes every op to the backups over a persistent connection (default: checkpoint)")
+    parser.add_argument("--sync-acks", type=int, default=0, help="With --replication stream, backups that must acknowledge a write before the client is answered; 0 for asynchronous (default: 0)")
+    parser.add_argument("--stream-batch-size", type=int, default=1024, help="Max ops per streamed batch (default: 1024)")
+    parser.add_argument("--stream-timeout", type=float, default=2.0, help="Seconds a write waits for --sync-acks acknowledgements before 503 (default: 2.0)")
+    parser.add_argument("--recover", type=int, default=0, help="On start, copy the state from the primary or a peer before serving (1.on/0.off, default: 0)")
+    parser.add_argument("--recover-from", default=None, help="Replica to recover from, e.g. S2 (default: the primary, else any ready peer)")
+    parser.add_argument("--recover-timeout", type=float, default=5.0, help="Seconds to keep trying to recover before falling back to checkpoints (default: 5.0)")
+    parser.add_argument("--lease-rm", default=None, help="RM host:port to take primary read leases from; a primary then answers lease reads only while its lease is valid (default: off)")
+    parser.add_argument("--chain-batch-size", type=int, default=1024, help="Max ops per update sent down the chain (default: 1024)")
+    parser.add_argument("--chain-timeout", type=float, default=2.0, help="Seconds a chain write waits for the tail before 503 (default: 2.0)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARN", "ERROR"], help="Log level (default: INFO)")
+    parser.add_argument("--workers", type=int, default=64, help="Worker threads for threaded/asyncio serving modes (default: 64)")
     args = parser.parse_args()
+    if args.ordering == "sequencer":
+        if args.configuration != 1:
+            parser.error("--ordering sequencer needs active replication (--configuration 1)")
+        if args.serving_mode == "single":
+            # Handlers block until the sequencer's batch arrives
+            parser.error("--ordering sequencer needs --serving-mode threaded or asyncio")
+    if args.recover == 1 and args.configuration == 2:
+        parser.error("--recover is not needed in the chain configuration: the predecessor sends its state")
+    if args.replication == "stream" and args.configuration != 0:
+        parser.error("--replication stream needs passive replication (--configuration 0)")
+
+    CounterRequestHandler.log_file = os.path.join(os.path.dirname(__file__), "..", "..", "logs", f"server_{args.replica_id}_log_{CounterRequestHandler.server_start_time.replace(':','_')}.txt")
+    CounterRequestHandler.logger = logger = get_logger(CounterRequestHandler.log_file, level=args.log_level)
 
-    state = StateManager(state_file=args.state_file, replica_id=args.replica_id, replica_host=args.host, replica_port=args.port)
-    checkpoint_handler = CheckpointHandler(time.time(), args.checkpoint_freq, state, curr_replica_id=args.replica_id)
+    storage = args.storage or ("json" if args.state_file else "memory")
+    wal_options = {"flush_interval": args.wal_flush_interval, "batch_size": args.wal_batch_size, "snapshot_every": args.snapshot_every} if storage == "wal" else {}
+    backend = make_backend(storage, args.state_file, replica_id=args.replica_id, **wal_options)
+    state = StateManager(state_file=args.state_file, replica_id=args.replica_id, replica_host=args.host, replica_port=args.port, op_log_size=args.op_log_size, backend=backend,
+                         dedup=DedupTable(capacity=args.dedup_capacity, ttl=args.dedup_ttl), shards=args.shards)
+    checkpoint_handler = CheckpointHandler(time.time(), args.checkpoint_freq, state, curr_replica_id=args.replica_id, fanout=args.checkpoint_fanout, deadline=args.checkpoint_deadline, max_skips=args.checkpoint_max_skips)
 
     CounterRequestHandler.state_manager = state
     CounterRequestHandler.replica_id = args.replica_id
+    CounterRequestHandler.backup_reads = args.backup_reads == 1
+    CounterRequestHandler.timeout = args.keepalive_timeout
+    CounterRequestHandler.max_requests_per_connection = args.max_requests_per_connection
 
     if args.configuration == 1:
         CounterRequestHandler.configuration = Configuration.ACTIVE
+    elif args.configuration == 2:
+        CounterRequestHandler.configuration = Configuration.CHAIN
     else:
         CounterRequestHandler.configuration = Configuration.PASSIVE
 
     if args.is_primary == 1:
-        role = Role.PRIMARY
-        i_am_ready = 1
+        CounterRequestHandler.set_role(Role.PRIMARY, 1)
     else:
-        role = Role.BACKUP
-        i_am_ready = 0
+        CounterRequestHandler.set_role(Role.BACKUP, 0)
 
-    CounterRequestHandler.role = role
-    CounterRequestHandler.i_am_ready = i_am_ready
-
-    # print("\033[94m%s i_am_ready -> %d\033[0m" % (CounterRequestHandler.replica_id, CounterRequestHandler.i_am_ready))
-    print(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] {CounterRequestHandler.replica_id} i_am_ready -> {CounterRequestHandler.i_am_ready}\033[0m")
+    logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] {CounterRequestHandler.replica_id} i_am_ready -> {CounterRequestHandler.i_am_ready}\033[0m")
 
     # Start listening
-    server = SingleThreadedHTTPServer((args.host, args.port), CounterRequestHandler)
+    server = build_server(args.serving_mode, (args.host, args.port), args.workers)
     server.timeout = 0.1
-    print(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Listening on http://{args.host}:{args.port} as {args.replica_id}\033[0m")
-    print(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Endpoints: POST /increase, POST /decrease, GET /get, GET /heartbeat\033[0m")
+    logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Listening on http://{args.host}:{args.port} as {args.replica_id} ({args.serving_mode} serving mode)\033[0m")
+    logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Endpoints: POST /increase, POST /decrease, POST /batch, GET /get, GET /counters, GET|POST /counters/<key>[/increase|/decrease], GET /heartbeat, GET /metrics, GET /snapshot, POST /order, POST /chain\033[0m")
+
+    backups = [[args.backup1_name, args.backup1_host, args.backup1_port], [args.backup2_name, args.backup2_host, args.backup2_port]]
+
+    # Checkpoints go out from their own thread so a slow backup never
+    # delays client requests or heartbeats.
+    policy = None
+    if args.checkpoint_adaptive == 1:
+        policy = AdaptiveCheckpointPolicy(min_interval=args.checkpoint_min_interval, max_interval=args.checkpoint_max_interval, max_unreplicated=args.checkpoint_max_unreplicated)
+    scheduler = CheckpointScheduler(checkpoint_handler, backups, freq=args.checkpoint_freq, late_tolerance=args.checkpoint_late_tolerance, policy=policy)
+    CounterRequestHandler.checkpoint_scheduler = scheduler
+
+    # In a chain the updates travel replica to replica instead of as
+    # checkpoints. Until the RM says otherwise the chain runs in replica id
+    # order (S1 -> S2 -> S3).
+    chain = None
+    if CounterRequestHandler.configuration == Configuration.CHAIN:
+        members = sorted([[args.replica_id, args.host, args.port]] + backups, key=lambda member: member[0])
+        position = [member[0] for member in members].index(args.replica_id)
+        successor = members[position + 1] if position + 1 < len(members) else None
+        chain = ChainReplicator(state, args.replica_id, successor=successor, batch_size=args.chain_batch_size, timeout=args.chain_timeout)
+        CounterRequestHandler.chain = chain
+        logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Chain replication: writes go to the head, reads to the tail; successor {successor[0] if successor else 'none (tail)'}\033[0m")
+
+    # Streaming replication replaces the periodic checkpoints: every op is
+    # pushed to the backups as soon as it is applied
+    log_shipper = None
+    if args.replication == "stream":
+        log_shipper = LogShipper(state, args.replica_id, backups, sync_acks=args.sync_acks, batch_size=args.stream_batch_size, timeout=args.stream_timeout)
+        CounterRequestHandler.log_shipper = log_shipper
+        logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Streaming replication to the backups, {'asynchronous' if args.sync_acks <= 0 else f'{args.sync_acks} ack(s) per write'}\033[0m")
+
+    # With a sequencer the ordered write stream keeps the replicas in step;
+    # a checkpoint on top of it would apply the same writes twice.
+    ordering = None
+    if args.ordering == "sequencer":
+        ordering = SequencerOrdering(state, args.replica_id, backups, batch_interval=args.order_batch_interval, batch_size=args.order_batch_size,
+                                     timeout=args.order_timeout, log_size=args.order_log_size)
+        CounterRequestHandler.ordering = ordering
+        logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Writes are totally ordered by the sequencer (the primary); POST /order takes ordered batches\033[0m")
+
+    lease = None
+    if args.lease_rm:
+        rm_host, _, rm_port = args.lease_rm.rpartition(":")
+        lease = LeaseKeeper(args.replica_id, rm_host, rm_port)
+        CounterRequestHandler.lease = lease
+        lease.start()
+
+    # Recover while already accepting connections, so writes that arrive
+    # meanwhile wait in their handlers instead of being refused
+    if args.recover == 1:
+        recovery = StateRecovery(state, args.replica_id, backups, prefer=args.recover_from, timeout=args.recover_timeout, ordering=ordering)
+        CounterRequestHandler.recovery_timeout = args.recover_timeout * 2
+        CounterRequestHandler.recovered.clear()
+        was_ready = CounterRequestHandler.i_am_ready
+        CounterRequestHandler.i_am_ready = 0
+
+        def recover():
+            try:
+                ok = recovery.run(started)
+            except Exception as e:
+                logger.log(f"\033[91m[{time.strftime('%Y-%m-%d %H:%M:%S')}] Recovery failed: {e}\033[0m", "ERROR")
+                ok = False
+            with CounterRequestHandler.state_lock:
+                if ok:
+                    CounterRequestHandler.i_am_ready = 1
+                    CounterRequestHandler.last_checkpoint_time = time.monotonic()
+                    CounterRequestHandler.recovery = recovery.result
+                else:
+                    CounterRequestHandler.i_am_ready = was_ready
+            CounterRequestHandler.recovered.set()
+            logger.log(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] {args.replica_id} i_am_ready -> {CounterRequestHandler.i_am_ready}\033[0m")
 
-    # # Use the handler's role attribute so role changes can happen at runtime
-    # if CounterRequestHandler.role == Role.BACKUP:
-    #     print(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] This replica now is a backup server \033[0m")
-    # else:
-    #     print(f"\033[94m[{time.strftime('%Y-%m-%d %H:%M:%S')}] This replica now is a primary server \033[0m")
+        threading.Thread(target=recover, name="recovery", daemon=True).start()
 
     try:
         # Writeup said that the checkpoint_count is 1 at first.
-        while True: 
-            if CounterRequestHandler.role == Role.PRIMARY:
-                checkpoint_handler.send_request([[args.backup1_name, args.backup1_host, args.backup1_port], [args.backup2_name, args.backup2_host, args.backup2_port]])
-            server.handle_request()
+        if ordering is not None:
+            ordering.start()
+        elif chain is not None:
+            chain.start()
+        elif log_shipper is not None:
+            log_shipper.start()
+        else:
+            scheduler.start()
+        server.serve_forever()
     except KeyboardInterrupt:
-        # clear_json(args.replica_file)
-        print(f"\n\033[91m[{time.strftime('%Y-%m-%d %H:%M:%S')}] server has died...\033[0m")
+        logger.log(f"\n\033[91m[{time.strftime('%Y-%m-%d %H:%M:%S')}] server has died...\033[0m", "ERROR")
     finally:
-        # clear_json(args.replica_file)
+        if ordering is not None:
+            ordering.stop()
+        elif chain is not None:
+            chain.stop()
+        elif log_shipper is not None:
+            log_shipper.stop()
+        else:
+            scheduler.stop(timeout=1.0)
+        if lease is not None:
+            lease.stop()
         server.server_close()
+        state.close()
 
 if __name__ == "__main__":
     main()
@@ -1,46 +1,130 @@
 import json
-import os
 import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 from typing import Optional
-from request_handler import Role
+from request_handler import Role, CounterRequestHandler
+from storage import StorageBackend, JsonFileBackend, MemoryBackend, DEFAULT_KEY, check_key
+from dedup import DedupTable
+from common.metrics import metrics
 
-# Maintain the counter value in json
+def _apply_to(values: dict, entry: dict) -> int:
+    # Apply one op-log entry to a key -> value map and return the new value
+    key = entry.get("key", DEFAULT_KEY)
+    if entry["op"] == "increase":
+        values[key] = values.get(key, 0) + 1
+    elif entry["op"] == "decrease":
+        values[key] = values.get(key, 0) - 1
+    elif entry["op"] == "set":
+        values[key] = int(entry["value"])
+    else:
+        raise ValueError(f"unknown op {entry['op']!r}")
+    return values[key]
+
+
+class _Shard:
+    __slots__ = ("lock", "values")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+# Named counters, split over shards by key.
+#
+# Each shard has its own lock, so writes to keys in different shards only
+# share the short critical section under _log_lock that assigns the version,
+# appends to the op log and hands the op to the storage backend. Lock order
+# is always shards (by index) then _log_lock. Operations that need the whole
+# keyspace (snapshots, checkpoints received from the primary) take every
+# shard lock.
 class StateManager:
-    def __init__(self, state_file: Optional[str] = None, replica_id: str = "S1", replica_host: str = "0.0.0.0", replica_port: int = 8080):
-        self._lock = threading.Lock()
-        self._value = 0
+    def __init__(self, state_file: Optional[str] = None, replica_id: str = "S1", replica_host: str = "0.0.0.0", replica_port: int = 8080, op_log_size: int = 10000,
+                 backend: Optional[StorageBackend] = None, dedup: Optional[DedupTable] = None, shards: int = 16):
+        self._shards = [_Shard() for _ in range(max(1, int(shards)))]
+        self._log_lock = threading.Lock()
+        # Bumped by every mutation; checkpoints use it to skip backups that
+        # are already current and to ship only the ops they are missing.
+        self._version = 0
+        self._op_log = deque(maxlen=op_log_size)
         self._primary = []
         self._backup = []
         self._state_file = state_file
         self._replica_id = replica_id
         self._replica_host = replica_host
         self._replica_port = replica_port
+        # Without an explicit backend keep the original behaviour: the JSON
+        # state file when one is given, nothing otherwise.
+        if backend is None:
+            backend = JsonFileBackend(state_file, replica_id=replica_id) if state_file else MemoryBackend()
+        self._backend = backend
+        # Replies to client ops already applied, so retries are not applied twice.
+        # Checked and filled under the key's shard lock together with the mutation.
+        self.dedup = dedup if dedup is not None else DedupTable()
+        self._lock_wait = metrics.histogram("state_lock_wait_seconds")
+        self._persist_time = metrics.histogram("state_persist_seconds", backend=self._backend.name)
+        self._durable_wait = metrics.histogram("state_durable_wait_seconds", backend=self._backend.name)
 
-        if self._state_file and os.path.exists(self._state_file):
-            self._load_state_file()
+        self._load_state()
 
     def _timestamp(self) -> str:
         return time.strftime("%Y-%m-%d %H:%M:%S")
 
-    def _persist_state_file(self):
-        if not self._state_file:
-            return
-        tmp = f"{self._state_file}.tmp"
-        data = {"counter": self._value, "replica_id": self._replica_id}
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f)
-            f.flush()
-            os.fsync(f.fileno())
-        os.replace(tmp, self._state_file)
-
-    def _load_state_file(self):
+    def _shard(self, key: str) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _load_state(self):
+        values, self._version, entries = self._backend.load()
+        self._install(values)
+        # Re-apply the ops logged after the last snapshot, in version order
+        for entry in entries:
+            _apply_to(self._shard(entry.get("key", DEFAULT_KEY)).values, entry)
+            self._version = int(entry["version"])
+            self._op_log.append(entry)
+            self._remember(entry)
+        if entries:
+            CounterRequestHandler.get_logger().log(f"\033[96m[{self._timestamp()}] state_{self._replica_id}: replayed {len(entries)} op(s) from {self._backend.name} storage, now at version {self._version}\033[0m")
+
+    def _install(self, values: dict):
+        # Replace the contents of every shard (all locks held)
+        for shard in self._shards:
+            shard.values = {}
+        for key, value in values.items():
+            self._shard(key).values[key] = int(value)
+
+    @contextmanager
+    def _locked(self, *locks):
+        # Acquire locks in the given order, recording how long we waited
+        start = time.perf_counter()
+        for lock in locks:
+            lock.acquire()
+        self._lock_wait.observe(time.perf_counter() - start)
         try:
-            with open(self._state_file, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                self._value = int(data.get("counter", 0))
-        except Exception:
-            self._value = 0
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _all_locks(self):
+        return [shard.lock for shard in self._shards] + [self._log_lock]
+
+    def _persist(self, entries: list, changes: dict):
+        # Caller holds _log_lock. Returns a token to wait on (after
+        # releasing the locks) before the write may be acknowledged.
+        with self._persist_time.time():
+            return self._backend.record(entries, changes, self._version)
+
+    def _wait_durable(self, token):
+        if token is not None:
+            with self._durable_wait.time():
+                self._backend.wait_durable(token)
+        if self._backend.needs_snapshot():
+            values, version = self.snapshot()
+            self._backend.write_snapshot(values, version)
+
+    def close(self):
+        self._backend.close()
 
     def _load_replica_file(self):
         try:
@@ -51,34 +135,184 @@ class StateManager:
         except Exception:
             self._primary = []
 
-    def get(self) -> int:
-        with self._lock:
-            return self._value
-
-    def increase(self) -> int:
-        with self._lock:
-            before = self._value
-            # print(f"\033[96m[{self._timestamp()}] state_{self._replica_id} = {before} before processing <request: increase>\033[0m")
-            self._value += 1
-            after = self._value
-            # print(f"\033[96m[{self._timestamp()}] state_{self._replica_id} = {after} after processing <request: increase>\033[0m")
-            self._persist_state_file()
-            return self._value
-
-    def decrease(self) -> int:
-        with self._lock:
-            before = self._value
-            # print(f"\033[96m[{self._timestamp()}] state_{self._replica_id} = {before} before processing <request: decrease>\033[0m")
-            self._value -= 1
-            after = self._value
-            # print(f"\033[96m[{self._timestamp()}] state_{self._replica_id} = {after} after processing <request: decrease>\033[0m")
-            self._persist_state_file()
-            return self._value
-        
-
-    def set(self, v: int) -> int:
-        # Set the counter to an exact value (used for passive checkpointing)
-        with self._lock:
-            self._value = int(v)
-            self._persist_state_file()
-            return self._value
\ No newline at end of file
+    def _record(self, shard: _Shard, op: str, key: str, client_id=None, request_num=None, session=None, **fields) -> dict:
+        # Apply a new local mutation and append it to the op log
+        # (shard lock and _log_lock held)
+        entry = {"version": self._version + 1, "op": op, "key": key, **fields}
+        if client_id is not None and request_num is not None:
+            entry["client_id"] = client_id
+            entry["session"] = session
+            entry["request_num"] = request_num
+        _apply_to(shard.values, entry)
+        self._version = entry["version"]
+        self._op_log.append(entry)
+        self._remember(entry)
+        return entry
+
+    def _remember(self, entry: dict):
+        # Cache the reply of a client op (its shard lock held)
+        if "client_id" in entry:
+            key = entry.get("key", DEFAULT_KEY)
+            self.dedup.put(entry["client_id"], entry.get("session"), entry["request_num"],
+                           {"op": entry["op"], "key": key, "counter": self._shard(key).values.get(key, 0)})
+
+    def _mutate(self, op: str, key, client_id=None, request_num=None, session=None, **fields):
+        # Apply one op to one key; returns (value, duplicate)
+        key = check_key(key)
+        shard = self._shard(key)
+        with self._locked(shard.lock):
+            cached = self.dedup.get(client_id, session, request_num, op)
+            if cached is not None:
+                return cached["counter"], True
+            with self._log_lock:
+                entry = self._record(shard, op, key, client_id=client_id, request_num=request_num, session=session, **fields)
+                value = shard.values[key]
+                token = self._persist([entry], {key: value})
+        self._wait_durable(token)
+        return value, False
+
+    def get(self, key: Optional[str] = None) -> int:
+        key = check_key(key)
+        shard = self._shard(key)
+        with self._locked(shard.lock):
+            return shard.values.get(key, 0)
+
+    def read(self, key: Optional[str] = None):
+        # (value, version) of one key, taken together
+        key = check_key(key)
+        shard = self._shard(key)
+        with self._locked(shard.lock, self._log_lock):
+            return shard.values.get(key, 0), self._version
+
+    def get_version(self) -> int:
+        with self._locked(self._log_lock):
+            return self._version
+
+    def snapshot(self):
+        """Return (values, version): a copy of every counter and the version
+        they correspond to."""
+        with self._locked(*self._all_locks()):
+            values = {}
+            for shard in self._shards:
+                values.update(shard.values)
+            return values, self._version
+
+    def key_count(self) -> int:
+        return sum(len(shard.values) for shard in self._shards)
+
+    def delta_since(self, version: Optional[int]):
+        """Return (values, version, ops).
+
+        ops lists the mutations after `version` (values is then None, since
+        the caller does not need a copy of the keyspace), or is None when
+        `version` is unknown or already fell out of the op log, in which case
+        values is a full snapshot to ship instead.
+        """
+        with self._locked(self._log_lock):
+            if version is not None and version <= self._version:
+                if version == self._version:
+                    return None, self._version, []
+                if self._op_log and self._op_log[0]["version"] <= version + 1:
+                    return None, self._version, [entry for entry in self._op_log if entry["version"] > version]
+        values, current = self.snapshot()
+        return values, current, None
+
+    def apply_ops(self, base_version: int, ops: list):
+        """Apply ops shipped by the primary. Returns (applied, version).
+
+        Nothing is applied unless this replica is exactly at base_version.
+        """
+        with self._locked(*self._all_locks()):
+            if base_version != self._version:
+                return False, self._version
+            changes = {}
+            for entry in ops:
+                key = entry.get("key", DEFAULT_KEY)
+                changes[key] = _apply_to(self._shard(key).values, entry)
+                self._version = int(entry["version"])
+                self._op_log.append(entry)
+                self._remember(entry)
+            token = self._persist(ops, changes) if ops else None
+            version = self._version
+        self._wait_durable(token)
+        return True, version
+
+    def install_snapshot(self, values, version: int, dedup: Optional[list] = None) -> int:
+        # Replace the whole state with a full checkpoint from the primary
+        if not isinstance(values, dict):
+            # Checkpoint from a primary that only had the single counter
+            values = {DEFAULT_KEY: int(values)}
+        with self._locked(*self._all_locks()):
+            self._install(values)
+            self._version = int(version)
+            self._op_log.clear()
+            if dedup is not None:
+                self.dedup.load(dedup)
+            self._backend.replace({key: int(value) for key, value in values.items()}, self._version)
+            return self._version
+
+    def apply_client_op(self, action: str, client_id=None, request_num=None, key: Optional[str] = None, session=None):
+        """Apply increase/decrease for a client request unless it is a retry.
+
+        Returns (counter, duplicate). For a duplicate nothing is applied and
+        counter is the value originally sent back for that request.
+        """
+        return self._mutate(action, key, client_id, request_num, session)
+
+    def increase(self, key: Optional[str] = None) -> int:
+        return self._mutate("increase", key)[0]
+
+    def decrease(self, key: Optional[str] = None) -> int:
+        return self._mutate("decrease", key)[0]
+
+    def set(self, v: int, key: Optional[str] = None) -> int:
+        # Set a counter to an exact value
+        return self._mutate("set", key, value=int(v))[0]
+
+    @staticmethod
+    def check_batch(ops: list) -> list:
+        # Per op: None if apply_batch can apply it, else its error result
+        results = []
+        for op in ops:
+            action = op.get("op") if isinstance(op, dict) else None
+            request_num = op.get("request_num") if isinstance(op, dict) else None
+            error = None
+            if action not in ("increase", "decrease"):
+                error = f"invalid op {action!r}"
+            else:
+                try:
+                    check_key(op.get("key"))
+                except ValueError as e:
+                    error = str(e)
+            results.append(None if error is None else {"ok": False, "error": error, "request_num": request_num})
+        return results
+
+    def apply_batch(self, ops: list) -> list:
+        """Apply a list of client ops atomically: one lock hold, one persist.
+
+        Each op is a dict with "op" ("increase" or "decrease") and optional
+        "key" / "client_id" / "session" / "request_num"; returns one result per op, in
+        order. Only the shards of the keys in the batch are locked.
+        """
+        results = self.check_batch(ops)
+        valid = [(i, op["op"], check_key(op.get("key")), op.get("client_id"), op.get("session"), op.get("request_num"))
+                 for i, op in enumerate(ops) if results[i] is None]
+
+        shard_ids = sorted({hash(key) % len(self._shards) for _, _, key, _, _, _ in valid})
+        token = None
+        with self._locked(*[self._shards[i].lock for i in shard_ids], self._log_lock):
+            entries = []
+            changes = {}
+            for i, action, key, client_id, session, request_num in valid:
+                cached = self.dedup.get(client_id, session, request_num, action)
+                if cached is not None:
+                    results[i] = {"ok": True, "key": key, "counter": cached["counter"], "request_num": request_num, "duplicate": True}
+                    continue
+                shard = self._shard(key)
+                entries.append(self._record(shard, action, key, client_id=client_id, request_num=request_num, session=session))
+                changes[key] = shard.values[key]
+                results[i] = {"ok": True, "key": key, "counter": changes[key], "request_num": request_num}
+            if entries:
+                token = self._persist(entries, changes)
+        self._wait_durable(token)
+        return results
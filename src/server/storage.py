@@ -0,0 +1,309 @@
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+from typing import Optional
+from wal import WriteAheadLog
+
+STORAGE_BACKENDS = ("memory", "json", "wal", "mmap", "sqlite")
+
+DEFAULT_KEY = "counter"
+# Keys are stored in fixed-size slots by the mmap backend
+MAX_KEY_BYTES = 64
+
+def check_key(key) -> str:
+    """Return the key to use for `key`, or raise ValueError if it is invalid.
+
+    None selects DEFAULT_KEY, the single counter of the original API.
+    """
+    if key is None:
+        return DEFAULT_KEY
+    if not isinstance(key, str) or not key:
+        raise ValueError("key must be a non-empty string")
+    if len(key.encode("utf-8")) > MAX_KEY_BYTES:
+        raise ValueError(f"key longer than {MAX_KEY_BYTES} bytes")
+    return key
+
+# Where StateManager keeps its counters between restarts.
+#
+# The state is a map of key -> counter value plus the version of the last
+# op applied. StateManager applies a mutation under its locks and then calls
+# record() with the new op-log entries and the new values of the keys they
+# changed, while still holding _log_lock. record() returns a token that is
+# passed to wait_durable() after the locks are released, so backends that
+# batch their syncs (the append log) do not serialize writers on the disk.
+class StorageBackend:
+    name = "base"
+
+    def load(self):
+        """Return (values, version, entries): the last saved counters plus
+        any logged ops after them that the caller still has to re-apply."""
+        return {}, 0, []
+
+    def record(self, entries: list, changes: dict, version: int):
+        return None
+
+    def wait_durable(self, token):
+        pass
+
+    def needs_snapshot(self) -> bool:
+        return False
+
+    def write_snapshot(self, values: dict, version: int):
+        pass
+
+    def replace(self, values: dict, version: int):
+        # Discard the saved history and store exactly this state
+        self.write_snapshot(values, version)
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(StorageBackend):
+    # No persistence; the state is lost when the process exits
+    name = "memory"
+
+
+class JsonFileBackend(StorageBackend):
+    # The original format: rewrite and fsync the whole JSON file per write
+    name = "json"
+
+    def __init__(self, path: str, replica_id: str = "S1"):
+        self._path = path
+        self._replica_id = replica_id
+        self._values = {}
+
+    def _read(self):
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception:
+            return {}, 0
+        if "counters" in data:
+            values = {key: int(value) for key, value in data["counters"].items()}
+        else:
+            # Written before keys existed: just the default counter
+            values = {DEFAULT_KEY: int(data.get("counter", 0))}
+        return values, int(data.get("version", 0))
+
+    def load(self):
+        self._values, version = self._read()
+        return dict(self._values), version, []
+
+    def record(self, entries, changes, version):
+        self._values.update(changes)
+        self._write(self._values, version)
+        return None
+
+    def write_snapshot(self, values, version):
+        self._values = dict(values)
+        self._write(self._values, version)
+
+    def _write(self, values, version):
+        tmp = f"{self._path}.tmp"
+        data = {"counters": values, "version": version, "replica_id": self._replica_id}
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path)
+
+
+class AppendLogBackend(JsonFileBackend):
+    # Ops go to <path>.wal with group commit; the JSON file at <path> is only
+    # a periodic snapshot, after which the log is compacted.
+    name = "wal"
+
+    def __init__(self, path: str, replica_id: str = "S1", flush_interval: float = 0.002, batch_size: int = 256, snapshot_every: int = 10000):
+        super().__init__(path, replica_id)
+        self._wal_path = f"{path}.wal"
+        self._snapshot_every = snapshot_every
+        self._ops_since_snapshot = 0
+        self._snapshot_lock = threading.Lock()
+        self._wal = WriteAheadLog(self._wal_path, flush_interval=flush_interval, batch_size=batch_size)
+
+    def load(self):
+        values, version = self._read()
+        entries = []
+        for entry in WriteAheadLog.read(self._wal_path):
+            entry_version = int(entry.get("version", 0))
+            if entry_version <= version:
+                continue
+            if entry_version != version + len(entries) + 1:
+                break
+            entries.append(entry)
+        self._ops_since_snapshot = len(entries)
+        return values, version, entries
+
+    def record(self, entries, changes, version):
+        lsn = None
+        for entry in entries:
+            lsn = self._wal.append(entry)
+        self._ops_since_snapshot += len(entries)
+        return lsn
+
+    def wait_durable(self, token):
+        if token is not None:
+            self._wal.wait_durable(token)
+
+    def needs_snapshot(self):
+        return self._ops_since_snapshot >= self._snapshot_every and not self._snapshot_lock.locked()
+
+    def write_snapshot(self, values, version):
+        # Records the snapshot covers are dropped from the log; newer ones stay
+        if not self._snapshot_lock.acquire(blocking=False):
+            return
+        try:
+            self._ops_since_snapshot = 0
+            self._write(values, version)
+            self._wal.truncate_through(version)
+        finally:
+            self._snapshot_lock.release()
+
+    def replace(self, values, version):
+        # Waits out a snapshot in progress, which would otherwise truncate
+        # the log against a version this install no longer matches
+        with self._snapshot_lock:
+            self._wal.flush()
+            self._write(values, version)
+            self._wal.truncate_through(float("inf"))
+            self._ops_since_snapshot = 0
+
+    def close(self):
+        self._wal.close()
+
+
+class MmapBackend(StorageBackend):
+    # Header (magic, version, slots in use) followed by fixed 72-byte slots of
+    # (utf-8 key padded to 64 bytes, counter), all little-endian. A write
+    # stores the changed slots and the header, then msyncs; the file doubles
+    # in size when it runs out of slots.
+    name = "mmap"
+    _HEADER = struct.Struct("<8sqq")
+    _SLOT = struct.Struct(f"<{MAX_KEY_BYTES}sq")
+    _MAGIC = b"CNTRv002"
+
+    def __init__(self, path: str, initial_slots: int = 1024):
+        self._path = path
+        self._slots = {}
+        self._used = 0
+        self._capacity = 0
+        self._mm = None
+        self._map(self._HEADER.size + self._SLOT.size * initial_slots)
+
+    def _map(self, min_size: int):
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < min_size:
+                os.ftruncate(fd, min_size)
+            size = os.fstat(fd).st_size
+            if self._mm is not None:
+                self._mm.close()
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._capacity = (size - self._HEADER.size) // self._SLOT.size
+
+    def _slot_offset(self, index: int) -> int:
+        return self._HEADER.size + index * self._SLOT.size
+
+    def load(self):
+        magic, version, used = self._HEADER.unpack_from(self._mm, 0)
+        self._slots = {}
+        self._used = 0
+        if magic != self._MAGIC:
+            return {}, 0, []
+        values = {}
+        for index in range(min(used, self._capacity)):
+            raw_key, value = self._SLOT.unpack_from(self._mm, self._slot_offset(index))
+            key = raw_key.rstrip(b"\0").decode("utf-8")
+            self._slots[key] = index
+            values[key] = value
+        self._used = len(self._slots)
+        return values, version, []
+
+    def _store(self, key: str, value: int):
+        index = self._slots.get(key)
+        if index is None:
+            if self._used >= self._capacity:
+                self._map(self._slot_offset(self._capacity * 2))
+            index = self._used
+            self._slots[key] = index
+            self._used += 1
+        self._SLOT.pack_into(self._mm, self._slot_offset(index), key.encode("utf-8"), value)
+
+    def record(self, entries, changes, version):
+        for key, value in changes.items():
+            self._store(key, value)
+        self._HEADER.pack_into(self._mm, 0, self._MAGIC, version, self._used)
+        self._mm.flush()
+        return None
+
+    def write_snapshot(self, values, version):
+        self._slots = {}
+        self._used = 0
+        self.record([], values, version)
+
+    def close(self):
+        self._mm.close()
+
+
+class SqliteBackend(StorageBackend):
+    # One row per key, updated in place; synchronous=FULL so each commit
+    # (one per write, however many keys it changed) is durable
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (id, version) VALUES (0, 0)")
+
+    def load(self):
+        values = dict(self._conn.execute("SELECT key, value FROM counters"))
+        (version,) = self._conn.execute("SELECT version FROM meta WHERE id = 0").fetchone()
+        return values, version, []
+
+    def record(self, entries, changes, version):
+        self._write(changes, version, clear=False)
+        return None
+
+    def write_snapshot(self, values, version):
+        self._write(values, version, clear=True)
+
+    def _write(self, values, version, clear):
+        self._conn.execute("BEGIN")
+        try:
+            if clear:
+                self._conn.execute("DELETE FROM counters")
+            self._conn.executemany("INSERT OR REPLACE INTO counters (key, value) VALUES (?, ?)", values.items())
+            self._conn.execute("UPDATE meta SET version = ? WHERE id = 0", (version,))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        self._conn.close()
+
+
+def make_backend(name: str, path: Optional[str], replica_id: str = "S1", **options) -> StorageBackend:
+    """Build a backend by name. Every backend except memory needs a path."""
+    if name == "memory":
+        return MemoryBackend()
+    if not path:
+        raise ValueError(f"storage backend {name!r} needs a state file path")
+    if name == "json":
+        return JsonFileBackend(path, replica_id=replica_id)
+    if name == "wal":
+        return AppendLogBackend(path, replica_id=replica_id, **options)
+    if name == "mmap":
+        return MmapBackend(path)
+    if name == "sqlite":
+        return SqliteBackend(path)
+    raise ValueError(f"unknown storage backend {name!r}")
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from state_manager import StateManager
+from storage import STORAGE_BACKENDS, make_backend
+
+# Microbenchmark: ops/sec and latency percentiles of StateManager.increase()
+# for each storage backend, with a configurable number of writer threads
+# spread over a configurable number of keys.
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, int(round(p / 100.0 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+def run_backend(name, directory, ops, threads, keys, shards, wal_options):
+    path = os.path.join(directory, f"bench_{name}.state")
+    backend = make_backend(name, path, **(wal_options if name == "wal" else {}))
+    state = StateManager(backend=backend, shards=shards)
+    per_thread = ops // threads
+    latencies = [[] for _ in range(threads)]
+
+    def worker(offset, samples):
+        for i in range(per_thread):
+            key = f"key{(offset + i) % keys}"
+            start = time.perf_counter()
+            state.increase(key)
+            samples.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker, args=(i, latencies[i])) for i in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    state.close()
+
+    samples = sorted(s for per in latencies for s in per)
+    return {
+        "backend": name,
+        "ops": len(samples),
+        "threads": threads,
+        "keys": keys,
+        "seconds": elapsed,
+        "ops_per_sec": len(samples) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": (samples[-1] if samples else 0.0) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="StateManager storage backend microbenchmark")
+    parser.add_argument("--backends", default=",".join(STORAGE_BACKENDS), help=f"Comma separated backends (default: {','.join(STORAGE_BACKENDS)})")
+    parser.add_argument("--ops", type=int, default=2000, help="increase() calls per backend (default: 2000)")
+    parser.add_argument("--threads", type=int, default=1, help="Concurrent writer threads (default: 1)")
+    parser.add_argument("--keys", type=int, default=1, help="Distinct counters the writes are spread over (default: 1)")
+    parser.add_argument("--shards", type=int, default=16, help="StateManager lock shards (default: 16)")
+    parser.add_argument("--dir", default=None, help="Directory for the state files; use the disk you deploy on (default: a temp dir)")
+    parser.add_argument("--wal-flush-interval", type=float, default=0.002, help="WAL group commit interval (default: 0.002)")
+    parser.add_argument("--wal-batch-size", type=int, default=256, help="WAL group commit batch size (default: 256)")
+    parser.add_argument("--json", dest="json_out", default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="storage_bench_")
+    os.makedirs(directory, exist_ok=True)
+    wal_options = {"flush_interval": args.wal_flush_interval, "batch_size": args.wal_batch_size}
+
+    results = []
+    try:
+        print(f"{'backend':<8} {'ops/sec':>10} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for name in args.backends.split(","):
+            result = run_backend(name.strip(), directory, args.ops, max(1, args.threads), max(1, args.keys), args.shards, wal_options)
+            results.append(result)
+            print(f"{result['backend']:<8} {result['ops_per_sec']:>10.0f} {result['p50_ms']:>9.3f} {result['p99_ms']:>9.3f} {result['max_ms']:>9.3f}")
+    finally:
+        if args.dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
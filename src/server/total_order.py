@@ -0,0 +1,415 @@
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from http.client import HTTPConnection
+from request_handler import CounterRequestHandler
+from common.metrics import metrics
+
+ORDERING_MODES = ("arrival", "sequencer")
+
+def _log(text, level="INFO"):
+    CounterRequestHandler.get_logger().log(text, level)
+
+def _timestamp():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+def _op_id(op):
+    # The de-duplication key of a client op
+    return op["client_id"], op.get("session"), op["request_num"]
+
+
+class SequencerOrdering:
+    """Total-order broadcast for active replication.
+
+    Clients still send every write to all replicas. The primary acts as the
+    sequencer: it gives each write it receives the next sequence number,
+    applies it, and streams the ordered writes (the ops themselves, not just
+    their ids) to the other replicas in batches, one POST /order per batch
+    and peer. Every replica applies strictly in sequence order, holding back
+    anything that arrives early, so all replicas see the same history no
+    matter how the clients' messages interleave. A replica answers the
+    client once the client's op has been applied there, i.e. after the
+    sequencer's batch reached it; the client's own copy only tells the
+    replica whom to answer.
+
+    Replicas acknowledge cumulatively (the highest sequence number applied),
+    and the sequencer resends everything after the acknowledged number, so a
+    lost batch or a replica that was briefly down simply catches up from the
+    sequencer's order log.
+
+    Sequence numbers continue across sequencers. A replica that becomes the
+    sequencer first takes the state of the peer that applied the most
+    (GET /snapshot) if that is further than itself, then starts a new epoch
+    numbered from there. Its batches name that starting point (`base`): a
+    replica exactly there joins the new epoch, any other one is sent a
+    snapshot of the sequencer's state instead, so the replicas cannot keep
+    different suffixes of the old epoch.
+
+    Ordered entries are applied by one applier thread, outside the lock, so
+    handlers waiting for their ops and the shippers are not held up by the
+    storage backend. Taking over (which fetches the peers' snapshots) runs
+    on its own thread as soon as the replica is made primary; writes that
+    reach the primary before it finished are refused at once, and the
+    client retries.
+    """
+
+    def __init__(self, state_manager, replica_id, peers, batch_interval=0.002, batch_size=512, timeout=2.0, log_size=100000):
+        self.state_manager = state_manager
+        self._replica_id = replica_id
+        self._peers = peers
+        self._batch_interval = float(batch_interval)
+        self._batch_size = int(batch_size)
+        self._timeout = float(timeout)
+        self._lock = threading.Lock()
+        # Signalled whenever something was applied (waiting handlers),
+        # ordered (shipper threads) or is ready to apply (the applier)
+        self._applied = threading.Condition(self._lock)
+        self._ordered = threading.Condition(self._lock)
+        self._ready = threading.Condition(self._lock)
+        # Held by the applier while it applies, and by anything that replaces
+        # the state or moves the order position; taken before _lock
+        self._apply_mutex = threading.Lock()
+        self._takeover_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        # Sequencer side: our epoch once we lead, and where it starts
+        self._epoch = None
+        self._base = None
+        self._next_seq = 1
+        self._log = deque(maxlen=log_size)
+        self._assigned = OrderedDict()   # (client_id, session, request_num) -> seq
+        # Replica side: next sequence number to apply, entries held back and
+        # entries the applier is applying right now
+        self._sequencer_epoch = None
+        self._apply_seq = 1
+        self._held = {}
+        self._in_flight = 0
+        # Client requests answered here, so a retry is reported as a duplicate
+        # (the order stream may apply an op before the client's copy arrives)
+        self._answered = OrderedDict()
+        self._wait_time = metrics.histogram("order_wait_seconds")
+        self._apply_time = metrics.histogram("order_apply_seconds")
+
+    def start(self):
+        thread = threading.Thread(target=self._apply_loop, name="order-applier", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        thread = threading.Thread(target=self._lead_loop, name="order-takeover", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        for replica_id, host, port in self._peers:
+            thread = threading.Thread(target=self._ship, args=(replica_id, host, int(port)), name=f"order-{replica_id}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            self._ordered.notify_all()
+            self._ready.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    def role_changed(self):
+        # Called when this replica was made primary, so the takeover starts
+        # now rather than at the next periodic check
+        with self._lock:
+            self._ordered.notify_all()
+
+    def applied_seq(self) -> int:
+        with self._lock:
+            return self._apply_seq - 1
+
+    def snapshot(self):
+        """State plus the order position it corresponds to, for a replica
+        recovering from this one: (values, version, dedup, epoch, applied_seq)."""
+        with self._apply_mutex, self._lock:
+            values, version = self.state_manager.snapshot()
+            return values, version, self.state_manager.dedup.export(), self._sequencer_epoch, self._apply_seq - 1
+
+    def resume(self, epoch, applied_seq):
+        # After installing a snapshot(): continue the order from where it was taken
+        with self._apply_mutex, self._lock:
+            self._move_to(epoch, applied_seq)
+
+    def _move_to(self, epoch, applied_seq):
+        # Jump to another order position (_apply_mutex and lock held)
+        self._sequencer_epoch = epoch
+        self._apply_seq = int(applied_seq) + 1
+        self._held.clear()
+        self._applied.notify_all()
+
+    def _leading(self) -> bool:
+        # Whether our own numbering is the one being applied (lock held)
+        return self._epoch is not None and self._sequencer_epoch == self._epoch
+
+    # ---- client writes -------------------------------------------------
+
+    def execute(self, ops: list):
+        """Order (on the sequencer) and wait for ops to be applied here.
+
+        Each op is {"op", "key", "client_id", "session", "request_num"}. Returns one
+        result per op like StateManager.apply_batch, or None if the ops were
+        not applied within the timeout (e.g. the sequencer never got them),
+        or right away on a primary that has not finished taking over.
+        """
+        start = time.perf_counter()
+        ids = [_op_id(op) for op in ops]
+        with self._lock:
+            if CounterRequestHandler.is_primary() and not self._leading():
+                self._ordered.notify_all()
+                return None
+            duplicate = [op_id in self._answered for op_id in ids]
+            if CounterRequestHandler.is_primary():
+                self._assign(ops)
+            deadline = time.monotonic() + self._timeout
+            while True:
+                replies = [self.state_manager.dedup.get(*op_id) for op_id in ids]
+                if all(reply is not None for reply in replies):
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._applied.wait(remaining)
+            for op_id in ids:
+                self._answered[op_id] = True
+            while len(self._answered) > self._log.maxlen:
+                self._answered.popitem(last=False)
+        self._wait_time.observe(time.perf_counter() - start)
+        return [{"ok": True, "key": reply.get("key"), "counter": reply["counter"], "request_num": rn, "duplicate": dup}
+                for reply, (_, _, rn), dup in zip(replies, ids, duplicate)]
+
+    def _assign(self, ops):
+        # Sequencer: order the ops not ordered before and hand them to the
+        # applier (lock held)
+        if not self._leading():
+            # Another sequencer's epoch reached us; the client retries
+            return
+        new_ops = []
+        for op in ops:
+            key = _op_id(op)
+            if key in self._assigned or self.state_manager.dedup.get(*key) is not None:
+                continue
+            new_ops.append(op)
+        if not new_ops:
+            return
+        entry = {"seq": self._next_seq, "ops": new_ops}
+        self._next_seq += 1
+        for op in new_ops:
+            self._assigned[_op_id(op)] = entry["seq"]
+        while len(self._assigned) > self._log.maxlen:
+            self._assigned.popitem(last=False)
+        self._log.append(entry)
+        self._held[entry["seq"]] = entry
+        self._apply_ready()
+        self._ordered.notify_all()
+
+    def _take_over(self):
+        """Start numbering writes as the sequencer, unless we already do.
+
+        First catch up with the peer that applied the most: everything it
+        applied may have been answered to clients, so the new epoch must
+        include it. Peers that do not answer are skipped."""
+        with self._lock:
+            if self._leading():
+                return
+        with self._takeover_lock:
+            with self._lock:
+                if self._leading():
+                    return
+            best = None
+            for replica_id, host, port in self._peers:
+                data = self._fetch_snapshot(replica_id, host, int(port))
+                order = (data or {}).get("order")
+                if order is not None and (best is None or int(order["applied"]) > int(best[1]["order"]["applied"])):
+                    best = (replica_id, data)
+            with self._apply_mutex:
+                with self._lock:
+                    behind = best is not None and int(best[1]["order"]["applied"]) > self._apply_seq - 1
+                if behind:
+                    replica_id, data = best
+                    self.state_manager.install_snapshot(data.get("state", {}), data.get("version", 0), data.get("dedup"))
+                    _log(f"\033[96m[{_timestamp()}] {self._replica_id}: caught up with {replica_id} at seq {data['order']['applied']} before taking over as the sequencer\033[0m")
+                with self._lock:
+                    if behind:
+                        self._move_to(best[1]["order"]["epoch"], best[1]["order"]["applied"])
+                    applied = self._apply_seq - 1
+                    self._base = {"epoch": self._sequencer_epoch, "applied": applied}
+                    self._epoch = f"{self._replica_id}-{time.time():.6f}"
+                    self._sequencer_epoch = self._epoch
+                    self._next_seq = applied + 1
+                    # Entries of an earlier term of ours were never applied
+                    self._log.clear()
+                    self._held.clear()
+                    self._assigned.clear()
+                    self._ordered.notify_all()
+            _log(f"\033[96m[{_timestamp()}] {self._replica_id}: now the sequencer (epoch {self._epoch}), numbering from seq {applied + 1}\033[0m")
+
+    def _lead_loop(self):
+        # Take over as the sequencer whenever we are primary but not leading
+        while not self._stop.is_set():
+            with self._lock:
+                while not self._stop.is_set() and not (CounterRequestHandler.is_primary() and not self._leading()):
+                    self._ordered.wait(1.0)
+            if self._stop.is_set():
+                break
+            self._take_over()
+
+    def _fetch_snapshot(self, replica_id, host, port):
+        conn = HTTPConnection(host, port, timeout=self._timeout)
+        try:
+            conn.request("GET", "/snapshot")
+            resp = conn.getresponse()
+            data = json.loads(resp.read() or b"{}")
+            return data if resp.status == 200 else None
+        except Exception as e:
+            _log(f"\033[93m[{_timestamp()}] {self._replica_id}: no order position from {replica_id} while taking over: {e}\033[0m", "WARN")
+            return None
+        finally:
+            conn.close()
+
+    # ---- replicas ------------------------------------------------------
+
+    def deliver(self, epoch, entries: list, base=None) -> int:
+        """Take a batch from the sequencer; returns the highest seq received
+        in order (see _hold), or -1 if this replica cannot join the batch's epoch at its `base` and
+        needs a snapshot (install())."""
+        with self._lock:
+            if epoch == self._sequencer_epoch:
+                return self._hold(entries)
+        with self._apply_mutex, self._lock:
+            if epoch != self._sequencer_epoch:
+                position = {"epoch": self._sequencer_epoch, "applied": self._apply_seq - 1}
+                if base != position:
+                    _log(f"\033[93m[{_timestamp()}] {self._replica_id}: new sequencer epoch {epoch} starts at {base}, this replica is at {position}; asking for a snapshot\033[0m", "WARN")
+                    return -1
+                self._sequencer_epoch = epoch
+                self._held.clear()
+            return self._hold(entries)
+
+    def install(self, epoch, snapshot: dict) -> int:
+        """Take the sequencer's state when deliver() could not continue;
+        returns the seq it corresponds to."""
+        with self._apply_mutex:
+            self.state_manager.install_snapshot(snapshot.get("state", {}), snapshot.get("version", 0), snapshot.get("dedup"))
+            with self._lock:
+                self._move_to(epoch, snapshot["applied"])
+                applied = self._apply_seq - 1
+        _log(f"\033[96m[{_timestamp()}] {self._replica_id}: installed the sequencer's snapshot at seq {applied} (epoch {epoch})\033[0m")
+        return applied
+
+    def _hold(self, entries):
+        # Queue a batch for the applier (lock held). Returns the highest seq
+        # received with nothing missing before it: the applier applies those
+        # in order, so the sequencer need not resend them.
+        received = self._apply_seq + self._in_flight
+        for entry in entries:
+            if entry["seq"] >= received:
+                self._held[entry["seq"]] = entry
+        self._apply_ready()
+        while received in self._held:
+            received += 1
+        return received - 1
+
+    def _apply_ready(self):
+        # Wake the applier if the next entry in sequence is here (lock held)
+        if self._apply_seq + self._in_flight in self._held:
+            self._ready.notify()
+
+    def _apply_loop(self):
+        # Apply held entries in sequence order; one apply_batch (one persist)
+        # for everything that is ready
+        while not self._stop.is_set():
+            with self._lock:
+                while not self._stop.is_set() and self._apply_seq not in self._held:
+                    self._ready.wait(1.0)
+            with self._apply_mutex:
+                with self._lock:
+                    seq = self._apply_seq
+                    entries = []
+                    while seq in self._held:
+                        entries.append(self._held.pop(seq))
+                        seq += 1
+                    self._in_flight = len(entries)
+                if not entries:
+                    continue
+                try:
+                    with self._apply_time.time():
+                        self.state_manager.apply_batch([op for entry in entries for op in entry["ops"]])
+                finally:
+                    with self._lock:
+                        self._in_flight = 0
+                        self._apply_seq = seq
+                        self._applied.notify_all()
+
+    # ---- sequencer to replicas -----------------------------------------
+
+    def _ship(self, replica_id, host, port):
+        conn = None
+        epoch = None
+        # -1 until the replica has joined our epoch: the first batch is sent
+        # even when empty, so replicas start serving without waiting for a write
+        acked = -1
+        resync = False
+        sent = metrics.counter("order_entries_sent_total", replica=replica_id)
+        snapshots = metrics.counter("order_snapshots_sent_total", replica=replica_id)
+        batch_sizes = metrics.histogram("order_batch_entries", replica=replica_id)
+        while not self._stop.is_set():
+            with self._lock:
+                while not self._stop.is_set() and not (CounterRequestHandler.is_primary() and self._leading() and (
+                        self._epoch != epoch or resync or self._next_seq - 1 > acked)):
+                    self._ordered.wait(1.0)
+            if self._stop.is_set():
+                break
+            # Let a batch build up before sending
+            if self._stop.wait(self._batch_interval):
+                break
+            with self._lock:
+                if self._epoch != epoch:
+                    epoch, acked, resync = self._epoch, -1, False
+                first = self._log[0]["seq"] if self._log else self._next_seq
+                if acked >= 0 and acked + 1 < first:
+                    # Behind our order log: only a snapshot can catch it up
+                    resync = True
+                start = 0 if acked < 0 else acked + 1 - first
+                entries = list(itertools.islice(self._log, start, start + self._batch_size))
+                base = self._base
+            if not entries and acked >= 0 and not resync:
+                continue
+            try:
+                if conn is None:
+                    conn = HTTPConnection(host, port, timeout=self._timeout)
+                if resync:
+                    values, version, dedup, snapshot_epoch, applied = self.snapshot()
+                    if snapshot_epoch != epoch:
+                        continue
+                    message = {"sequencer": self._replica_id, "epoch": epoch,
+                               "snapshot": {"state": values, "version": version, "dedup": dedup, "applied": applied}}
+                else:
+                    message = {"sequencer": self._replica_id, "epoch": epoch, "base": base, "entries": entries}
+                conn.request("POST", "/order", body=json.dumps(message), headers={"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                data = json.loads(resp.read() or b"{}")
+                if resp.status != 200:
+                    raise RuntimeError(f"status {resp.status}: {data}")
+                if data.get("needs_snapshot"):
+                    _log(f"\033[93m[{_timestamp()}] {self._replica_id}: {replica_id} cannot continue from seq {base['applied']}; sending it a snapshot\033[0m", "WARN")
+                    resync = True
+                    continue
+                if resync:
+                    snapshots.inc()
+                    resync = False
+                previous, acked = acked, int(data.get("applied", acked))
+                sent.inc(len(entries))
+                batch_sizes.observe(len(entries))
+                if entries and acked <= previous:
+                    # The replica did not get further; do not spin on it
+                    self._stop.wait(0.5)
+            except Exception as e:
+                _log(f"\033[93m[{_timestamp()}] {self._replica_id}: order batch to {replica_id} failed, will resend: {e}\033[0m", "WARN")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                self._stop.wait(0.5)
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+from common.metrics import metrics
+
+# Append-only write-ahead log with group commit.
+#
+# Writers append records to an in-memory batch and get back a log sequence
+# number (lsn). A single flusher thread writes the batch and fsyncs once,
+# after flush_interval seconds or as soon as batch_size records are waiting,
+# then wakes every writer whose lsn is now durable. Concurrent writes thus
+# share one fsync instead of paying one each.
+#
+# A failed write or fsync is sticky: the flusher stops, and every waiter
+# (and every later append) gets a WriteAheadLogError, since records past
+# the failure may or may not have reached the disk.
+class WriteAheadLogError(IOError):
+    pass
+
+
+class WriteAheadLog:
+    def __init__(self, path: str, flush_interval: float = 0.002, batch_size: int = 256):
+        self._path = path
+        self._flush_interval = float(flush_interval)
+        self._batch_size = int(batch_size)
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        # Serializes file writes with truncation
+        self._io_lock = threading.Lock()
+        self._pending = []
+        self._appended = 0
+        self._durable = 0
+        # lsn a flush() caller is waiting for; the flusher stops filling the batch
+        self._flush_through = 0
+        self._closed = False
+        self._error = None
+        self._file = open(self._path, "a", encoding="utf-8")
+        self._fsync_time = metrics.histogram("wal_fsync_seconds")
+        self._batch_records = metrics.counter("wal_records_total")
+        self._batches = metrics.counter("wal_fsyncs_total")
+        self._thread = threading.Thread(target=self._run, name="wal-flusher", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def read(path: str) -> list:
+        # Records in log order; stops at a torn or corrupt tail line
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+        return records
+
+    def _check_error_locked(self):
+        if self._error is not None:
+            raise WriteAheadLogError(f"write-ahead log {self._path} failed: {self._error}") from self._error
+
+    def append(self, record: dict) -> int:
+        with self._lock:
+            self._check_error_locked()
+            self._pending.append(json.dumps(record) + "\n")
+            self._appended += 1
+            if len(self._pending) == 1 or len(self._pending) >= self._batch_size:
+                self._has_work.notify()
+            return self._appended
+
+    def wait_durable(self, lsn: int):
+        with self._lock:
+            while self._durable < lsn and not self._closed and self._error is None:
+                self._flushed.wait()
+            if self._durable < lsn:
+                self._check_error_locked()
+
+    def flush(self):
+        # Block until everything appended so far is on disk
+        with self._lock:
+            lsn = self._appended
+            self._flush_through = max(self._flush_through, lsn)
+            self._has_work.notify()
+        self.wait_durable(lsn)
+
+    def truncate_through(self, version: int):
+        """Drop records with version <= `version` (they are in a snapshot now).
+
+        Records written after the snapshot was taken are kept, so this is
+        safe to call while writers keep appending.
+        """
+        with self._io_lock:
+            self._file.flush()
+            keep = [r for r in self.read(self._path) if r.get("version", 0) > version]
+            tmp = f"{self._path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for record in keep:
+                    f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp, self._path)
+            self._file = open(self._path, "a", encoding="utf-8")
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._closed = True
+                self._has_work.notify()
+                self._flushed.notify_all()
+            self._thread.join(timeout=1.0)
+            try:
+                self._file.close()
+            except OSError:
+                pass
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closed:
+                    self._has_work.wait()
+                if self._closed and not self._pending:
+                    return
+                # Let the batch fill up for at most flush_interval
+                deadline = time.monotonic() + self._flush_interval
+                while len(self._pending) < self._batch_size and not self._closed and self._flush_through <= self._durable:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._has_work.wait(remaining)
+                batch, self._pending = self._pending, []
+                lsn = self._appended
+
+            try:
+                with self._io_lock, self._fsync_time.time():
+                    self._file.write("".join(batch))
+                    self._file.flush()
+                    os.fsync(self._file.fileno())
+            except (OSError, ValueError) as e:
+                with self._lock:
+                    self._error = e
+                    self._flushed.notify_all()
+                return
+            self._batches.inc()
+            self._batch_records.inc(len(batch))
+
+            with self._lock:
+                self._durable = lsn
+                self._flushed.notify_all()
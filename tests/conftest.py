@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The scripts import their neighbours flat (run from their own directory),
+# so put every source directory on the path the same way.
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+for path in (SRC, os.path.join(SRC, "server"), os.path.join(SRC, "client")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def server_log(tmp_path, monkeypatch):
+    # The replication modules log through CounterRequestHandler; keep their
+    # lines out of logs/ and off the console
+    from common.logger import AsyncLogger
+    from request_handler import CounterRequestHandler
+
+    monkeypatch.setattr(CounterRequestHandler, "logger", AsyncLogger(str(tmp_path / "server.log"), console=False))
+
+
+@pytest.fixture
+def fake_peer():
+    """Start a replica stand-in: fake_peer(reply) -> (host, port).
+
+    reply(method, path, body) returns (status, payload) for every request;
+    body is the decoded JSON body or None.
+    """
+    servers = []
+
+    def start(reply):
+        class Handler(BaseHTTPRequestHandler):
+            def _answer(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length)) if length else None
+                status, payload = reply(self.command, self.path, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _answer
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server.server_address
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,75 @@
+from chain import ChainReplicator
+from state_manager import StateManager
+
+
+def _successor(fake_peer, tail_lag=0):
+    # A chain member that applies what it is sent; its tail is tail_lag
+    # versions behind it
+    received = []
+
+    def reply(method, path, body):
+        received.append(body)
+        if body["mode"] == "full":
+            version = body["version"]
+        else:
+            version = body["ops"][-1]["version"] if body["ops"] else body["base_version"]
+        return 200, {"ok": True, "version": version, "tail_version": max(0, version - tail_lag)}
+
+    host, port = fake_peer(reply)
+    return ("S2", host, port), received
+
+
+def test_the_tail_holds_what_it_applied(server_log):
+    state = StateManager()
+    chain = ChainReplicator(state, "S3")
+    state.increase()
+    assert chain.is_tail()
+    assert chain.tail_version() == 1
+    assert chain.wait_replicated(1) == 1
+
+
+def test_the_head_waits_for_the_tail_version_its_successor_reports(server_log, fake_peer):
+    successor, received = _successor(fake_peer)
+    state = StateManager()
+    chain = ChainReplicator(state, "S1", successor, timeout=2.0)
+    chain.start()
+    try:
+        state.increase()
+        chain.notify()
+        assert chain.wait_replicated(1) == 1
+        state.increase()
+        state.increase()
+        chain.notify()
+        assert chain.wait_replicated(3) == 3
+        # The whole state first, then every later op exactly once
+        assert received[0]["mode"] == "full"
+        shipped = [op["version"] for body in received[1:] for op in body["ops"]]
+        assert shipped == list(range(received[0]["version"] + 1, 4))
+        assert chain.tail_version() == 3
+    finally:
+        chain.stop()
+
+
+def test_a_write_the_tail_does_not_hold_times_out_with_the_tails_version(server_log, fake_peer):
+    successor, _ = _successor(fake_peer, tail_lag=1)
+    state = StateManager()
+    chain = ChainReplicator(state, "S1", successor, timeout=0.3)
+    chain.start()
+    try:
+        state.increase()
+        state.increase()
+        chain.notify()
+        assert chain.wait_replicated(2) == 1
+    finally:
+        chain.stop()
+
+
+def test_reconfiguring_to_the_tail_stops_waiting_for_acks(server_log, fake_peer):
+    successor, _ = _successor(fake_peer, tail_lag=5)
+    state = StateManager()
+    chain = ChainReplicator(state, "S2", successor, timeout=2.0)
+    state.increase()
+    # The successor failed and was removed: we are the tail now
+    chain.configure(None)
+    assert chain.is_tail()
+    assert chain.wait_replicated(1) == 1
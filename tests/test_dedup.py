@@ -0,0 +1,98 @@
+import time
+
+from dedup import DedupTable
+
+
+def test_get_returns_the_reply_that_was_put():
+    table = DedupTable()
+    table.put("C1", "s1", 1, {"op": "increase", "counter": 5})
+    assert table.get("C1", "s1", 1) == {"op": "increase", "counter": 5}
+    assert table.get("C1", "s1", 2) is None
+    assert table.get("C2", "s1", 1) is None
+
+
+def test_a_new_session_of_the_same_client_is_not_a_duplicate():
+    # A restarted client numbers its requests from 1 again
+    table = DedupTable()
+    table.put("C1", "old", 1, {"op": "increase", "counter": 5})
+    assert table.get("C1", "new", 1) is None
+    assert table.get("C1", "old", 1)["counter"] == 5
+
+
+def test_missing_ids_are_never_duplicates():
+    table = DedupTable()
+    table.put(None, "s1", 1, {"counter": 1})
+    table.put("C1", "s1", None, {"counter": 1})
+    assert len(table) == 0
+    assert table.get(None, "s1", 1) is None
+
+
+def test_an_entry_for_another_op_is_not_a_duplicate():
+    table = DedupTable()
+    table.put("C1", "s1", 1, {"op": "increase", "counter": 5})
+    assert table.get("C1", "s1", 1, "decrease") is None
+    assert table.get("C1", "s1", 1, "increase")["counter"] == 5
+
+
+def test_least_recently_used_entry_is_evicted_at_capacity():
+    table = DedupTable(capacity=2)
+    table.put("C1", "s1", 1, {"counter": 1})
+    table.put("C1", "s1", 2, {"counter": 2})
+    # Reading request 1 makes request 2 the least recently used
+    assert table.get("C1", "s1", 1) is not None
+    table.put("C1", "s1", 3, {"counter": 3})
+    assert len(table) == 2
+    assert table.get("C1", "s1", 2) is None
+    assert table.get("C1", "s1", 1) is not None
+    assert table.get("C1", "s1", 3) is not None
+
+
+def test_expired_entries_are_ignored_and_dropped():
+    table = DedupTable(ttl=10.0)
+    table.put("C1", "s1", 1, {"counter": 1}, inserted_at=time.monotonic() - 11.0)
+    table.put("C1", "s1", 2, {"counter": 2})
+    assert table.get("C1", "s1", 1) is None
+    assert len(table) == 1
+    assert table.get("C1", "s1", 2) is not None
+
+
+def test_export_and_load_keep_entries_and_their_age():
+    table = DedupTable(ttl=10.0)
+    table.put("C1", "s1", 1, {"counter": 1}, inserted_at=time.monotonic() - 8.0)
+    table.put("C2", "s2", 7, {"counter": 2})
+    table.put("C3", "s3", 1, {"counter": 3}, inserted_at=time.monotonic() - 20.0)
+    exported = table.export()
+    # Expired entries are not shipped
+    assert sorted((e[0], e[1], e[2]) for e in exported) == [("C1", "s1", 1), ("C2", "s2", 7)]
+
+    other = DedupTable(ttl=10.0)
+    other.put("C9", "s9", 1, {"counter": 9})
+    other.load(exported)
+    assert other.get("C9", "s9", 1) is None
+    assert other.get("C2", "s2", 7) == {"counter": 2}
+    assert other.get("C1", "s1", 1) == {"counter": 1}
+    # The loaded entry kept its age: it runs out after the remaining 2 seconds
+    aged = [e for e in other.export() if e[0] == "C1"][0]
+    assert aged[4] >= 8.0
+
+
+def test_load_respects_capacity():
+    table = DedupTable(capacity=3)
+    table.load([["C1", "s1", n, {"counter": n}, 0.0] for n in range(1, 6)])
+    assert len(table) == 3
+    assert table.get("C1", "s1", 1) is None
+    assert table.get("C1", "s1", 5) is not None
+
+
+def test_state_manager_applies_a_restarted_clients_requests():
+    from state_manager import StateManager
+
+    state = StateManager()
+    assert state.apply_client_op("increase", "C1", 1, session="first") == (1, False)
+    assert state.apply_client_op("increase", "C1", 1, session="first") == (1, True)
+    # Same client id and request number, new incarnation
+    assert state.apply_client_op("increase", "C1", 1, session="second") == (2, False)
+    results = state.apply_batch([{"op": "increase", "client_id": "C1", "session": "second", "request_num": 1},
+                                 {"op": "increase", "client_id": "C1", "session": "third", "request_num": 1}])
+    assert [r.get("duplicate", False) for r in results] == [True, False]
+    assert state.get() == 3
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from lease import LeaseKeeper
+from request_handler import CounterRequestHandler, Role
+
+
+@pytest.fixture
+def primary(monkeypatch, server_log):
+    monkeypatch.setattr(CounterRequestHandler, "role", Role.PRIMARY)
+
+
+def _keeper(monkeypatch, replies):
+    # Answers POST /lease with the given replies in turn, then keeps denying
+    keeper = LeaseKeeper("S1", "127.0.0.1", 1)
+    replies = list(replies)
+    monkeypatch.setattr(keeper, "_request", lambda: replies.pop(0) if replies else (409, {"granted": False, "retry_after": 0.05}))
+    return keeper
+
+
+def _wait_for(condition, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_the_lease_is_shortened_by_the_drift_bound_and_expires(monkeypatch, primary):
+    keeper = _keeper(monkeypatch, [(200, {"granted": True, "duration": 0.5, "drift": 0.2, "epoch": 1})])
+    keeper.start()
+    try:
+        assert _wait_for(keeper.valid)
+        # Counted from when the request was sent: at most 0.5 * (1 - 0.2)
+        assert 0.3 < keeper.remaining() <= 0.4
+        assert keeper.epoch() == 1
+        # Renewals are denied from here on, so it runs out
+        assert _wait_for(lambda: not keeper.valid())
+        assert keeper.remaining() == 0.0
+    finally:
+        keeper.stop()
+
+
+def test_a_denied_lease_is_never_valid(monkeypatch, primary):
+    keeper = _keeper(monkeypatch, [])
+    keeper.start()
+    try:
+        time.sleep(0.1)
+        assert not keeper.valid()
+    finally:
+        keeper.stop()
+
+
+def test_demotion_drops_the_lease_at_once(monkeypatch, primary):
+    keeper = _keeper(monkeypatch, [(200, {"granted": True, "duration": 30.0, "drift": 0.01, "epoch": 1})])
+    keeper.start()
+    try:
+        assert _wait_for(keeper.valid)
+        monkeypatch.setattr(CounterRequestHandler, "role", Role.BACKUP)
+        keeper.drop()
+        assert not keeper.valid()
+        # The renewal thread does not bring it back while we are a backup
+        time.sleep(0.1)
+        assert not keeper.valid()
+    finally:
+        keeper.stop()
+
+
+def test_a_grant_that_arrives_after_demotion_is_ignored(monkeypatch, server_log):
+    monkeypatch.setattr(CounterRequestHandler, "role", Role.PRIMARY)
+
+    def demoted_while_in_flight():
+        monkeypatch.setattr(CounterRequestHandler, "role", Role.BACKUP)
+        return 200, {"granted": True, "duration": 30.0, "drift": 0.01, "epoch": 2}
+
+    keeper = LeaseKeeper("S1", "127.0.0.1", 1)
+    monkeypatch.setattr(keeper, "_request", demoted_while_in_flight)
+    keeper.start()
+    try:
+        time.sleep(0.1)
+        assert not keeper.valid()
+    finally:
+        keeper.stop()
@@ -0,0 +1,93 @@
+import time
+
+from log_shipping import LogShipper
+from request_handler import CounterRequestHandler, Role
+from state_manager import StateManager
+
+BACKUPS = [("S2", "127.0.0.1", 1), ("S3", "127.0.0.1", 2)]
+
+
+def _shipper(sync_acks, acked, version=5, timeout=0.2):
+    state = StateManager()
+    for _ in range(version):
+        state.increase()
+    shipper = LogShipper(state, "S1", BACKUPS, sync_acks=sync_acks, timeout=timeout)
+    shipper._acked.update(acked)
+    return shipper
+
+
+def test_asynchronous_replication_does_not_wait_for_backups():
+    shipper = _shipper(0, {})
+    assert shipper.wait_replicated(5) == 5
+
+
+def test_one_ack_is_the_furthest_backup():
+    shipper = _shipper(1, {"S2": 3, "S3": 5})
+    assert shipper.wait_replicated(5) == 5
+
+
+def test_two_acks_wait_for_the_slower_backup():
+    shipper = _shipper(2, {"S2": 3, "S3": 5})
+    start = time.monotonic()
+    assert shipper.wait_replicated(5) == 3
+    assert time.monotonic() - start >= 0.2
+    assert shipper.wait_replicated(3) == 3
+
+
+def test_too_few_acking_backups_hold_nothing():
+    shipper = _shipper(2, {"S3": 5})
+    assert shipper.wait_replicated(1) == 0
+
+
+def test_sync_acks_is_capped_at_the_number_of_backups():
+    shipper = _shipper(5, {"S2": 4, "S3": 5})
+    assert shipper.wait_replicated(4) == 4
+
+
+def _stream(fake_peer, sync_acks, timeout):
+    # One backup that applies everything it is sent, one that is down
+    received = []
+
+    def backup(method, path, body):
+        received.append(body["mode"])
+        if body["mode"] == "full":
+            version = body["version"]
+        else:
+            version = body["ops"][-1]["version"] if body["ops"] else body["base_version"]
+        return 200, {"ok": True, "version": version}
+
+    def down(method, path, body):
+        return 503, {"error": "not serving"}
+
+    backups = [("S2", *fake_peer(backup)), ("S3", *fake_peer(down))]
+    return LogShipper(StateManager(), "S1", backups, sync_acks=sync_acks, timeout=timeout), received
+
+
+def test_acks_from_the_stream_release_writes(monkeypatch, server_log, fake_peer):
+    monkeypatch.setattr(CounterRequestHandler, "role", Role.PRIMARY)
+    shipper, received = _stream(fake_peer, sync_acks=1, timeout=2.0)
+    shipper.start()
+    try:
+        shipper.state_manager.increase()
+        shipper.notify()
+        assert shipper.wait_replicated(1) == 1
+        shipper.state_manager.increase()
+        shipper.notify()
+        assert shipper.wait_replicated(2) == 2
+        # The first batch carries the whole state, later ones only the new ops
+        assert received[0] == "full" and "delta" in received
+        assert shipper.acked_versions() == {"S2": 2}
+    finally:
+        shipper.stop()
+
+
+def test_a_write_is_not_released_while_a_required_backup_is_down(monkeypatch, server_log, fake_peer):
+    monkeypatch.setattr(CounterRequestHandler, "role", Role.PRIMARY)
+    shipper, _ = _stream(fake_peer, sync_acks=2, timeout=0.3)
+    shipper.start()
+    try:
+        shipper.state_manager.increase()
+        shipper.notify()
+        assert shipper.wait_replicated(1) == 0
+    finally:
+        shipper.stop()
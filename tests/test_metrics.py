@@ -0,0 +1,96 @@
+import pytest
+
+from common.metrics import MAX_BUCKETS, SUB_BUCKETS, Histogram, MetricsRegistry, _bucket_index, _bucket_value
+
+
+def test_small_values_get_exact_buckets():
+    for micros in range(SUB_BUCKETS):
+        assert _bucket_index(micros) == micros
+        assert _bucket_value(micros) == micros
+
+
+def test_bucket_index_is_monotonic_and_values_fall_in_their_bucket():
+    previous = -1
+    for micros in list(range(0, 5000)) + [10 ** k for k in range(4, 10)]:
+        index = _bucket_index(micros)
+        assert previous <= index < MAX_BUCKETS
+        previous = index
+        # The bucket's representative value is within ~3% (half a sub-bucket)
+        assert _bucket_value(index) == pytest.approx(micros, rel=1 / 32, abs=0.5)
+
+
+def test_bucket_width_doubles_every_power_of_two():
+    # 16..31 one microsecond each, 32..63 two each, 64..127 four each
+    assert _bucket_index(31) - _bucket_index(16) == 15
+    assert _bucket_index(32) == _bucket_index(33) != _bucket_index(34)
+    assert len({_bucket_index(m) for m in range(64, 128)}) == SUB_BUCKETS
+
+
+def test_huge_values_land_in_the_last_bucket():
+    assert _bucket_index(1 << 60) == MAX_BUCKETS - 1
+
+
+def test_empty_histogram_reports_zeros():
+    histogram = Histogram()
+    assert histogram.percentile(99) == 0.0
+    assert histogram.snapshot() == {"count": 0, "sum": 0.0, "min": 0.0, "max": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0}
+
+
+def test_percentiles_of_a_uniform_distribution():
+    histogram = Histogram()
+    for ms in range(1, 1001):
+        histogram.observe(ms / 1000.0)
+    assert histogram.count == 1000
+    assert histogram.total == pytest.approx(500.5)
+    assert histogram.percentile(50) == pytest.approx(0.500, rel=0.06)
+    assert histogram.percentile(90) == pytest.approx(0.900, rel=0.06)
+    assert histogram.percentile(99) == pytest.approx(0.990, rel=0.06)
+    assert histogram.percentile(100) == pytest.approx(1.0, rel=0.06)
+
+
+def test_percentiles_are_clamped_to_the_observed_range():
+    histogram = Histogram()
+    histogram.observe(0.0123)
+    assert histogram.percentile(0) == 0.0123
+    assert histogram.percentile(50) == 0.0123
+    assert histogram.percentile(99.99) == 0.0123
+
+
+def test_tail_percentiles_see_rare_slow_observations():
+    histogram = Histogram()
+    for _ in range(9990):
+        histogram.observe(0.001)
+    for _ in range(10):
+        histogram.observe(0.5)
+    assert histogram.percentile(99) == pytest.approx(0.001, rel=0.06)
+    assert histogram.percentile(99.95) == pytest.approx(0.5, rel=0.06)
+    assert histogram.max == 0.5
+
+
+def test_merge_combines_counts_and_range():
+    fast, slow = Histogram(), Histogram()
+    for _ in range(50):
+        fast.observe(0.001)
+    for _ in range(50):
+        slow.observe(0.1)
+    fast.merge(slow)
+    assert fast.count == 100
+    assert fast.min == 0.001 and fast.max == 0.1
+    assert fast.percentile(25) == pytest.approx(0.001, rel=0.06)
+    assert fast.percentile(75) == pytest.approx(0.1, rel=0.06)
+    # The merged-in histogram is left as it was
+    assert slow.count == 50
+
+
+def test_snapshot_names_percentiles_compactly():
+    histogram = Histogram()
+    histogram.observe(0.002)
+    assert set(histogram.snapshot((50, 99.9))) == {"count", "sum", "min", "max", "p50", "p99.9"}
+
+
+def test_registry_returns_one_metric_per_name_and_labels():
+    registry = MetricsRegistry()
+    assert registry.histogram("latency", endpoint="/get") is registry.histogram("latency", endpoint="/get")
+    assert registry.histogram("latency", endpoint="/get") is not registry.histogram("latency", endpoint="/increase")
+    registry.counter("requests", endpoint="/get").inc(3)
+    assert registry.snapshot()["counters"] == {"requests{endpoint=/get}": 3}
@@ -0,0 +1,76 @@
+import pytest
+
+from partitioned_client import ConsistentHashRing
+
+KEYS = [f"k{i}" for i in range(20000)]
+
+
+def _ring(*groups, vnodes=128):
+    ring = ConsistentHashRing(vnodes)
+    for group_id in groups:
+        ring.add(group_id)
+    return ring
+
+
+def test_empty_ring_has_no_owner():
+    with pytest.raises(LookupError):
+        ConsistentHashRing().lookup("k0")
+
+
+def test_single_group_owns_every_key():
+    ring = _ring("G1")
+    assert {ring.lookup(key) for key in KEYS[:100]} == {"G1"}
+    assert ring.ownership() == {"G1": pytest.approx(1.0)}
+
+
+def test_lookup_does_not_depend_on_insertion_order():
+    forward, backward = _ring("G1", "G2", "G3"), _ring("G3", "G2", "G1")
+    assert all(forward.lookup(key) == backward.lookup(key) for key in KEYS[:2000])
+
+
+def test_adding_a_group_twice_changes_nothing():
+    ring = _ring("G1", "G2")
+    before = [ring.lookup(key) for key in KEYS[:2000]]
+    ring.add("G2")
+    assert len(ring) == 2
+    assert [ring.lookup(key) for key in KEYS[:2000]] == before
+
+
+def test_keys_are_spread_evenly():
+    ring = _ring("G1", "G2", "G3", "G4")
+    counts = {group_id: 0 for group_id in ("G1", "G2", "G3", "G4")}
+    for key in KEYS:
+        counts[ring.lookup(key)] += 1
+    for count in counts.values():
+        assert count == pytest.approx(len(KEYS) / 4, rel=0.25)
+    assert sum(ring.ownership().values()) == pytest.approx(1.0)
+
+
+def test_adding_a_group_moves_only_keys_to_it():
+    ring = _ring("G1", "G2", "G3")
+    before = {key: ring.lookup(key) for key in KEYS}
+    ring.add("G4")
+    moved = [key for key in KEYS if ring.lookup(key) != before[key]]
+    # Every moved key went to the new group, and about 1/(n+1) of them moved
+    assert {ring.lookup(key) for key in moved} == {"G4"}
+    assert len(moved) / len(KEYS) == pytest.approx(1 / 4, rel=0.25)
+
+
+def test_removing_a_group_restores_the_previous_owners():
+    ring = _ring("G1", "G2", "G3")
+    before = {key: ring.lookup(key) for key in KEYS}
+    ring.add("G4")
+    ring.remove("G4")
+    assert "G4" not in ring
+    assert all(ring.lookup(key) == before[key] for key in KEYS)
+
+
+def test_removing_a_group_moves_only_its_keys():
+    ring = _ring("G1", "G2", "G3")
+    before = {key: ring.lookup(key) for key in KEYS}
+    ring.remove("G2")
+    for key in KEYS:
+        if before[key] == "G2":
+            assert ring.lookup(key) in ("G1", "G3")
+        else:
+            assert ring.lookup(key) == before[key]
@@ -0,0 +1,68 @@
+import time
+
+from recovery import StateRecovery
+from state_manager import StateManager
+
+PEERS = [("S1", "127.0.0.1", 1), ("S2", "127.0.0.1", 2)]
+
+
+def _recovery(monkeypatch, replies, **options):
+    # replies: port -> list of (status, data) answered in turn; a port with
+    # no replies left does not answer
+    state = StateManager()
+    recovery = StateRecovery(state, "S3", PEERS, timeout=0.3, **options)
+
+    def fetch(host, port, since=None):
+        if not replies.get(port):
+            raise ConnectionRefusedError("connection refused")
+        return replies[port].pop(0)
+    monkeypatch.setattr(recovery, "_fetch", fetch)
+    return recovery
+
+
+def _full(values, version, primary, dedup=()):
+    return 200, {"mode": "full", "state": values, "version": version, "dedup": list(dedup), "order": None, "primary": primary}
+
+
+def _delta(base, ops):
+    return 200, {"mode": "delta", "base_version": base, "version": ops[-1]["version"] if ops else base, "ops": ops}
+
+
+def test_recovers_from_the_primary_and_replays_what_it_applied_since(monkeypatch, server_log):
+    ops = [{"op": "increase", "key": "a", "version": 4}, {"op": "increase", "key": "a", "version": 5}]
+    recovery = _recovery(monkeypatch, {
+        1: [_full({"a": 2}, 2, primary=False)],
+        2: [_full({"a": 3}, 3, primary=True), _delta(3, ops), _delta(5, [])],
+    })
+    assert recovery.run(time.monotonic())
+    assert recovery.state_manager.snapshot() == ({"a": 5}, 5)
+    assert recovery.result["source"] == "S2"
+    assert recovery.result["replayed_ops"] == 2
+
+
+def test_takes_a_backup_when_the_primary_does_not_answer(monkeypatch, server_log):
+    recovery = _recovery(monkeypatch, {2: [_full({"a": 7}, 7, primary=False)]})
+    assert recovery.run(time.monotonic())
+    assert recovery.state_manager.snapshot() == ({"a": 7}, 7)
+    assert recovery.result["source"] == "S2"
+
+
+def test_the_snapshot_brings_the_dedup_table(monkeypatch, server_log):
+    reply = {"op": "increase", "key": "a", "counter": 1}
+    recovery = _recovery(monkeypatch, {1: [_full({"a": 1}, 1, primary=True, dedup=[["C1", "s", 1, reply, 0.0]])]})
+    assert recovery.run(time.monotonic())
+    assert recovery.state_manager.apply_client_op("increase", "C1", 1, key="a", session="s") == (1, True)
+
+
+def test_gives_up_when_no_peer_answers_in_time(monkeypatch, server_log):
+    recovery = _recovery(monkeypatch, {})
+    start = time.monotonic()
+    assert not recovery.run(start)
+    assert time.monotonic() - start >= 0.3
+    assert recovery.result is None
+
+
+def test_prefer_limits_recovery_to_one_peer(monkeypatch, server_log):
+    recovery = _recovery(monkeypatch, {1: [_full({"a": 9}, 9, primary=True)], 2: [_full({"a": 4}, 4, primary=False)]}, prefer="S2")
+    assert recovery.run(time.monotonic())
+    assert recovery.state_manager.snapshot() == ({"a": 4}, 4)
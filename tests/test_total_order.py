@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+from request_handler import CounterRequestHandler, Role
+from state_manager import StateManager
+from total_order import SequencerOrdering
+
+PEERS = [("S1", "127.0.0.1", 1), ("S3", "127.0.0.1", 2)]
+
+
+@pytest.fixture
+def primary(monkeypatch, server_log):
+    monkeypatch.setattr(CounterRequestHandler, "role", Role.PRIMARY)
+
+
+def _ordering(monkeypatch, snapshots):
+    # snapshots: replica_id -> its /snapshot reply (missing: did not answer)
+    ordering = SequencerOrdering(StateManager(), "S2", PEERS, timeout=0.5)
+    monkeypatch.setattr(ordering, "_fetch_snapshot", lambda replica_id, host, port: snapshots.get(replica_id))
+    return ordering
+
+
+def _snapshot(values, version, epoch, applied):
+    return {"state": values, "version": version, "dedup": [], "order": {"epoch": epoch, "applied": applied}}
+
+
+def _op(request_num, key="a"):
+    return {"op": "increase", "key": key, "client_id": "C1", "session": "s", "request_num": request_num}
+
+
+def test_takeover_installs_the_most_advanced_peers_state(monkeypatch, primary):
+    ordering = _ordering(monkeypatch, {"S1": _snapshot({"a": 3}, 3, "S1-1", 3), "S3": _snapshot({"a": 5}, 5, "S1-1", 5)})
+    ordering._take_over()
+    assert ordering.state_manager.snapshot() == ({"a": 5}, 5)
+    assert ordering.applied_seq() == 5
+    # The new epoch numbers on from the peer's position and names it as its base
+    assert ordering._base == {"epoch": "S1-1", "applied": 5}
+    assert ordering._next_seq == 6
+    assert ordering._epoch.startswith("S2-")
+
+
+def test_takeover_keeps_its_own_state_when_no_peer_is_further(monkeypatch, primary):
+    ordering = _ordering(monkeypatch, {"S1": _snapshot({"a": 1}, 1, "S1-1", 1)})
+    ordering.install("S1-1", {"state": {"a": 2}, "version": 2, "dedup": [], "applied": 2})
+    ordering._take_over()
+    assert ordering.state_manager.snapshot() == ({"a": 2}, 2)
+    assert ordering._base == {"epoch": "S1-1", "applied": 2}
+    assert ordering._next_seq == 3
+
+
+def test_takeover_skips_peers_that_do_not_answer(monkeypatch, primary):
+    ordering = _ordering(monkeypatch, {})
+    ordering._take_over()
+    assert ordering._base == {"epoch": None, "applied": 0}
+    assert ordering._next_seq == 1
+
+
+def test_a_replica_at_another_position_asks_for_a_snapshot(server_log):
+    ordering = SequencerOrdering(StateManager(), "S3", PEERS)
+    assert ordering.deliver("S1-1", [], base={"epoch": None, "applied": 0}) == 0
+    # The next sequencer starts from seq 4 of the old epoch, which we never saw
+    assert ordering.deliver("S2-2", [{"seq": 5, "ops": [_op(5)]}], base={"epoch": "S1-1", "applied": 4}) == -1
+    assert ordering.install("S2-2", {"state": {"a": 4}, "version": 4, "dedup": [], "applied": 4}) == 4
+    assert ordering.deliver("S2-2", [{"seq": 5, "ops": [_op(5)]}], base={"epoch": "S1-1", "applied": 4}) == 5
+
+
+def test_a_primary_that_has_not_taken_over_refuses_writes_at_once(primary):
+    ordering = SequencerOrdering(StateManager(), "S2", [], timeout=0.5)
+    start = time.monotonic()
+    assert ordering.execute([_op(1)]) is None
+    assert time.monotonic() - start < 0.1
+    # The takeover thread catches up and the retry is ordered
+    ordering.start()
+    try:
+        deadline = time.monotonic() + 2.0
+        results = None
+        while results is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+            results = ordering.execute([_op(1)])
+        assert results[0]["counter"] == 1
+    finally:
+        ordering.stop()
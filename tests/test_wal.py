@@ -0,0 +1,106 @@
+import json
+import threading
+
+import pytest
+
+from common.metrics import metrics
+from wal import WriteAheadLog, WriteAheadLogError
+
+
+def _wal(tmp_path, **options):
+    return WriteAheadLog(str(tmp_path / "state.wal"), **options)
+
+
+def test_append_returns_increasing_lsns_and_records_are_read_in_order(tmp_path):
+    wal = _wal(tmp_path)
+    lsns = [wal.append({"version": v, "op": "increase"}) for v in range(1, 6)]
+    assert lsns == [1, 2, 3, 4, 5]
+    wal.wait_durable(lsns[-1])
+    wal.close()
+    assert [r["version"] for r in WriteAheadLog.read(str(tmp_path / "state.wal"))] == [1, 2, 3, 4, 5]
+
+
+def test_wait_durable_returns_once_the_record_is_on_disk(tmp_path):
+    wal = _wal(tmp_path, flush_interval=0.01)
+    lsn = wal.append({"version": 1})
+    wal.wait_durable(lsn)
+    # Durable means written and fsynced: a fresh reader sees it
+    assert WriteAheadLog.read(str(tmp_path / "state.wal")) == [{"version": 1}]
+    wal.close()
+
+
+def test_concurrent_writers_share_fsyncs(tmp_path):
+    wal = _wal(tmp_path, flush_interval=0.05, batch_size=1000)
+    fsyncs = metrics.counter("wal_fsyncs_total")
+    before = fsyncs.value
+    writers = 50
+    start = threading.Barrier(writers)
+
+    def writer(version):
+        start.wait()
+        wal.wait_durable(wal.append({"version": version}))
+
+    threads = [threading.Thread(target=writer, args=(v,)) for v in range(1, writers + 1)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wal.close()
+    assert fsyncs.value - before < writers
+    assert sorted(r["version"] for r in WriteAheadLog.read(str(tmp_path / "state.wal"))) == list(range(1, writers + 1))
+
+
+def test_full_batch_is_flushed_without_waiting_for_the_interval(tmp_path):
+    wal = _wal(tmp_path, flush_interval=30.0, batch_size=4)
+    lsn = 0
+    for v in range(1, 5):
+        lsn = wal.append({"version": v})
+    done = threading.Event()
+    threading.Thread(target=lambda: (wal.wait_durable(lsn), done.set()), daemon=True).start()
+    assert done.wait(5.0)
+    wal.close()
+
+
+def test_read_stops_at_a_torn_tail(tmp_path):
+    path = tmp_path / "state.wal"
+    path.write_text(json.dumps({"version": 1}) + "\n" + json.dumps({"version": 2}) + "\n" + '{"version": 3, "op"', encoding="utf-8")
+    assert WriteAheadLog.read(str(path)) == [{"version": 1}, {"version": 2}]
+
+
+def test_read_of_a_missing_log_is_empty(tmp_path):
+    assert WriteAheadLog.read(str(tmp_path / "missing.wal")) == []
+
+
+def test_truncate_through_keeps_later_records_and_appends_continue(tmp_path):
+    wal = _wal(tmp_path)
+    for v in range(1, 7):
+        wal.append({"version": v})
+    wal.flush()
+    wal.truncate_through(4)
+    assert [r["version"] for r in WriteAheadLog.read(str(tmp_path / "state.wal"))] == [5, 6]
+    wal.wait_durable(wal.append({"version": 7}))
+    wal.close()
+    assert [r["version"] for r in WriteAheadLog.read(str(tmp_path / "state.wal"))] == [5, 6, 7]
+
+
+def test_close_flushes_pending_records_and_releases_waiters(tmp_path):
+    wal = _wal(tmp_path, flush_interval=30.0, batch_size=1000)
+    lsn = wal.append({"version": 1})
+    wal.close()
+    wal.wait_durable(lsn + 10)
+    assert WriteAheadLog.read(str(tmp_path / "state.wal")) == [{"version": 1}]
+
+
+def test_a_failed_fsync_is_raised_to_waiters_and_later_appends(tmp_path, monkeypatch):
+    def failing_fsync(fd):
+        raise OSError(5, "Input/output error")
+
+    wal = _wal(tmp_path, flush_interval=0.01)
+    monkeypatch.setattr("wal.os.fsync", failing_fsync)
+    lsn = wal.append({"version": 1})
+    with pytest.raises(WriteAheadLogError):
+        wal.wait_durable(lsn)
+    with pytest.raises(WriteAheadLogError):
+        wal.append({"version": 2})
+    with pytest.raises(WriteAheadLogError):
+        wal.close()